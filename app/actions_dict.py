@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 from dataclasses import dataclass, field
 
 
@@ -26,6 +26,11 @@ action_list: List[Action] = [
         'Pass start and end seconds please as one message like that: `15-120`.\n'
         '`0` means - convert entire file to a voice message.',
     ),
+    Action(
+        'splitvoice',
+        '🎙 🎙 Split long audio into a series of voice messages',
+        'Send audio file. It will come back as consecutive voice messages of up to 4 minutes each.',
+    ),
     Action(
         'thumbnail',
         '🏞 📎 Set thumbnail for audio file via Telegram API',
@@ -50,3 +55,5 @@ action_list: List[Action] = [
 ]
 
 actions: Actions = Actions({x.name: x for x in action_list})
+# Кнопки клавиатуры выбора действия: ('id кнопки', 'title кнопки').
+action_buttons: Tuple[Tuple[str, str], ...] = tuple((action.name, action.title) for action in action_list)
@@ -0,0 +1,258 @@
+import asyncio
+from asyncio import Future
+from collections import OrderedDict
+import logging
+from logging import Logger
+import time
+from typing import Dict, Optional, Tuple
+from uuid import uuid4
+
+from aioredis.commands import Redis
+
+from app import codec
+from app.config import (
+    DEBUGLEVEL,
+    FILE_META_CACHE_SIZE,
+    FILE_META_CACHE_TTL,
+    RESULT_CACHE_INFLIGHT_TTL,
+    RESULT_CACHE_TTL,
+    RESULT_CACHE_WAIT,
+)
+from app.jobs import consumer_slot_released
+from app.metrics import metrics
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+class ResultCache:
+    """
+    Кэш результатов обработки: (file_unique_id, action, time range) -> file_id уже отправленного в Telegram файла.
+    При попадании файл пересылается по file_id, без скачивания, перекодирования и загрузки.
+
+    Singleflight: первый запрос на ключ берет в redis in-flight маркер (SET NX) и делает работу.
+    Маркер живет inflight_ttl секунд и продлевается, пока владелец работает: медленный джоб не приводит
+    к повторной обработке, а маркер упавшего процесса быстро истекает.
+    Одинаковые запросы, пришедшие пока работа идет, ждут ее результата: в этом процессе через Future,
+    из других процессов - BLPOP на списке уведомлений ключа, в который владелец при release кладет по элементу
+    на каждого зарегистрированного ждущего. Пока запрос ждет, его слот потребителя media-воркера свободен
+    (см. app/jobs.py). Не дождавшись за RESULT_CACHE_WAIT секунд, запрос выполняется сам, без кэша.
+    """
+    cacheable_actions: Tuple[str] = ('crop', 'makevoice', 'makeopus', 'makerounded')
+    # Продлить маркер, если он принадлежит этому владельцу.
+    renew_script: str = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end"
+    )
+    # Зарегистрировать ждущего, только если работа еще идет: иначе уведомления уже не будет.
+    wait_script: str = (
+        "if redis.call('exists', KEYS[1]) == 1 then "
+        "redis.call('incr', KEYS[2]) redis.call('expire', KEYS[2], ARGV[1]) return 1 else return 0 end"
+    )
+    # Снять свой маркер и разбудить всех зарегистрированных ждущих.
+    release_script: str = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then redis.call('del', KEYS[1]) end "
+        "local waiters = tonumber(redis.call('get', KEYS[2]) or '0') "
+        "redis.call('del', KEYS[2]) "
+        "for i = 1, waiters do redis.call('rpush', KEYS[3], '1') end "
+        "if waiters > 0 then redis.call('expire', KEYS[3], ARGV[2]) end "
+        "return waiters"
+    )
+
+    def __init__(
+            self,
+            redis_conn: Redis,
+            ttl: Optional[int] = RESULT_CACHE_TTL,
+            wait: Optional[int] = RESULT_CACHE_WAIT,
+            inflight_ttl: Optional[int] = RESULT_CACHE_INFLIGHT_TTL,
+    ):
+        self.redis: Redis = redis_conn
+        self.ttl: int = ttl
+        self.wait: int = wait
+        self.inflight_ttl: int = max(3, inflight_ttl)
+        self._inflight: Dict[str, Future] = {}
+        self._owned: Dict[str, Tuple[str, asyncio.Task]] = {}
+
+    def make_key(self, file_meta: dict, action: str, time_range: Optional[Tuple[int, int]]) -> Optional[str]:
+        """Возвращает ключ кэша или None, если результат этого действия не кэшируется."""
+        file_unique_id: str = file_meta.get('file_unique_id')
+        if action not in self.cacheable_actions or not file_unique_id:
+            return None
+
+        params: str = f'{time_range[0]}-{time_range[1]}' if time_range else 'full'
+        return f'result-{file_unique_id}-{action}-{params}'
+
+    async def _get(self, key: str) -> Optional[dict]:
+        with await self.redis as redis_conn:
+            data: Optional[bytes] = await redis_conn.get(key)
+        return codec.loads(data) if data else None
+
+    async def _heartbeat(self, key: str, token: str):
+        while True:
+            await asyncio.sleep(self.inflight_ttl / 3)
+            with await self.redis as redis_conn:
+                renewed: int = await redis_conn.eval(
+                    self.renew_script, keys=[f'{key}-inflight'], args=[token, self.inflight_ttl],
+                )
+            if not renewed:
+                log.warning(f'In-flight marker lost: {key}')
+                return
+
+    async def _wait_notification(self, key: str, timeout: float) -> bool:
+        """
+        Ждет release владельца не дольше timeout. False - владельца уже нет, ждать нечего.
+        Слот потребителя media-воркера на время ожидания отдается другому джобу.
+        """
+        with await self.redis as redis_conn:
+            registered: int = await redis_conn.eval(
+                self.wait_script, keys=[f'{key}-inflight', f'{key}-waiters'], args=[self.wait],
+            )
+        if not registered:
+            return False
+
+        metrics.incr('result_cache.wait')
+        async with consumer_slot_released():
+            with await self.redis as redis_conn:
+                await redis_conn.blpop(f'{key}-done', timeout=max(1, int(min(timeout, self.inflight_ttl))))
+        return True
+
+    async def acquire(self, key: Optional[str]) -> Tuple[Optional[dict], bool]:
+        """
+        Возвращает (закэшированный результат, владеет ли вызывающий in-flight маркером).
+        Если результата нет и маркер получен - вызывающий должен сделать работу, вызвать store() и release().
+        """
+        if not key:
+            return None, False
+
+        deadline: float = time.monotonic() + self.wait
+        while True:
+            cached: Optional[dict] = await self._get(key)
+            if cached:
+                metrics.incr('result_cache.hit')
+                log.debug(f'Result cache hit: {key}')
+                return cached, False
+
+            remaining: float = deadline - time.monotonic()
+            if remaining <= 0:
+                metrics.incr('result_cache.wait_timeout')
+                log.warning(f'Gave up waiting for in-flight result: {key}')
+                return None, False
+
+            local: Optional[Future] = self._inflight.get(key)
+            if local:
+                try:
+                    await asyncio.wait_for(asyncio.shield(local), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            token: str = uuid4().hex
+            with await self.redis as redis_conn:
+                owned: bool = await redis_conn.set(
+                    f'{key}-inflight', token, expire=self.inflight_ttl, exist=redis_conn.SET_IF_NOT_EXIST,
+                )
+            if owned:
+                metrics.incr('result_cache.miss')
+                self._inflight[key] = asyncio.get_event_loop().create_future()
+                self._owned[key] = token, asyncio.ensure_future(self._heartbeat(key, token))
+                return None, True
+
+            await self._wait_notification(key, remaining)
+
+    async def store(self, key: Optional[str], result: Optional[dict]):
+        if not key or not result:
+            return
+        with await self.redis as redis_conn:
+            await redis_conn.set(key, codec.dumps(result), expire=self.ttl)
+
+    async def invalidate(self, key: Optional[str]):
+        """Удаляет результат, например, если Telegram больше не принимает его file_id."""
+        if not key:
+            return
+        with await self.redis as redis_conn:
+            await redis_conn.delete(key)
+
+    async def release(self, key: Optional[str], owned: bool):
+        """Снимает in-flight маркер и будит ждущих в этом и других процессах. Ждущие заново проверят кэш."""
+        if not key or not owned:
+            return
+        token, heartbeat = self._owned.pop(key)
+        heartbeat.cancel()
+        with await self.redis as redis_conn:
+            await redis_conn.eval(
+                self.release_script,
+                keys=[f'{key}-inflight', f'{key}-waiters', f'{key}-done'],
+                args=[token, self.inflight_ttl],
+            )
+        local: Optional[Future] = self._inflight.pop(key, None)
+        if local and not local.done():
+            local.set_result(None)
+
+
+class FileMetaCache:
+    """
+    Кэш ответов getFile: file_id -> (file_path, file_size). Убирает запрос к Bot API перед повторным скачиванием
+    того же файла: пользователь повторил команду после ошибки диапазона, один трек переслали многим пользователям.
+    Два уровня: LRU в памяти процесса и redis, общий для всех процессов. TTL меньше часа,
+    который Telegram гарантирует для ссылки на скачивание. Протухшую раньше ссылку можно сбросить invalidate().
+    """
+    fields: Tuple[str] = ('file_id', 'file_unique_id', 'file_size', 'file_path')
+
+    def __init__(
+            self,
+            redis_conn: Redis,
+            ttl: Optional[int] = FILE_META_CACHE_TTL,
+            size: Optional[int] = FILE_META_CACHE_SIZE,
+    ):
+        self.redis: Redis = redis_conn
+        self.ttl: int = ttl
+        self.size: int = size
+        self._local: 'OrderedDict[str, Tuple[float, dict]]' = OrderedDict()
+
+    @staticmethod
+    def key(file_id: str) -> str:
+        return f'filemeta-{file_id}'
+
+    def _remember(self, file_id: str, file_meta: dict, expires: float):
+        self._local[file_id] = (expires, file_meta)
+        self._local.move_to_end(file_id)
+        while len(self._local) > self.size:
+            self._local.popitem(last=False)
+
+    async def get(self, file_id: str) -> Optional[dict]:
+        """Копия закэшированного ответа getFile или None."""
+        entry: Optional[Tuple[float, dict]] = self._local.get(file_id)
+        if entry and entry[0] > time.monotonic():
+            self._local.move_to_end(file_id)
+            metrics.incr('file_meta_cache.hit_local')
+            return dict(entry[1])
+        if entry:
+            del self._local[file_id]
+
+        with await self.redis as redis_conn:
+            transaction = redis_conn.multi_exec()
+            transaction.get(self.key(file_id))
+            transaction.ttl(self.key(file_id))
+            data: Optional[bytes]
+            ttl: int
+            data, ttl = await transaction.execute()
+
+        if not data or ttl <= 0:
+            metrics.incr('file_meta_cache.miss')
+            return None
+
+        file_meta: dict = codec.loads(data)
+        self._remember(file_id, file_meta, time.monotonic() + ttl)
+        metrics.incr('file_meta_cache.hit_redis')
+        return dict(file_meta)
+
+    async def store(self, file_id: str, file_meta: dict):
+        file_meta = {key: file_meta[key] for key in self.fields if key in file_meta}
+        self._remember(file_id, file_meta, time.monotonic() + self.ttl)
+        with await self.redis as redis_conn:
+            await redis_conn.set(self.key(file_id), codec.dumps(file_meta), expire=self.ttl)
+
+    async def invalidate(self, file_id: str):
+        self._local.pop(file_id, None)
+        with await self.redis as redis_conn:
+            await redis_conn.delete(self.key(file_id))
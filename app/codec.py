@@ -0,0 +1,26 @@
+"""
+JSON кодек для всего приложения: webhook, ответы Telegram API, вывод ffprobe, клавиатуры, кэш результатов.
+Использует orjson, если он установлен, иначе стандартный json. Интерфейс одинаковый:
+loads принимает str или bytes, dumps возвращает str (его ждут aiohttp json_response и параметры запросов).
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND: str = 'orjson' if orjson else 'json'
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
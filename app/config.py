@@ -1,5 +1,5 @@
 import os
-from typing import Tuple
+from typing import Dict, Tuple
 
 from app.exceptions.base import ConfigurationError
 
@@ -8,6 +8,9 @@ DEBUGLEVEL: str = os.getenv('DEBUGLEVEL', 'DEBUG')
 if DEBUGLEVEL and DEBUGLEVEL not in DEBUGLEVELS:
     raise ConfigurationError('invalid_debuglevel', {'LEVELS': DEBUGLEVELS})
 
+# Разбирать входящие update полной marshmallow схемой Update вместо быстрого parse_update. Для отладки.
+FULL_UPDATE_SCHEMA: bool = os.getenv('FULL_UPDATE_SCHEMA', '0') == '1'
+
 TOKEN: str = os.getenv('TOKEN', None)
 if not TOKEN:
     raise ConfigurationError('no_token', {'token': TOKEN})
@@ -15,11 +18,117 @@ if not TOKEN:
 SERVER_NAME: str = os.getenv('SERVER_NAME')
 PUBLIC_PORT: int = int(os.getenv('PUBLIC_PORT'))
 
-OPERATION_LOCK_TIMEOUT: int = 600
+REDIS_ADDRESS: Tuple[str, int] = (os.getenv('REDIS_HOST', 'redis'), int(os.getenv('REDIS_PORT', 6379)))
+
+# TTL per-user lease операции. Пока операция идет, lease продлевается каждые LEASE_HEARTBEAT_INTERVAL секунд.
+OPERATION_LOCK_TIMEOUT: int = int(os.getenv('OPERATION_LOCK_TIMEOUT', 600))
+LEASE_HEARTBEAT_INTERVAL: int = int(os.getenv('LEASE_HEARTBEAT_INTERVAL', 60))
+
+# Режим отдельного пула media-воркеров (python -m app.worker).
+# Webhook только кладет джоб в очередь redis, тяжелая обработка идет в воркерах.
+MEDIA_WORKERS_ENABLED: bool = os.getenv('MEDIA_WORKERS_ENABLED', '0') == '1'
+MEDIA_WORKERS: int = int(os.getenv('MEDIA_WORKERS', os.cpu_count() or 1))
+MEDIA_WORKER_CONCURRENCY: int = int(os.getenv('MEDIA_WORKER_CONCURRENCY', 2))
+JOB_QUEUE_KEY: str = 'media-jobs'
+
+# Бюджет CPU процесса в условных единицах для ffmpeg/ffprobe подпроцессов. По умолчанию: 2 единицы на ядро
+# на всю машину, т.е. при пуле media-воркеров он делится между MEDIA_WORKERS процессами.
+CPU_BUDGET: int = int(os.getenv(
+    'CPU_BUDGET',
+    max(1, 2 * (os.cpu_count() or 1) // (MEDIA_WORKERS if MEDIA_WORKERS_ENABLED else 1)),
+))
+# Сколько единиц бюджета занимает одна команда. Кодирование видео многопоточное и самое тяжелое,
+# crop делается через -acodec copy и почти не нагружает CPU.
+ACTION_CPU_WEIGHTS: Dict[str, int] = {
+    'probe': 1,
+    'crop': 1,
+    'makevoice': 2,
+    'makeopus': 2,
+    'makerounded': 4,
+    'splitvoice': 2,
+}
+
+# Пул для блокирующей CPU работы вне event loop (PIL, mutagen): 'thread' или 'process', и его размер.
+BLOCKING_EXECUTOR: str = os.getenv('BLOCKING_EXECUTOR', 'thread')
+BLOCKING_WORKERS: int = int(os.getenv('BLOCKING_WORKERS', 2))
+
+# Каждый процесс (gunicorn и media воркеры) раз в METRICS_PUBLISH_INTERVAL секунд пишет снимок своих метрик
+# в redis hash METRICS_KEY, /stats/ собирает их все.
+METRICS_KEY: str = 'metrics'
+METRICS_PUBLISH_INTERVAL: int = int(os.getenv('METRICS_PUBLISH_INTERVAL', 10))
+
+# Фоновая отправка ответов из webhook: число отправителей и максимальная длина очереди.
+SENDER_WORKERS: int = int(os.getenv('SENDER_WORKERS', 4))
+SENDER_QUEUE_SIZE: int = int(os.getenv('SENDER_QUEUE_SIZE', 1000))
+
+# Кэш результатов: сколько хранить file_id обработанного файла и сколько ждать такой же, уже идущий, запрос.
+RESULT_CACHE_TTL: int = int(os.getenv('RESULT_CACHE_TTL', 7 * 24 * 3600))
+RESULT_CACHE_WAIT: int = int(os.getenv('RESULT_CACHE_WAIT', 300))
+# TTL in-flight маркера. Владелец продлевает его, пока работает, так что это время обнаружения упавшего владельца.
+RESULT_CACHE_INFLIGHT_TTL: int = int(os.getenv('RESULT_CACHE_INFLIGHT_TTL', 30))
+
+# makeopus длинных FLAC и WAV (не короче OPUS_SEGMENT_MIN_DURATION секунд) кодируется OPUS_SEGMENTS параллельными
+# ffmpeg, если бюджет CPU процесса сейчас свободен. 1 - выключено.
+OPUS_SEGMENTS: int = int(os.getenv('OPUS_SEGMENTS', 1))
+OPUS_SEGMENT_MIN_DURATION: int = int(os.getenv('OPUS_SEGMENT_MIN_DURATION', 300))
+
+# splitvoice: битрейт голосовых кусков, длина куска (не больше, чем влезает в 1 Мб при этом битрейте),
+# максимальная длительность исходника и сколько кусков одного файла кодируется одновременно.
+SPLIT_VOICE_BITRATE: int = int(os.getenv('SPLIT_VOICE_BITRATE', 32000))
+SPLIT_VOICE_CHUNK_DURATION: int = int(os.getenv('SPLIT_VOICE_CHUNK_DURATION', 240))
+SPLIT_VOICE_MAX_DURATION: int = int(os.getenv('SPLIT_VOICE_MAX_DURATION', 3 * 3600))
+SPLIT_VOICE_PARALLEL: int = int(os.getenv('SPLIT_VOICE_PARALLEL', 3))
+
+# Сколько индексов фреймов MP3 (для обрезки без ffmpeg) держать в памяти процесса.
+MP3_INDEX_CACHE_SIZE: int = int(os.getenv('MP3_INDEX_CACHE_SIZE', 64))
+
+# Кэш ответов getFile: ссылка на скачивание валидна час, храним меньше. Размер LRU в памяти процесса.
+FILE_META_CACHE_TTL: int = int(os.getenv('FILE_META_CACHE_TTL', 50 * 60))
+FILE_META_CACHE_SIZE: int = int(os.getenv('FILE_META_CACHE_SIZE', 1024))
+
+# Idle TTL стейта пользователя, продлевается при каждом обращении.
+# Стейт с картинками (thumbnail/setcover) живет меньше, т.к. занимает в redis на порядки больше.
+STATE_TTL: int = int(os.getenv('STATE_TTL', 7 * 24 * 3600))
+STATE_BLOB_TTL: int = int(os.getenv('STATE_BLOB_TTL', 3600))
+
+# Лимиты отправки сообщений Telegram на процесс: сообщений в секунду и размер всплеска, общие и на один чат.
+TG_GLOBAL_RATE: float = float(os.getenv('TG_GLOBAL_RATE', 30))
+TG_GLOBAL_BURST: float = float(os.getenv('TG_GLOBAL_BURST', 30))
+TG_CHAT_RATE: float = float(os.getenv('TG_CHAT_RATE', 1))
+TG_CHAT_BURST: float = float(os.getenv('TG_CHAT_BURST', 3))
+# Сколько раз повторять запрос, на который Telegram ответил 429 с parameters.retry_after.
+TG_MAX_RETRIES: int = int(os.getenv('TG_MAX_RETRIES', 3))
+# HTTP клиенты Telegram: отдельные пулы для вызовов методов и для передачи файлов.
+TG_API_CONNECTIONS: int = int(os.getenv('TG_API_CONNECTIONS', 32))
+TG_API_TIMEOUT: int = int(os.getenv('TG_API_TIMEOUT', 30))
+TG_FILE_CONNECTIONS: int = int(os.getenv('TG_FILE_CONNECTIONS', 16))
+# Для файлов это не общее время передачи, а сколько секунд можно не получать данных от сервера.
+TG_FILE_TIMEOUT: int = int(os.getenv('TG_FILE_TIMEOUT', 180))
+TG_KEEPALIVE_TIMEOUT: int = int(os.getenv('TG_KEEPALIVE_TIMEOUT', 60))
+TG_DNS_CACHE_TTL: int = int(os.getenv('TG_DNS_CACHE_TTL', 300))
+# Сколько байт от начала файла скачивать для проверки длительности и потоков до полного скачивания.
+PROBE_PREFIX_SIZE: int = int(os.getenv('PROBE_PREFIX_SIZE', 256 * 1024))
+# Файлы больше порога скачиваются RANGE_DOWNLOAD_PARTS параллельными HTTP Range запросами. 1 - выключено.
+RANGE_DOWNLOAD_PARTS: int = int(os.getenv('RANGE_DOWNLOAD_PARTS', 4))
+RANGE_DOWNLOAD_THRESHOLD: int = int(os.getenv('RANGE_DOWNLOAD_THRESHOLD', 4 * 1048576))
 
 SIZE_1MB: int = 1048576
 SIZE_20MB: int = 20971520
 SIZE_50MB: int = 52428800
+SIZE_2000MB: int = 2097152000
+
+# Адрес Bot API сервера. Можно указать свой telegram-bot-api или заглушку для нагрузочных тестов.
+TG_API_BASE_URL: str = os.getenv('TG_API_BASE_URL', 'https://api.telegram.org').rstrip('/')
+# Свой telegram-bot-api в режиме --local: getFile отдает абсолютный путь к файлу на диске сервера
+# (диск должен быть примонтирован в контейнер бота по тому же пути), лимиты на размер файлов выше.
+TG_LOCAL_MODE: bool = os.getenv('TG_LOCAL_MODE', '0') == '1'
+TG_DOWNLOAD_LIMIT: int = int(os.getenv('TG_DOWNLOAD_LIMIT', SIZE_2000MB if TG_LOCAL_MODE else SIZE_20MB))
+TG_UPLOAD_LIMIT: int = int(os.getenv('TG_UPLOAD_LIMIT', SIZE_2000MB if TG_LOCAL_MODE else SIZE_50MB))
+
+# Размер чанка при потоковой передаче файла из Telegram прямо в stdin ffmpeg.
+STREAM_CHUNK_SIZE: int = int(os.getenv('STREAM_CHUNK_SIZE', 65536))
+# Отправлять результат ffmpeg в Telegram потоком, не дожидаясь окончания кодирования.
+STREAM_UPLOADS: bool = os.getenv('STREAM_UPLOADS', '0') == '1'
 
 # Опытным путем установил что радиус (length) может быть max: 637px, min: 100px
 VIDEO_NOTE_MAX_RADIUS: int = 600
@@ -33,6 +142,7 @@ Type something to call a dog (doc) or use a /start command and you'll get Action
 
 - *Cut audio files* by specified period of time in seconds, returning a fragment of the same format.
 - Same, returning Telegram *Voice message*.
+- *Split* a long audio file into a series of voice messages.
 - *Set thumbnail* for an audio file. Thumbnail shows in Telegram only and not being placed into your file.
 - *Set cover*. Same as above with also including a picture inside audio file as front cover.
 - Convert audio files to *Opus OGG* format as, by far, most advanced audio format.
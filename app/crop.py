@@ -0,0 +1,549 @@
+"""
+Обрезка WAV, FLAC и MP3 в процессе, без ffmpeg.
+
+WAV: новый заголовок плюс срез PCM данных по byte_rate * секунды, выровненный по block_align.
+FLAC: новый STREAMINFO плюс срез целых фреймов. Фрейм с нужным сэмплом ищется бинарным поиском по байтовому
+смещению: заголовок каждого фрейма содержит его абсолютный номер. Точность обрезки - один фрейм (обычно 4096 сэмплов).
+Номера фреймов в срезе переписываются с нуля, CRC-8 заголовка и CRC-16 фрейма пересчитываются, иначе декодеры
+считают, что файл начинается не с нуля (ffmpeg показывает start: 4.9 у куска 5-12 секунд).
+MP3: ID3v2 тег плюс срез фреймов по индексу их смещений (index_mp3), точность - один фрейм (1152 сэмпла).
+
+Функции возвращают список кусков результата: новый заголовок и memoryview срезов исходника без копирования
+(у FLAC между срезами - новые заголовки фреймов и их CRC-16). Куски отдаются дальше как есть, не склеиваясь
+(см. MediaHandler._crop_file). None, если файл не удалось разобрать: тогда обрезка идет обычным путем через ffmpeg.
+"""
+from array import array
+from collections import OrderedDict
+import struct
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from app.config import MP3_INDEX_CACHE_SIZE
+
+CropResult = List[Union[bytes, memoryview]]
+
+# WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_EXTENSIBLE.
+WAV_FORMATS: Tuple[int] = (1, 3, 0xFFFE)
+
+FLAC_STREAMINFO: int = 0
+# Блоки метаданных, которые переносятся в обрезанный файл как есть: VORBIS_COMMENT и PICTURE.
+# SEEKTABLE и CUESHEET ссылаются на старые смещения, PADDING не нужен.
+FLAC_KEPT_BLOCKS: Tuple[int] = (4, 6)
+# Сколько байт просматривать линейно после бинарного поиска. С запасом больше любого фрейма в 4096 сэмплов.
+FLAC_SCAN_WINDOW: int = 65536
+
+
+def crop_wav(data: bytes, start: float, end: float) -> Optional[CropResult]:
+    """Обрезает PCM WAV по секундам [start, end). Чанки кроме fmt и data (LIST и пр.) не переносятся."""
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+
+    fmt: Optional[bytes] = None
+    data_offset: Optional[int] = None
+    data_size: int = 0
+    pos: int = 12
+    while pos + 8 <= len(data):
+        chunk_id: bytes = data[pos:pos + 4]
+        chunk_size: int = struct.unpack_from('<I', data, pos + 4)[0]
+        if chunk_id == b'fmt ':
+            fmt = data[pos + 8:pos + 8 + chunk_size]
+        elif chunk_id == b'data':
+            data_offset = pos + 8
+            # Записанный потоком WAV может не знать своего размера: 0 или 0xFFFFFFFF.
+            data_size = min(chunk_size, len(data) - data_offset) or len(data) - data_offset
+            break
+        pos += 8 + chunk_size + (chunk_size & 1)
+
+    if not fmt or len(fmt) < 16 or data_offset is None:
+        return None
+
+    audio_format: int
+    byte_rate: int
+    block_align: int
+    audio_format, _, _, byte_rate, block_align = struct.unpack_from('<HHIIH', fmt)
+    if audio_format not in WAV_FORMATS or not byte_rate or not block_align:
+        return None
+
+    first: int = int(byte_rate * start) // block_align * block_align
+    last: int = min(int(byte_rate * end) // block_align * block_align, data_size // block_align * block_align)
+    if first >= last:
+        return None
+
+    size: int = last - first
+    fmt_chunk: bytes = b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'\x00' * (len(fmt) & 1)
+    header: bytes = (
+        b'RIFF' + struct.pack('<I', 4 + len(fmt_chunk) + 8 + size + (size & 1)) + b'WAVE'
+        + fmt_chunk + b'data' + struct.pack('<I', size)
+    )
+    view: memoryview = memoryview(data)[data_offset + first:data_offset + last]
+    if size & 1:
+        # Чанк нечетной длины дополняется байтом. Бывает только у 8-bit mono.
+        return [header, view, b'\x00']
+    return [header, view]
+
+
+class StreamInfo(NamedTuple):
+    min_block_size: int
+    sample_rate: int
+    total_samples: int
+    raw: bytes
+
+
+class Frame(NamedTuple):
+    pos: int
+    sample: int
+    block_size: int
+    # Номер из заголовка (фрейма, или сэмпла для variable block size), конец его UTF-8 кодировки и конец
+    # заголовка вместе с CRC-8.
+    number: int
+    number_end: int
+    header_end: int
+
+
+def _crc8(data: bytes) -> int:
+    crc: int = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def _crc16_table() -> Tuple[int]:
+    table: List[int] = []
+    for byte in range(256):
+        crc: int = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x8005) & 0xFFFF if crc & 0x8000 else (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+
+FLAC_CRC16_TABLE: Tuple[int] = _crc16_table()
+
+
+def _crc16(data: bytes, crc: int = 0) -> int:
+    """CRC-16 фрейма FLAC: полином 0x8005, без отражения, начальное значение 0."""
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ FLAC_CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def _crc16_zeros_operators() -> List[Tuple[int]]:
+    """
+    CRC-16 линейна: прогон n нулевых байт - линейное отображение 16 бит состояния. operators[k] - образы
+    битов состояния для 2**k нулевых байт, так сдвиг на любое n собирается из log(n) операторов.
+    """
+    operator: Tuple[int] = tuple(_crc16(b'\x00', 1 << bit) for bit in range(16))
+    operators: List[Tuple[int]] = [operator]
+    for _ in range(40):
+        operator = tuple(_crc16_apply(operator, column) for column in operator)
+        operators.append(operator)
+    return operators
+
+
+def _crc16_apply(operator: Tuple[int], crc: int) -> int:
+    result: int = 0
+    bit: int = 0
+    while crc:
+        if crc & 1:
+            result ^= operator[bit]
+        crc >>= 1
+        bit += 1
+    return result
+
+
+def _crc16_shift(crc: int, length: int) -> int:
+    """Состояние CRC-16 после еще length нулевых байт."""
+    bit: int = 0
+    while length:
+        if length & 1:
+            crc = _crc16_apply(FLAC_CRC16_ZEROS[bit], crc)
+        length >>= 1
+        bit += 1
+    return crc
+
+
+FLAC_CRC16_ZEROS: List[Tuple[int]] = _crc16_zeros_operators()
+
+
+def _utf8_number(number: int) -> bytes:
+    """Номер фрейма или сэмпла в расширенной UTF-8 кодировке FLAC (до 36 бит, до 7 байт)."""
+    if number < 0x80:
+        return bytes((number,))
+    length: int = 2
+    while length < 7 and number >= 1 << (5 * length + 1):
+        length += 1
+    lead: int = (0xFF00 >> length) & 0xFF
+    tail: List[int] = [0x80 | (number >> (6 * index)) & 0x3F for index in range(length - 2, -1, -1)]
+    return bytes([lead | number >> (6 * (length - 1))] + tail)
+
+
+def _parse_flac_metadata(data: bytes) -> Optional[Tuple[StreamInfo, List[bytes], int]]:
+    """STREAMINFO, сохраняемые блоки метаданных целиком (с заголовком) и смещение первого фрейма."""
+    if data[:4] != b'fLaC':
+        return None
+
+    streaminfo: Optional[StreamInfo] = None
+    kept: List[bytes] = []
+    pos: int = 4
+    while True:
+        if pos + 4 > len(data):
+            return None
+        is_last: bool = bool(data[pos] & 0x80)
+        block_type: int = data[pos] & 0x7F
+        length: int = int.from_bytes(data[pos + 1:pos + 4], 'big')
+        body: bytes = data[pos + 4:pos + 4 + length]
+        if block_type == FLAC_STREAMINFO and length == 34:
+            packed: int = int.from_bytes(body[10:18], 'big')
+            streaminfo = StreamInfo(
+                min_block_size=int.from_bytes(body[0:2], 'big'),
+                sample_rate=packed >> 44,
+                total_samples=packed & 0xFFFFFFFFF,
+                raw=body,
+            )
+        elif block_type in FLAC_KEPT_BLOCKS:
+            kept.append(data[pos:pos + 4 + length])
+        pos += 4 + length
+        if is_last:
+            break
+
+    if not streaminfo or not streaminfo.sample_rate:
+        return None
+    return streaminfo, kept, pos
+
+
+def _parse_frame_header(data: bytes, pos: int, streaminfo: StreamInfo) -> Optional[Frame]:
+    """Разбирает заголовок фрейма в pos. None, если это не заголовок (ложная синхропоследовательность)."""
+    if pos + 6 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xFE != 0xF8:
+        return None
+    variable: bool = bool(data[pos + 1] & 0x01)
+    block_code: int = data[pos + 2] >> 4
+    rate_code: int = data[pos + 2] & 0x0F
+    channels_code: int = data[pos + 3] >> 4
+    size_code: int = (data[pos + 3] >> 1) & 0x07
+    if not block_code or rate_code == 0x0F or channels_code > 10 or size_code == 3 or data[pos + 3] & 0x01:
+        return None
+
+    # Номер фрейма (или сэмпла для variable block size) в кодировке UTF-8, до 7 байт.
+    first: int = data[pos + 4]
+    extra: int = 0
+    while extra < 7 and first & (0x80 >> extra):
+        extra += 1
+    if extra == 1 or first == 0xFF:
+        return None
+    number: int = first & (0x7F >> extra) if extra else first
+    cursor: int = pos + 5
+    for _ in range(max(0, extra - 1)):
+        if cursor >= len(data) or data[cursor] & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (data[cursor] & 0x3F)
+        cursor += 1
+
+    if block_code == 1:
+        block_size: int = 192
+    elif block_code <= 5:
+        block_size = 576 << (block_code - 2)
+    elif block_code == 6:
+        block_size = data[cursor] + 1 if cursor < len(data) else 0
+        cursor += 1
+    elif block_code == 7:
+        block_size = int.from_bytes(data[cursor:cursor + 2], 'big') + 1
+        cursor += 2
+    else:
+        block_size = 256 << (block_code - 8)
+    cursor += {12: 1, 13: 2, 14: 2}.get(rate_code, 0)
+
+    if cursor >= len(data) or _crc8(data[pos:cursor]) != data[cursor]:
+        return None
+
+    sample: int = number if variable else number * streaminfo.min_block_size
+    if streaminfo.total_samples and sample >= streaminfo.total_samples:
+        return None
+    return Frame(pos, sample, block_size, number, pos + 4 + max(1, extra), cursor + 1)
+
+
+def _next_frame(data: bytes, pos: int, streaminfo: StreamInfo) -> Optional[Frame]:
+    """Первый настоящий фрейм, начинающийся не раньше pos."""
+    while True:
+        pos = data.find(b'\xff', pos)
+        if pos < 0:
+            return None
+        frame: Optional[Frame] = _parse_frame_header(data, pos, streaminfo)
+        if frame:
+            return frame
+        pos += 1
+
+
+def _find_frame(data: bytes, frames_start: int, target: int, streaminfo: StreamInfo) -> Optional[Frame]:
+    """Первый фрейм, который заканчивается после сэмпла target. Бинарный поиск, затем линейный проход."""
+    low: int = frames_start
+    high: int = len(data)
+    while high - low > FLAC_SCAN_WINDOW:
+        middle: int = (low + high) // 2
+        frame: Optional[Frame] = _next_frame(data, middle, streaminfo)
+        if not frame or frame.sample > target:
+            high = middle
+        else:
+            low = frame.pos
+
+    frame = _next_frame(data, low, streaminfo)
+    while frame and frame.sample + frame.block_size <= target:
+        frame = _next_frame(data, frame.pos + 1, streaminfo)
+    return frame
+
+
+def _following_frame(data: bytes, frame: Frame, streaminfo: StreamInfo) -> Optional[Frame]:
+    """Фрейм сразу за frame: ложные синхропоследовательности внутри фрейма отбрасываются по номеру сэмпла."""
+    pos: int = frame.header_end
+    while True:
+        candidate: Optional[Frame] = _next_frame(data, pos, streaminfo)
+        if not candidate or candidate.sample == frame.sample + frame.block_size:
+            return candidate
+        pos = candidate.pos + 1
+
+
+def _ends_file(data: bytes, frame: Frame, streaminfo: StreamInfo) -> bool:
+    """
+    frame - последний фрейм и кончается ровно с данными: за ним нет ни фрейма, ни тега (ID3v1, APEv2).
+    Проверяется по числу сэмплов из STREAMINFO и CRC-16 всего [frame.pos, len(data)): вместе с самим CRC он равен 0.
+    """
+    return (
+        bool(streaminfo.total_samples)
+        and frame.sample + frame.block_size == streaminfo.total_samples
+        and _crc16(memoryview(data)[frame.pos:]) == 0
+    )
+
+
+def _renumber_frame(data: bytes, frame: Frame, end: int, number: int) -> List[Union[bytes, memoryview]]:
+    """
+    Фрейм [frame.pos, end) с номером number в заголовке: новый заголовок с CRC-8, тело фрейма как есть и
+    CRC-16. CRC-16 не считается заново по всему фрейму: по линейности достаточно разницы CRC заголовков,
+    сдвинутой на длину тела.
+    """
+    header: bytes = bytes(data[frame.pos:frame.pos + 4]) + _utf8_number(number) + bytes(
+        data[frame.number_end:frame.header_end - 1]
+    )
+    header += bytes((_crc8(header),))
+    body: memoryview = memoryview(data)[frame.header_end:end - 2]
+    old_crc: int = int.from_bytes(data[end - 2:end], 'big')
+    delta: int = _crc16(header) ^ _crc16(data[frame.pos:frame.header_end])
+    return [header, body, (_crc16_shift(delta, len(body)) ^ old_crc).to_bytes(2, 'big')]
+
+
+def crop_flac(data: bytes, start: float, end: float) -> Optional[CropResult]:
+    """
+    Обрезает FLAC по границам фреймов, покрывающих [start, end). MD5 в STREAMINFO обнуляется.
+    Фреймы нумеруются заново с нуля, поэтому результат начинается с 0 секунды.
+    None, если конец какого-то фрейма не найден: битый фрейм или тег после аудио. Тогда режет ffmpeg.
+    """
+    parsed: Optional[Tuple[StreamInfo, List[bytes], int]] = _parse_flac_metadata(data)
+    if not parsed:
+        return None
+    streaminfo, kept, frames_start = parsed
+
+    first: Optional[Frame] = _find_frame(data, frames_start, int(start * streaminfo.sample_rate), streaminfo)
+    if not first:
+        return None
+    end_sample: int = int(end * streaminfo.sample_rate)
+
+    # Фрейм, в котором лежит end, входит в результат целиком. Конец каждого фрейма - начало следующего.
+    pieces: List[Union[bytes, memoryview]] = []
+    frame: Optional[Frame] = first
+    while frame and frame.sample < max(end_sample, first.sample + 1):
+        following: Optional[Frame] = _following_frame(data, frame, streaminfo)
+        if not following and not _ends_file(data, frame, streaminfo):
+            return None
+        pieces += _renumber_frame(data, frame, following.pos if following else len(data), frame.number - first.number)
+        frame = following
+
+    # 0 в STREAMINFO означает, что число сэмплов неизвестно: так и оставляем, если оно не было известно.
+    last_sample: int = frame.sample if frame else streaminfo.total_samples
+    total_samples: int = last_sample - first.sample if last_sample else 0
+
+    raw: bytearray = bytearray(streaminfo.raw)
+    packed: int = int.from_bytes(raw[10:18], 'big')
+    raw[10:18] = ((packed & ~0xFFFFFFFFF) | total_samples).to_bytes(8, 'big')
+    raw[18:34] = bytes(16)
+
+    blocks: List[bytes] = [bytes((FLAC_STREAMINFO,)) + len(raw).to_bytes(3, 'big') + bytes(raw)] + kept
+    blocks[-1] = bytes((blocks[-1][0] | 0x80,)) + blocks[-1][1:]
+    return [b'fLaC' + b''.join(blocks)] + pieces
+
+
+# Битрейты MPEG audio в kbps: (MPEG1, layer) и (MPEG2/2.5, layer). Индекс 0 - free format, не поддерживается.
+MP3_BITRATES: Dict[Tuple[bool, int], Tuple[int, ...]] = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Частоты дискретизации по версии: 0 - MPEG2.5, 2 - MPEG2, 3 - MPEG1.
+MP3_SAMPLE_RATES: Dict[int, Tuple[int, int, int]] = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+# Где искать первые фреймы после ID3 тега.
+MP3_SYNC_WINDOW: int = 65536
+
+
+class Mp3Frame(NamedTuple):
+    version: int
+    layer: int
+    sample_rate: int
+    samples: int
+    length: int
+    mono: bool
+
+
+class Mp3FrameIndex(NamedTuple):
+    """Смещения аудио фреймов MP3. Фрейм i начинается на i * samples_per_frame / sample_rate секунде."""
+    tag_end: int
+    sample_rate: int
+    samples_per_frame: int
+    offsets: array
+    audio_end: int
+
+
+def _parse_mp3_header(data: bytes, pos: int) -> Optional[Mp3Frame]:
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    version: int = (data[pos + 1] >> 3) & 0x03
+    layer: int = 4 - ((data[pos + 1] >> 1) & 0x03)
+    bitrate_index: int = data[pos + 2] >> 4
+    rate_index: int = (data[pos + 2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1: bool = version == 3
+    bitrate: int = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate: int = MP3_SAMPLE_RATES[version][rate_index]
+    padding: int = (data[pos + 2] >> 1) & 0x01
+    if layer == 1:
+        samples: int = 384
+        length: int = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or mpeg1:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+    else:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+    return Mp3Frame(version, layer, sample_rate, samples, length, data[pos + 3] >> 6 == 3)
+
+
+def _skip_id3v2(data: bytes) -> int:
+    """Конец ID3v2 тегов в начале файла (их может быть несколько подряд)."""
+    pos: int = 0
+    while data[pos:pos + 3] == b'ID3' and pos + 10 <= len(data):
+        size: int = 0
+        for byte in data[pos + 6:pos + 10]:
+            size = (size << 7) | (byte & 0x7F)
+        pos += 10 + size + (10 if data[pos + 5] & 0x10 else 0)
+    return pos
+
+
+def _is_info_frame(data: bytes, pos: int, frame: Mp3Frame) -> bool:
+    """Фрейм с Xing/Info или VBRI заголовком: в нем нет звука, а описание всего файла после обрезки неверно."""
+    side_info: int = (32 if not frame.mono else 17) if frame.version == 3 else (17 if not frame.mono else 9)
+    xing: int = pos + 4 + side_info
+    return data[xing:xing + 4] in (b'Xing', b'Info') or data[pos + 36:pos + 40] == b'VBRI'
+
+
+def index_mp3(data: bytes) -> Optional[Mp3FrameIndex]:
+    """
+    Проходит MP3 по заголовкам фреймов и запоминает их смещения. Проход останавливается на первом месте,
+    где нет валидного фрейма той же версии и частоты: ID3v1, APE тег или мусор в конце файла.
+    """
+    tag_end: int = _skip_id3v2(data)
+
+    # Первый фрейм - тот, за которым сразу идет еще один валидный фрейм, чтобы не принять мусор за синхронизацию.
+    pos: int = tag_end
+    first: Optional[Mp3Frame] = None
+    while pos < min(len(data), tag_end + MP3_SYNC_WINDOW):
+        pos = data.find(b'\xff', pos)
+        if pos < 0:
+            return None
+        first = _parse_mp3_header(data, pos)
+        if first and _parse_mp3_header(data, pos + first.length):
+            break
+        first = None
+        pos += 1
+    if not first:
+        return None
+
+    offsets: array = array('I')
+    if _is_info_frame(data, pos, first):
+        pos += first.length
+    while True:
+        frame: Optional[Mp3Frame] = _parse_mp3_header(data, pos)
+        if (
+            not frame or pos + frame.length > len(data)
+            or frame.version != first.version or frame.sample_rate != first.sample_rate
+        ):
+            break
+        offsets.append(pos)
+        pos += frame.length
+
+    if not offsets:
+        return None
+    return Mp3FrameIndex(tag_end, first.sample_rate, first.samples, offsets, pos)
+
+
+def crop_mp3(data: bytes, start: float, end: float, index: Optional[Mp3FrameIndex] = None) -> Optional[CropResult]:
+    """
+    Обрезает MP3 по границам фреймов, как ffmpeg -acodec copy: ID3v2 тег исходника плюс срез фреймов.
+    Xing/VBRI фрейм не переносится. index можно передать готовый (см. Mp3IndexCache).
+    """
+    index = index or index_mp3(data)
+    if not index:
+        return None
+
+    first: int = int(start * index.sample_rate) // index.samples_per_frame
+    last: int = min(len(index.offsets), -(-int(end * index.sample_rate) // index.samples_per_frame))
+    if first >= last:
+        return None
+
+    end_pos: int = index.offsets[last] if last < len(index.offsets) else index.audio_end
+    return [bytes(data[:index.tag_end]), memoryview(data)[index.offsets[first]:end_pos]]
+
+
+class Mp3IndexCache:
+    """LRU индексов MP3 по file_unique_id: повторная обрезка того же файла не проходит его заново."""
+    def __init__(self, size: int = MP3_INDEX_CACHE_SIZE):
+        self.size: int = size
+        self._indexes: 'OrderedDict[str, Mp3FrameIndex]' = OrderedDict()
+
+    def get(self, file_id: Optional[str]) -> Optional[Mp3FrameIndex]:
+        index: Optional[Mp3FrameIndex] = self._indexes.get(file_id) if file_id else None
+        if index:
+            self._indexes.move_to_end(file_id)
+        return index
+
+    def put(self, file_id: Optional[str], index: Optional[Mp3FrameIndex]):
+        if not file_id or not index:
+            return
+        self._indexes[file_id] = index
+        while len(self._indexes) > self.size:
+            self._indexes.popitem(last=False)
+
+
+mp3_index_cache: Mp3IndexCache = Mp3IndexCache()
+
+native_croppers: dict = {
+    '.wav': crop_wav,
+    '.flac': crop_flac,
+    '.mp3': crop_mp3,
+}
+
+
+def native_crop(data: bytes, suffix: str, time_range: Tuple[int, int]) -> Optional[CropResult]:
+    """Обрезка без ffmpeg, если формат это позволяет. None - формат не поддерживается или файл не разобран."""
+    cropper = native_croppers.get(suffix)
+    if not cropper or not isinstance(data, (bytes, bytearray)):
+        return None
+    try:
+        return cropper(data, *time_range)
+    except (IndexError, ValueError, struct.error):
+        return None
@@ -1,19 +1,32 @@
-from dataclasses import asdict
+from contextvars import ContextVar, Token
+from functools import partial
 import logging
 from logging import Logger
-import pickle
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 from aioredis.commands import Redis
 
-from app.actions_dict import actions
-from app.config import DEBUGLEVEL, OPERATION_LOCK_TIMEOUT, SIZE_1MB, USAGE_INFO
+from app.actions_dict import action_buttons, actions
+from app.cache import ResultCache
+from app.config import (
+    ACTION_CPU_WEIGHTS,
+    DEBUGLEVEL,
+    SIZE_1MB,
+    SPLIT_VOICE_MAX_DURATION,
+    STREAM_UPLOADS,
+    USAGE_INFO,
+)
 from app.exceptions.base import (
     ParametersValidationError,
     RoutingError,
     SoundHoundError,
 )
-from app.mediahandler import AudioHandler, VideoHandler
+from app.exceptions.tg_api import FileError, TGApiError
+from app.executor import blocking_executor
+from app.lease import UserLease
+from app.mediahandler import AudioHandler, FileContent, VideoHandler
+from app.metrics import metrics
+from app.scheduler import cpu_scheduler
 from app.serializers.telegram import (
     Animation,
     Audio,
@@ -22,13 +35,17 @@ from app.serializers.telegram import (
     Video,
     Voice,
 )
-from app.serializers.user_state import UserStateModel, UserStateSchema
-from app.tg_api import TelegramAPI
+from app.serializers.user_state import UserStateModel
+from app.state import StateSession
+from app.tg_api import LocalFileStream, TelegramAPI
 from app.utils import is_start_message, resize_thumbnail
 
 log: Logger = logging.getLogger(__name__)
 logging.basicConfig(level=DEBUGLEVEL)
 
+# Список, куда _reply складывает ответы вместо отправки. Выставляется только внутри dispatch_inline.
+inline_outbox: ContextVar[Optional[List[dict]]] = ContextVar('inline_outbox', default=None)
+
 
 class Dispatcher:
     def __init__(self, redis_conn, bot_api, client_session):
@@ -37,13 +54,20 @@ class Dispatcher:
         self.client_session = client_session
         self.audio = AudioHandler()
         self.video = VideoHandler()
+        self.cache = ResultCache(redis_conn)
+        self.lease = UserLease(redis_conn)
 
-    async def dispatch(self, user_id: int, update: dict):
-        with await self.redis as redis_conn:
-            # Потому что у aioredis нет lock
-            await redis_conn.set(f'{user_id}-lock', '1', expire=OPERATION_LOCK_TIMEOUT)
+    async def dispatch(self, user_id: int, update: dict, lease_token: str):
+        """
+        Выполняет update пользователя под уже захваченным в webhook lease (см. app/lease.py).
+        Пока идет обработка, lease продлевается heartbeat'ом.
+        Стейт читается и пишется через StateSession: все изменения стейта и освобождение lease
+        уходят в redis одной транзакцией в конце.
+        """
+        session: StateSession = StateSession(self.redis, user_id)
+        async with self.lease.heartbeat(user_id, lease_token):
             try:
-                await self._dispatch(user_id, update)
+                await self._dispatch(user_id, update, session)
             except SoundHoundError as exc:
                 log.error('Internal exception caught')
                 await self._handle_error(user_id, exc)
@@ -51,33 +75,53 @@ class Dispatcher:
                 log.error('Generic exception caught')
                 await self._handle_error(user_id, exc)
             finally:
-                await redis_conn.delete(f'{user_id}-lock')
+                await session.flush(self.lease, lease_token)
                 log.debug(f'Message from user {user_id} handled')
-                log.debug(await self._get_state(user_id))
 
-    async def initiate_task(self, user_id):
+    async def dispatch_inline(self, user_id: int, update: dict, lease_token: str) -> List[dict]:
+        """
+        Выполняет dispatch, не отправляя текстовые ответы, а собирая их параметры sendMessage в список.
+        Webhook может вернуть единственный ответ прямо в теле HTTP ответа Telegram'у, без отдельного запроса к API.
+        Только для update без файлов: вся работа тут - redis и формирование текста.
+        """
+        outbox: List[dict] = []
+        token: Token = inline_outbox.set(outbox)
+        try:
+            await self.dispatch(user_id, update, lease_token)
+        finally:
+            inline_outbox.reset(token)
+        return outbox
+
+    async def _reply(self, user_id: int, message: str, buttons: Optional[Sequence[Tuple[str, str]]] = None):
+        """Текстовый ответ пользователю: в outbox при dispatch_inline, иначе сразу через Telegram API."""
+        outbox: Optional[List[dict]] = inline_outbox.get()
+        if outbox is not None:
+            outbox.append(self.tg_api.message_params(user_id, message, buttons))
+            return
+        await self.tg_api.send_message(user_id, message, buttons)
+
+    async def initiate_task(self, user_id: int, session: StateSession):
         await self._send_action_list(user_id)
-        user_state = UserStateModel(id=user_id, actions_sent=True)
-        await self._save_state(user_id, user_state)
+        session.set(UserStateModel(id=user_id, actions_sent=True))
 
-    async def _dispatch(self, user_id: int, update: dict):
+    async def _dispatch(self, user_id: int, update: dict, session: StateSession):
         """Роутинг мессаджей юзера происходит тут."""
         message = update.get('message')
         if message:
             if is_start_message(update):
                 log.debug(f'User {user_id} sent /start. Reset his task.')
-                await self._clean_state(user_id)
-                await self.initiate_task(user_id)
+                session.clear()
+                await self.initiate_task(user_id, session)
                 return
             if message.get('text') == '/info':
-                await self.tg_api.send_message(user_id, USAGE_INFO)
+                await self._reply(user_id, USAGE_INFO)
                 return
 
         user_state: UserStateModel
-        user_state = await self._get_state(user_id)
+        user_state = await session.get()
 
         if not user_state:
-            await self.initiate_task(user_id)
+            await self.initiate_task(user_id, session)
             return
 
         if not user_state.actions_sent:
@@ -87,16 +131,15 @@ class Dispatcher:
             file: bytes
             file_meta: dict
             action: str = user_state.action
-            valid_time_range: Tuple[int, int]
 
             # Если в любом месте начатого диалога нажали кнопку из стартового меню: начать кликнутый таск заново.
             if update.get('callback_query'):
                 callback = update['callback_query'].get('data')
                 if callback in [action for action in actions.action_map]:
-                    await self._clean_state(user_id)
-                    user_state.action = callback
-                    await self._save_state(user_id, user_state)
-                    await self.tg_api.send_message(user_id, f'Restarted: {actions.action_map[callback].title}')
+                    session.clear()
+                    user_state = UserStateModel(id=user_id, action=callback, actions_sent=True)
+                    session.set(user_state)
+                    await self._reply(user_id, f'Restarted: {actions.action_map[callback].title}')
                     await self._ask_action_parameters(user_id, callback)
                     return
 
@@ -107,33 +150,24 @@ class Dispatcher:
                         time_range,
                         allow_empty=True if action == 'makevoice' else False,
                     )
-                    await self._save_state(user_id, user_state)
-                    await self.tg_api.send_message(user_id, 'Time range set, send audio file, please.')
+                    session.set(user_state)
+                    await self._reply(user_id, 'Time range set, send audio file, please.')
                 else:
+                    # Ключ кэша не зависит от длительности файла: preflight нужен только при промахе кэша.
                     audio_meta: dict = self._get_tg_object(update, 'audio')
-                    log.info(f'Pre audio file meta: {audio_meta}')
-                    valid_time_range = self._validate_file_duration(
-                        audio_meta.get('duration'),
-                        user_state.time_range,
-                        600,
+                    await self._send_cached_or_process(
+                        user_id,
+                        self.cache.make_key(audio_meta, action, user_state.time_range),
+                        partial(self._process_audio_range, user_id, audio_meta, action, user_state.time_range),
                     )
-                    audio_meta['duration'] = self._get_new_file_duration(valid_time_range)
-
-                    file, file_meta = await self.tg_api.download_file(audio_meta, 'audio')
-                    audio_meta['suffix'] = file_meta['suffix']
-
-                    mod_file: bytes = await self.audio.handle_file(
-                        file,
-                        audio_meta,
-                        action,
-                        valid_time_range,
-                    )
-
-                    as_voice: bool = True if action == 'makevoice' else False
-                    await self.tg_api.upload_file(user_id, mod_file, audio_meta, as_voice)
-                    await self.tg_api.send_message(user_id, 'Send next audio file or /start to start new action.')
+                    await self._reply(user_id, 'Send next audio file or /start to start new action.')
+            if action == 'splitvoice':
+                audio_meta: dict = await self._preflight(self._get_tg_object(update, 'audio'), 'audio')
+                self._validate_split_duration(audio_meta.get('duration'))
+                await self._process_split_voice(user_id, audio_meta)
+                await self._reply(user_id, 'Send next audio file or /start to start new action.')
             if action in ('thumbnail', 'setcover'):
-                if not user_state.thumbnail_file:
+                if not user_state.has_blob('thumbnail_file'):
                     photo_meta: dict = self._get_tg_object(update, 'photo')
 
                     if not 0 < photo_meta['file_size'] < SIZE_1MB:
@@ -141,11 +175,17 @@ class Dispatcher:
 
                     file, meta = await self.tg_api.download_file(photo_meta, 'photo')
                     user_state.thumbnail_file = file
-                    user_state.tg_thumbnail_file = resize_thumbnail(file, photo_meta['width'], photo_meta['height'])
-                    await self._save_state(user_id, user_state)
-                    await self.tg_api.send_message(user_id, 'Got thumbnail, send audio file, please.')
+                    user_state.tg_thumbnail_file = await blocking_executor.run(
+                        'resize_thumbnail', resize_thumbnail, file, photo_meta['width'], photo_meta['height'],
+                    )
+                    session.set(user_state)
+                    await self._reply(user_id, 'Got thumbnail, send audio file, please.')
                 else:
                     audio_meta: dict = self._get_tg_object(update, 'audio')
+                    await session.load_blobs(
+                        user_state,
+                        ('thumbnail_file', 'tg_thumbnail_file') if action == 'setcover' else ('tg_thumbnail_file',),
+                    )
 
                     file, file_meta = await self.tg_api.download_file(audio_meta, 'audio')
                     if action == 'setcover':
@@ -157,43 +197,30 @@ class Dispatcher:
                             user_state.thumbnail_file,
                         )
                     await self.tg_api.upload_file(user_id, file, audio_meta, False, user_state.tg_thumbnail_file)
-                    await self.tg_api.send_message(user_id, 'Send next audio file or /start to start new action.')
+                    await self._reply(user_id, 'Send next audio file or /start to start new action.')
             if action == 'makeopus':
                 audio_meta: dict = self._get_tg_object(update, 'audio')
-                file, file_meta = await self.tg_api.download_file(audio_meta, 'audio')
-                audio_meta['suffix'] = file_meta['suffix']
-                opus_file: bytes = await self.audio.handle_file(file, audio_meta, action, user_state.time_range)
-                audio_meta['mime_type'] = 'audio/x-opus+ogg'
-                audio_meta['suffix'] = '.oga'
-                await self.tg_api.upload_file(user_id, opus_file, audio_meta, False)
-                await self.tg_api.send_message(user_id, 'Send next audio file or /start to start new action.')
+                await self._send_cached_or_process(
+                    user_id,
+                    self.cache.make_key(audio_meta, action, user_state.time_range),
+                    partial(self._process_audio, user_id, audio_meta, action, user_state.time_range),
+                )
+                await self._reply(user_id, 'Send next audio file or /start to start new action.')
             if action == 'makerounded':
                 if not user_state.time_range:
                     time_range: str = self._get_tg_object(update, 'text')
                     user_state.time_range = self._validate_time_range(time_range, True, 60)
-                    await self._save_state(user_id, user_state)
-                    await self.tg_api.send_message(user_id, 'Time range set, send video file, please.')
+                    session.set(user_state)
+                    await self._reply(user_id, 'Time range set, send video file, please.')
                 else:
+                    # Как и для аудио, preflight и проверка длительности - внутри _process_video, после промаха кэша.
                     video_meta: dict = self._get_tg_object(update, 'video')
-                    log.info(f'Pre meta: {video_meta}')
-                    # Проверим соответствие time_range и file duration если telegram уже знает о duration файла.
-                    if video_meta.get('duration'):
-                        _ = self._validate_file_duration(
-                            video_meta['duration'],
-                            user_state.time_range,
-                            60,
-                        )
-                    file, file_meta = await self.tg_api.download_file(video_meta, 'video')
-                    video_meta['suffix'] = file_meta['suffix']
-
-                    video_meta = await self._collect_video_meta(video_meta, file)
-                    valid_time_range = self._validate_file_duration(video_meta['duration'], user_state.time_range, 60)
-
-                    new_duration = self._get_new_file_duration(valid_time_range)
-                    rounded_video, radius = await self.video.make_rounded(file, video_meta, valid_time_range)
-
-                    await self.tg_api.upload_roundy(user_id, rounded_video, new_duration, radius)
-                    await self.tg_api.send_message(user_id, 'Send next video file or /start to start new action.')
+                    await self._send_cached_or_process(
+                        user_id,
+                        self.cache.make_key(video_meta, action, user_state.time_range),
+                        partial(self._process_video, user_id, video_meta, user_state.time_range),
+                    )
+                    await self._reply(user_id, 'Send next video file or /start to start new action.')
 
         else:
             callback_query: dict = update.get('callback_query')
@@ -205,10 +232,162 @@ class Dispatcher:
                 raise RoutingError('Unable to parse button press.', update)
 
             user_state.action = new_action
-            await self._save_state(user_id, user_state)
+            session.set(user_state)
             await self._ask_action_parameters(user_id, new_action)
 
-    async def _collect_video_meta(self, video_meta: dict, content: bytes):
+    async def _send_cached_or_process(
+            self,
+            user_id: int,
+            cache_key: Optional[str],
+            process: Callable[[], Awaitable[dict]],
+    ):
+        """
+        Если результат для cache_key уже есть (или появится, пока ждем такой же запрос) - пересылает его по file_id.
+        Иначе вызывает process (скачать, обработать, загрузить) и кэширует file_id отправленного файла.
+        Если Telegram не принял закэшированный file_id, результат удаляется из кэша и файл обрабатывается заново.
+        """
+        cached: Optional[dict]
+        owned: bool
+        cached, owned = await self.cache.acquire(cache_key)
+        if cached:
+            try:
+                await self.tg_api.send_cached_file(user_id, cached)
+                return
+            except TGApiError as exc:
+                if not isinstance(exc.extra, dict) or exc.extra.get('error_code') != 400:
+                    raise
+                log.warning(f'Cached result {cache_key} is rejected by Telegram, processing again.')
+                metrics.incr('result_cache.stale')
+                await self.cache.invalidate(cache_key)
+                cached, owned = await self.cache.acquire(cache_key)
+                if cached:
+                    await self.tg_api.send_cached_file(user_id, cached)
+                    return
+
+        try:
+            message: dict = await process()
+            await self.cache.store(cache_key, self.tg_api.resend_descriptor(message))
+        finally:
+            await self.cache.release(cache_key, owned)
+
+    async def _process_audio(
+            self,
+            user_id: int,
+            audio_meta: dict,
+            action: str,
+            time_range: Optional[Tuple[int, int]],
+    ) -> dict:
+        """Скачивает аудио, обрабатывает его согласно action и отправляет результат. Возвращает отправленный Message."""
+        resolved: Tuple[dict, str] = await self.tg_api.resolve_file(audio_meta, 'audio')
+        audio_meta['suffix'] = resolved[0]['suffix']
+        # Если формат позволяет, ffmpeg кодирует файл параллельно с его скачиванием.
+        # Файл локального Bot API сервера ffmpeg читает прямо с диска, не загружая его в память.
+        streamed: bool = self.audio.can_stream(
+            action, audio_meta['suffix'], audio_meta.get('duration'), self.tg_api.is_local_path(resolved[1]),
+        )
+        weight: int = ACTION_CPU_WEIGHTS[action]
+
+        # Бюджет CPU для ffmpeg, который читает скачивание или пишет в тело загрузки, занимается до открытия
+        # HTTP запроса: иначе ожидание в очереди cpu_scheduler идет при открытом соединении.
+        async with cpu_scheduler.reserve(weight if streamed else 0):
+            async with self.tg_api.stream_file(audio_meta, 'audio', resolved) as stream:
+                file: FileContent = stream if streamed else await stream.read()
+                async with cpu_scheduler.reserve(weight if STREAM_UPLOADS else 0):
+                    mod_file: FileContent = await self.audio.handle_file(
+                        file,
+                        audio_meta,
+                        action,
+                        time_range,
+                        stream_output=STREAM_UPLOADS,
+                    )
+
+                    if action == 'makeopus':
+                        audio_meta['mime_type'] = 'audio/x-opus+ogg'
+                        audio_meta['suffix'] = '.oga'
+
+                    # При STREAM_UPLOADS загрузка идет одновременно с кодированием, поэтому еще внутри скачивания.
+                    as_voice: bool = True if action == 'makevoice' else False
+                    return await self.tg_api.upload_file(user_id, mod_file, audio_meta, as_voice)
+
+    async def _process_audio_range(
+            self,
+            user_id: int,
+            audio_meta: dict,
+            action: str,
+            time_range: Tuple[int, int],
+    ) -> dict:
+        """
+        crop и makevoice: preflight файла и проверка time_range по его длительности, затем _process_audio.
+        Вызывается только при промахе кэша результатов, поэтому повторный запрос не качает начало файла.
+        """
+        audio_meta = await self._preflight(audio_meta, 'audio')
+        log.info(f'Pre audio file meta: {audio_meta}')
+        if not audio_meta.get('duration'):
+            # Без длительности time_range не проверить, а (0, 0) не во что развернуть.
+            raise FileError('Unable to get audio duration.', audio_meta)
+        valid_time_range: Tuple[int, int] = self._validate_file_duration(audio_meta.get('duration'), time_range, 600)
+        audio_meta['duration'] = self._get_new_file_duration(valid_time_range)
+        return await self._process_audio(user_id, audio_meta, action, valid_time_range)
+
+    async def _process_split_voice(self, user_id: int, audio_meta: dict):
+        """
+        Скачивает аудио и отправляет его серией голосовых сообщений по порядку (см. AudioHandler.split_voice).
+        Каждый кусок отправляется, как только он готов и отправлены предыдущие, остальные в это время кодируются.
+        Результат не кэшируется: это не одно сообщение.
+        """
+        file, file_meta = await self.tg_api.download_file(audio_meta, 'audio')
+        audio_meta['suffix'] = file_meta['suffix']
+        # Длительность по preflight могла быть оценкой по битрейту: для нарезки нужна точная, по всему файлу.
+        meta: Optional[Dict[str, Any]] = self.audio.get_audio_meta(file)
+        duration: Optional[int] = meta and meta['duration'] or audio_meta.get('duration')
+        if not duration:
+            duration = (await self.audio.probe(file, len(file))).get('duration')
+        if not duration:
+            raise FileError('Unable to get audio duration.', audio_meta)
+        self._validate_split_duration(duration)
+        audio_meta['duration'] = duration
+
+        chunks: AsyncIterator[Tuple[bytes, Tuple[int, int]]] = self.audio.split_voice(
+            file, audio_meta, audio_meta['duration'],
+        )
+        try:
+            async for chunk, time_range in chunks:
+                chunk_meta: dict = {**audio_meta, 'duration': self._get_new_file_duration(time_range)}
+                await self.tg_api.upload_file(user_id, chunk, chunk_meta, True)
+        finally:
+            # Если отправка упала, куски, которые еще кодируются, отменяются сразу, а не при сборке мусора.
+            await chunks.aclose()
+
+    async def _process_video(self, user_id: int, video_meta: dict, time_range: Tuple[int, int]) -> dict:
+        """
+        Скачивает видео, делает из него VideoNote и отправляет. Возвращает отправленный Message.
+        Сначала preflight: если длительность известна по началу файла, неверный time_range отвергается до скачивания.
+        """
+        video_meta = await self._preflight(video_meta, 'video')
+        log.info(f'Pre meta: {video_meta}')
+        if video_meta.get('duration'):
+            self._validate_file_duration(video_meta['duration'], time_range, 60)
+
+        # Файл локального Bot API сервера ffprobe и ffmpeg читают по пути, без загрузки в память.
+        file: FileContent
+        file_meta: dict
+        local: Optional[LocalFileStream] = await self.tg_api.local_file(video_meta, 'video')
+        if local:
+            file, file_meta = local, local.meta
+        else:
+            file, file_meta = await self.tg_api.download_file(video_meta, 'video')
+        video_meta['suffix'] = file_meta['suffix']
+
+        video_meta = await self._collect_video_meta(video_meta, file)
+        valid_time_range = self._validate_file_duration(video_meta['duration'], time_range, 60)
+
+        new_duration = self._get_new_file_duration(valid_time_range)
+        # При STREAM_UPLOADS ffmpeg пишет в тело загрузки: бюджет CPU нужен до открытия запроса.
+        async with cpu_scheduler.reserve(ACTION_CPU_WEIGHTS['makerounded'] if STREAM_UPLOADS else 0):
+            rounded_video, radius = await self.video.make_rounded(file, video_meta, valid_time_range, STREAM_UPLOADS)
+            return await self.tg_api.upload_roundy(user_id, rounded_video, new_duration, radius)
+
+    async def _collect_video_meta(self, video_meta: dict, content: FileContent):
         """Если в meta для video не все параметры - получает их через ffprobe и дополняет meta."""
         height: int = video_meta.get('height', 0)
         width: int = video_meta.get('width', 0)
@@ -222,45 +401,51 @@ class Dispatcher:
 
         return video_meta
 
+    async def _preflight(self, meta: dict, file_type: str) -> dict:
+        """
+        Если Telegram не знает duration файла (Document), скачивает только начало файла и проверяет его ffprobe:
+        нужный поток есть, длительность и размеры видео известны. Так неверный range или неподдерживаемый файл
+        отвергаются до полного скачивания. Дополняет meta найденными полями.
+        Если по началу файла ничего понять нельзя (например moov в конце mp4), meta возвращается как есть.
+        """
+        if meta.get('duration'):
+            return meta
+
+        prefix: bytes
+        prefix, file_meta = await self.tg_api.download_prefix(meta, file_type)
+        handler: Union[AudioHandler, VideoHandler] = self.video if file_type == 'video' else self.audio
+        try:
+            probe: Dict[str, Any] = await handler.probe(prefix, meta['file_size'])
+        except SoundHoundError as exc:
+            log.info(f'Preflight probe is inconclusive: {exc.err_msg}')
+            metrics.incr('preflight.inconclusive')
+            return meta
+
+        if not probe['has_audio' if file_type == 'audio' else 'has_video']:
+            metrics.incr('preflight.rejected')
+            raise FileError(f'File has no {file_type} stream.', {'codec_name': probe['codec_name'], **meta})
+
+        if probe['duration']:
+            # Оценка по битрейту может немного ошибаться: лучше пропустить range чуть длиннее файла, ffmpeg его обрежет.
+            slack: int = max(1, probe['duration'] // 50) if probe['duration_estimated'] else 0
+            meta['duration'] = probe['duration'] + slack
+        for field in ('width', 'height'):
+            if probe.get(field) and not meta.get(field):
+                meta[field] = probe[field]
+        metrics.incr('preflight.probed')
+        return meta
+
     async def _send_action_list(self, user_id: int):
         """Начало диалога с юзером. Выслать action list-клавиатуру."""
-        buttons: List[Tuple[str]] = [(action_name, action.title) for action_name, action in actions.action_map.items()]
-        await self.tg_api.send_message(user_id, 'Please select an action', buttons)
+        await self._reply(user_id, 'Please select an action', action_buttons)
         log.debug(f'Action list sent to {user_id}')
 
     async def _ask_action_parameters(self, user_id, action: str):
         """Второй шаг диалога с юзером. Запрос параметров после выбора действия."""
         action_message = actions.action_map[action].message
-        await self.tg_api.send_message(user_id, action_message)
+        await self._reply(user_id, action_message)
         log.debug(f'Parameters asked for {user_id}')
 
-    async def _get_state(self, user_id: int) -> UserStateModel:
-        """
-        Получаем стейт юзера по его id из redis в виде байт.
-        Десериализуем pickle. Затем сериализуем в python объект через сериализатор Marshmallow,
-        затем в объект модели UserStateModel.
-        """
-        with await self.redis as redis_conn:
-            binary_data: Optional[bytes] = await redis_conn.get(f'{user_id}-state')
-            if not binary_data:
-                return None
-
-            return UserStateModel(**UserStateSchema().load(pickle.loads(binary_data)))
-
-    async def _save_state(self, user_id: int, user_state: UserStateModel):
-        """
-        Входящая модель UserStateModel (dataclass объект) хранит разные поля, в том числе байтовые.
-        Проверяем верность модели сериализуя ее с помощью UserStateSchema в питонный объект.
-        В байты, для хранения в redis, сериализуем с помощью pickle, т.к. в JSON нельзя из-за байт.
-        """
-        with await self.redis as redis_conn:
-            await redis_conn.set(f'{user_id}-state', pickle.dumps(UserStateSchema().load(asdict(user_state))))
-
-    async def _clean_state(self, user_id: int):
-        with await self.redis as redis_conn:
-            await redis_conn.delete(f'{user_id}-state')
-        log.debug(f'State for {user_id} is cleaned.')
-
     def _get_tg_object(self, update: Dict[str, Any], obj_type: str) -> Union[dict, str]:
         """
         Получает и валидирует объект text, photo, audio/voice/document или video/animation/document.
@@ -368,6 +553,15 @@ class Dispatcher:
 
         return start_sec, end_sec
 
+    @staticmethod
+    def _validate_split_duration(duration: Optional[int]):
+        """Длительность неизвестна до скачивания - проверится после него. Известная - не больше лимита."""
+        if duration and duration > SPLIT_VOICE_MAX_DURATION:
+            raise ParametersValidationError(
+                f'File is too long. Maximum is {SPLIT_VOICE_MAX_DURATION // 60} minutes.',
+                {'duration': duration},
+            )
+
     @staticmethod
     def _validate_file_duration(file_duration: int, time_range: Tuple[int, int], limit: int) -> Tuple[int, int]:
         """
@@ -410,8 +604,8 @@ class Dispatcher:
         if isinstance(exc, SoundHoundError):
             log.error(f'Error happened: {exc}, {exc.err_msg}, extra: {exc.extra}. Original exception:{exc.orig_exc}.')
             log.debug(f'Gonna send error to {user_id}.')
-            await self.tg_api.send_message(user_id, exc.err_msg)
+            await self._reply(user_id, exc.err_msg)
         elif isinstance(exc, Exception):
             log.exception(f'Generic exception happened: {exc}')
-            await self.tg_api.send_message(user_id, 'Generic error.')
+            await self._reply(user_id, 'Generic error.')
         log.debug('Error sent to user.')
@@ -0,0 +1,86 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import logging
+from logging import Logger
+from multiprocessing import current_process
+import time
+from typing import Any, Callable, Optional, Tuple
+
+from app.config import BLOCKING_EXECUTOR, BLOCKING_WORKERS, DEBUGLEVEL
+from app.exceptions.base import ConfigurationError
+from app.metrics import metrics
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+def _timed(func: Callable, *args: Any) -> Tuple[Any, float]:
+    """Выполняется в пуле: результат и сколько времени функция заняла бы event loop, если бы шла в нем."""
+    started: float = time.perf_counter()
+    result: Any = func(*args)
+    return result, time.perf_counter() - started
+
+
+class BlockingExecutor:
+    """
+    Process-wide пул для блокирующей CPU работы, которой не место в event loop: PIL, mutagen.
+    kind: 'thread' или 'process'. Для 'process' функция и аргументы должны пикклиться
+    (функции модуля и staticmethod'ы подходят). Одновременно выполняется не больше workers задач,
+    остальные ждут на семафоре, не занимая очередь пула.
+    Метрики: executor.<name> - сколько задача блокировала бы loop, executor.wait - ожидание свободного места в пуле.
+    """
+    kinds: Tuple[str] = ('thread', 'process')
+
+    def __init__(self, kind: str, workers: int):
+        if kind not in self.kinds:
+            raise ConfigurationError('invalid_blocking_executor', {'kinds': self.kinds})
+        self.kind: str = kind
+        self.workers: int = max(1, workers)
+        self._pool: Optional[Executor] = None
+        # Семафор создается при первом вызове: в python 3.8 он привязывается к текущему event loop.
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._running: int = 0
+
+        metrics.gauge('executor.running', lambda: self._running)
+
+    def _get_pool(self) -> Executor:
+        if not self._pool:
+            kind: str = self.kind
+            if kind == 'process' and current_process().daemon:
+                # Процессы пула media-воркеров - daemon, а им нельзя запускать дочерние процессы.
+                log.warning('Process pool is not available in a daemon process, using threads.')
+                kind = 'thread'
+            pool_class = ProcessPoolExecutor if kind == 'process' else ThreadPoolExecutor
+            self._pool = pool_class(max_workers=self.workers)
+        return self._pool
+
+    async def run(self, name: str, func: Callable, *args: Any) -> Any:
+        if not self._semaphore:
+            self._semaphore = asyncio.Semaphore(self.workers)
+
+        queued: float = time.monotonic()
+        async with self._semaphore:
+            metrics.timing('executor.wait').observe(time.monotonic() - queued)
+            self._running += 1
+            try:
+                result: Any
+                elapsed: float
+                result, elapsed = await asyncio.get_event_loop().run_in_executor(
+                    self._get_pool(), partial(_timed, func, *args),
+                )
+            finally:
+                self._running -= 1
+
+        metrics.timing(f'executor.{name}').observe(elapsed)
+        return result
+
+    async def shutdown(self, *_):
+        """Дожидается задач в работе и останавливает пул. Ожидание идет в default пуле, а не в event loop."""
+        if self._pool:
+            await asyncio.get_event_loop().run_in_executor(None, partial(self._pool.shutdown, wait=True))
+            self._pool = None
+            log.debug('Blocking executor is stopped')
+
+
+blocking_executor: BlockingExecutor = BlockingExecutor(BLOCKING_EXECUTOR, BLOCKING_WORKERS)
@@ -0,0 +1,70 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import logging
+from logging import Logger
+import pickle
+from typing import Optional, Tuple
+
+from aioredis.commands import Redis
+
+from app.config import DEBUGLEVEL, JOB_QUEUE_KEY
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+# Семафор слотов потребителей media-воркера, которому принадлежит текущий джоб (см. app/worker.py).
+consumer_slots: ContextVar[Optional[asyncio.Semaphore]] = ContextVar('consumer_slots', default=None)
+
+
+@asynccontextmanager
+async def consumer_slot_released():
+    """
+    Отдает слот текущего джоба другому джобу из очереди на время тела контекста, например, пока джоб ждет
+    чужой результат (см. ResultCache). После тела слот забирается обратно, при необходимости с ожиданием.
+    Вне media-воркера ничего не делает.
+    """
+    slots: Optional[asyncio.Semaphore] = consumer_slots.get()
+    if not slots:
+        yield
+        return
+
+    slots.release()
+    try:
+        yield
+    finally:
+        await slots.acquire()
+
+
+class JobQueue:
+    """
+    Очередь джобов для media-воркеров поверх redis list.
+    Webhook кладет в нее user_id, уже сериализованный update и токен lease пользователя,
+    воркеры (app/worker.py) забирают их через BLPOP.
+    Update хранится в pickle, т.к. после Marshmallow в нем есть datetime объекты.
+    """
+    def __init__(self, redis_conn: Redis, key: Optional[str] = JOB_QUEUE_KEY):
+        self.redis: Redis = redis_conn
+        self.key: str = key
+
+    async def push(self, user_id: int, update: dict, lease_token: str) -> int:
+        """Ставит джоб в конец очереди. Возвращает длину очереди после вставки."""
+        job: bytes = pickle.dumps({'user_id': user_id, 'update': update, 'lease_token': lease_token})
+        with await self.redis as redis_conn:
+            depth: int = await redis_conn.rpush(self.key, job)
+        log.debug(f'Job for user {user_id} enqueued. Queue depth: {depth}')
+        return depth
+
+    async def pop(self, timeout: Optional[int] = 5) -> Optional[Tuple[int, dict, str]]:
+        """
+        Блокирующе ждет джоб из начала очереди не дольше timeout секунд.
+        Возвращает (user_id, update, lease_token) или None, если очередь пуста.
+        """
+        with await self.redis as redis_conn:
+            item: Optional[list] = await redis_conn.blpop(self.key, timeout=timeout)
+
+        if not item:
+            return None
+
+        job: dict = pickle.loads(item[1])
+        return job['user_id'], job['update'], job['lease_token']
@@ -0,0 +1,104 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+from logging import Logger
+from typing import Optional
+from uuid import uuid4
+
+from aioredis.commands import MultiExec, Redis
+
+from app.config import DEBUGLEVEL, LEASE_HEARTBEAT_INTERVAL, OPERATION_LOCK_TIMEOUT
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+class UserLease:
+    """
+    Per-user lease в redis вместо EXISTS + SET.
+    Захват - один атомарный SET NX EX со случайным токеном владельца, который делает webhook до запуска джоба.
+    Продление и освобождение - Lua скрипты, которые срабатывают только для владельца токена:
+    если lease перехватили (/start, или он истек), старый джоб его уже не продлит и не снимет.
+    """
+    renew_script: str = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end"
+    )
+    release_script: str = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+
+    def __init__(
+            self,
+            redis_conn: Redis,
+            ttl: Optional[int] = OPERATION_LOCK_TIMEOUT,
+            heartbeat_interval: Optional[int] = LEASE_HEARTBEAT_INTERVAL,
+    ):
+        self.redis: Redis = redis_conn
+        self.ttl: int = ttl
+        self.heartbeat_interval: int = heartbeat_interval
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f'{user_id}-lock'
+
+    async def acquire(self, user_id: int) -> Optional[str]:
+        """Возвращает токен владельца или None, если у пользователя уже идет операция."""
+        token: str = uuid4().hex
+        with await self.redis as redis_conn:
+            acquired: bool = await redis_conn.set(
+                self.key(user_id), token, expire=self.ttl, exist=redis_conn.SET_IF_NOT_EXIST,
+            )
+        return token if acquired else None
+
+    async def force_acquire(self, user_id: int) -> str:
+        """Захватывает lease безусловно. Для /start и /reset: текущий владелец теряет lease."""
+        token: str = uuid4().hex
+        with await self.redis as redis_conn:
+            await redis_conn.set(self.key(user_id), token, expire=self.ttl)
+        return token
+
+    async def renew(self, user_id: int, token: str) -> bool:
+        with await self.redis as redis_conn:
+            renewed: int = await redis_conn.eval(self.renew_script, keys=[self.key(user_id)], args=[token, self.ttl])
+        return bool(renewed)
+
+    async def release(self, user_id: int, token: str) -> bool:
+        with await self.redis as redis_conn:
+            released: int = await redis_conn.eval(self.release_script, keys=[self.key(user_id)], args=[token])
+        if not released:
+            log.warning(f'Lease for user {user_id} was already lost, nothing to release.')
+        return bool(released)
+
+    async def watch(self, redis_conn: Redis, user_id: int, token: str) -> bool:
+        """
+        WATCH на ключ lease и проверка владельца на выделенном соединении redis_conn.
+        True - lease наш, и следующая транзакция на этом соединении выполнится, только если его никто не перехватит
+        до EXEC. False - lease уже потерян, WATCH снят.
+        """
+        await redis_conn.watch(self.key(user_id))
+        if await redis_conn.get(self.key(user_id), encoding='utf-8') == token:
+            return True
+        await redis_conn.unwatch()
+        return False
+
+    def release_in(self, transaction: MultiExec, user_id: int):
+        """Добавляет снятие lease в транзакцию, открытую после успешного watch (см. StateSession.flush)."""
+        transaction.delete(self.key(user_id))
+
+    async def _heartbeat(self, user_id: int, token: str):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not await self.renew(user_id, token):
+                log.warning(f'Lease for user {user_id} lost during operation, heartbeat stopped.')
+                return
+
+    @asynccontextmanager
+    async def heartbeat(self, user_id: int, token: str):
+        """Продлевает lease каждые heartbeat_interval секунд, пока выполняется тело контекста."""
+        task: asyncio.Task = asyncio.ensure_future(self._heartbeat(user_id, token))
+        try:
+            yield
+        finally:
+            task.cancel()
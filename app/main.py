@@ -3,16 +3,21 @@ import logging
 import sys
 from logging import Logger
 
-from aiohttp import ClientSession
 from aiohttp.web import Application, AppRunner, TCPSite
 from aiojobs.aiohttp import setup
 import aioredis
 from aioredis.commands import Redis
 
-from app.config import DEBUGLEVEL
+from app.cache import FileMetaCache
+from app.config import DEBUGLEVEL, REDIS_ADDRESS
 from app.dispatcher import Dispatcher
 from app.exceptions.base import SoundHoundError
-from app.tg_api import TelegramAPI
+from app.executor import blocking_executor
+from app.jobs import JobQueue
+from app.lease import UserLease
+from app.sender import BackgroundSender
+from app.stats import MetricsPublisher, StatsHandler
+from app.tg_api import TelegramAPI, create_api_session, create_file_session
 from app.webhook import WebhookHandler
 
 log: Logger = logging.getLogger(__name__)
@@ -36,25 +41,39 @@ async def close_redis(app):
 
 async def close_client_session(app):
     await app['http_client_session'].close()
+    await app['file_client_session'].close()
     log.debug('Client sessions is closed')
 
 
 async def http_app_factory() -> Application:
     """Создает, настраивает и возвращает Application-объект для запуска в контейнере через gunicorn."""
     redis_pool: Redis = await aioredis.create_redis_pool(
-        ('redis', 6379), db=0,
+        REDIS_ADDRESS, db=0,
     )
     app: Application = Application()
 
     app['redis'] = redis_pool
-    app['http_client_session'] = ClientSession(conn_timeout=180, read_timeout=180, trust_env=True)
-    app['tg_api']: TelegramAPI = TelegramAPI(app['http_client_session'])
+    app['http_client_session'] = create_api_session()
+    app['file_client_session'] = create_file_session()
+    app['tg_api']: TelegramAPI = TelegramAPI(
+        app['http_client_session'], app['file_client_session'], file_meta_cache=FileMetaCache(app['redis']),
+    )
     app['dispatcher'] = Dispatcher(app['redis'], app['tg_api'], app['http_client_session'])
+    app['job_queue'] = JobQueue(app['redis'])
+    app['lease'] = UserLease(app['redis'])
+    app['sender'] = BackgroundSender(app['tg_api'])
+    app['metrics_publisher'] = MetricsPublisher(app['redis'], 'webhook')
 
     app.router.add_route('POST', '/webhook/', WebhookHandler)
+    app.router.add_route('GET', '/stats/', StatsHandler)
     setup(app)
     app.on_startup.append(init_webhook)
+    app.on_startup.append(app['sender'].start)
+    app.on_startup.append(app['metrics_publisher'].start)
+    app.on_cleanup.append(app['sender'].stop)
     app.on_cleanup.append(close_client_session)
+    app.on_cleanup.append(blocking_executor.shutdown)
+    app.on_shutdown.append(app['metrics_publisher'].stop)
     app.on_shutdown.append(close_redis)
 
     return app
@@ -0,0 +1,82 @@
+"""
+Служебные команды. Запуск: python -m app.maintenance state-report
+
+state-report: количество ключей стейта и занимаемая ими память redis в разрезе action.
+Нужен для оценки размера инстанса redis. Учитываются и ключи с картинками стейта.
+"""
+import asyncio
+from collections import defaultdict
+import logging
+from logging import Logger
+import sys
+from typing import Dict, Optional
+
+import aioredis
+from aioredis.commands import Redis
+
+from app.config import DEBUGLEVEL, REDIS_ADDRESS
+from app.serializers.user_state import UserStateModel, decode_state
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+async def memory_usage(redis: Redis, key: str) -> int:
+    return await redis.execute('MEMORY', 'USAGE', key) or 0
+
+
+async def state_report(redis: Redis):
+    keys: Dict[str, int] = defaultdict(int)
+    state_bytes: Dict[str, int] = defaultdict(int)
+    blob_bytes: Dict[str, int] = defaultdict(int)
+    without_ttl: int = 0
+
+    async for key in redis.iscan(match='*-state'):
+        key = key.decode()
+        data: Optional[bytes] = await redis.get(key)
+        if not data:
+            continue
+
+        try:
+            user_state: UserStateModel = decode_state(data)
+            action: str = user_state.action or '<none>'
+        except Exception:
+            user_state = None
+            action = '<undecodable>'
+
+        keys[action] += 1
+        state_bytes[action] += await memory_usage(redis, key)
+        if await redis.ttl(key) == -1:
+            without_ttl += 1
+
+        for name in (user_state.blobs if user_state else ()):
+            blob_bytes[action] += await memory_usage(redis, f'{key}-{name}')
+
+    print(f'{"action":<16}{"states":>10}{"state bytes":>16}{"blob bytes":>16}')
+    for action in sorted(keys):
+        print(f'{action:<16}{keys[action]:>10}{state_bytes[action]:>16}{blob_bytes[action]:>16}')
+    print(
+        f'{"total":<16}{sum(keys.values()):>10}{sum(state_bytes.values()):>16}{sum(blob_bytes.values()):>16}'
+    )
+    print(f'States without TTL: {without_ttl}')
+
+
+commands = {
+    'state-report': state_report,
+}
+
+
+async def main(command: str):
+    redis: Redis = await aioredis.create_redis_pool(REDIS_ADDRESS, db=0)
+    try:
+        await commands[command](redis)
+    finally:
+        redis.close()
+        await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print(f'Usage: python -m app.maintenance {{{"|".join(commands)}}}')
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1]))
@@ -1,31 +1,78 @@
 import asyncio
 from asyncio.subprocess import Process
+from collections import deque
 from io import BytesIO
-import json
 import logging
+import os
+from pathlib import Path
 import shutil
-from tempfile import NamedTemporaryFile
-from typing import Any, Dict, Optional, Tuple, Union
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Deque, Dict, List, NamedTuple, Optional, Tuple, Union
 
-from mutagen import File
+from mutagen import File, FileType
 from mutagen.flac import FLAC, Picture
 from mutagen.id3 import APIC, ID3
 from mutagen.mp4 import MP4, MP4Cover
-
-from app.config import DEBUGLEVEL, VIDEO_NOTE_MAX_RADIUS
+from mutagen.wave import WAVE
+
+from app import codec
+from app.config import (
+    ACTION_CPU_WEIGHTS,
+    DEBUGLEVEL,
+    OPUS_SEGMENT_MIN_DURATION,
+    OPUS_SEGMENTS,
+    SIZE_1MB,
+    SPLIT_VOICE_BITRATE,
+    SPLIT_VOICE_CHUNK_DURATION,
+    SPLIT_VOICE_PARALLEL,
+    STREAM_CHUNK_SIZE,
+    VIDEO_NOTE_MAX_RADIUS,
+)
+from app.crop import (
+    CropResult,
+    Mp3FrameIndex,
+    crop_mp3,
+    index_mp3,
+    mp3_index_cache,
+    native_crop,
+    native_croppers,
+)
 from app.exceptions.audio import (
     AudioHandlerError,
     ExecutableNotFoundError,
     SubprocessError,
 )
-from app.exceptions.base import NotImplementedYetError
+from app.exceptions.base import NotImplementedYetError, SoundHoundError
+from app.executor import blocking_executor
+from app.metrics import metrics
+from app.ogg import OpusStream, opus_packet_samples, parse_opus, write_opus
+from app.scheduler import cpu_scheduler
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=DEBUGLEVEL)
 
+# Содержимое файла: байты целиком или поток чанков, который еще скачивается (см. TelegramAPI.stream_file).
+# Поток файла на диске локального Bot API сервера (tg_api.LocalFileStream) еще и знает свой path:
+# ffmpeg и ffprobe читают такой файл сами, без pipe и без временной копии (см. local_path).
+FileContent = Union[bytes, AsyncIterable[bytes]]
+
+
+def local_path(content: FileContent) -> Optional[str]:
+    """Путь к файлу на диске, если content - файл локального Bot API сервера, иначе None."""
+    return getattr(content, 'path', None)
+
+
+async def iter_pieces(pieces: CropResult) -> AsyncIterator[bytes]:
+    """Отдает куски обрезки в процессе (заголовок и memoryview срезов исходника) потоком, не склеивая их."""
+    for piece in pieces:
+        yield piece
+
 
 class MediaHandler:
     suffix_to_format: dict = {'.m4a': 'adts'}
+    # Форматы, которые ffmpeg может читать из pipe по мере поступления данных. Остальные передаются файлом.
+    pipeable_suffixes: Tuple[str] = ('.mp3', '.ogg', '.oga', '.flac', '.wav')
 
     def __init__(self):
         if not shutil.which('ffmpeg'):
@@ -51,56 +98,190 @@ class MediaHandler:
         return suffix, output_format
 
     @staticmethod
-    async def _run_command(command: str, file_content: bytes, suffix: str, *params: Tuple[str]) -> bytes:
+    async def _feed_stdin(process: Process, content: FileContent):
+        """
+        Пишет в stdin процесса байты или поток чанков по мере их получения, затем закрывает stdin.
+        Если ffmpeg закрыл stdin раньше (например, дошел до -to), остаток входа не пишется.
+        """
+        try:
+            if isinstance(content, (bytes, bytearray)):
+                process.stdin.write(content)
+                await process.stdin.drain()
+            else:
+                async for chunk in content:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug('ffmpeg closed stdin before the end of the input.')
+        finally:
+            process.stdin.close()
+
+    @staticmethod
+    async def _communicate_stream(process: Process, chunks: AsyncIterable[bytes]) -> Tuple[bytes, bytes]:
+        """
+        Аналог process.communicate() для входа-потока: пишет чанки в stdin по мере их получения
+        и одновременно вычитывает stdout/stderr, чтобы ffmpeg не заблокировался на полном pipe.
+        """
+        out, err, _ = await asyncio.gather(
+            process.stdout.read(),
+            process.stderr.read(),
+            MediaHandler._feed_stdin(process, chunks),
+        )
+        await process.wait()
+        return out, err
+
+    @staticmethod
+    def _prepare_ffmpeg_input(
+            file_content: FileContent,
+            suffix: str,
+    ) -> Tuple[str, Optional[int], Optional[FileContent], Optional[NamedTemporaryFile]]:
+        """
+        Решает, как передать вход в ffmpeg: через pipe или через временный файл (m4a/mp4 из pipe не читаются).
+        Файл, который уже лежит на диске (см. local_path), передается по своему пути.
+        Возвращает источник для -i, stdin для подпроцесса, данные для pipe и временный файл, который надо закрыть.
+        """
+        path: Optional[str] = local_path(file_content)
+        if path:
+            log.debug('Passing local file to ffmpeg by path')
+            return path, None, None, None
+
+        if suffix in ('.m4a', '.mp4'):
+            log.debug('Passing data to ffmpeg as file')
+            temp_file: NamedTemporaryFile = NamedTemporaryFile(suffix=suffix)
+            temp_file.write(file_content)
+            temp_file.flush()
+            return temp_file.name, None, None, temp_file
+
+        return 'pipe:0', asyncio.subprocess.PIPE, file_content, None
+
+    @staticmethod
+    async def _stream_command(
+            file_content: FileContent,
+            suffix: str,
+            *params: Tuple[str],
+            weight: int,
+    ) -> AsyncIterator[bytes]:
+        """
+        Вариант _run_command для ffmpeg, который отдает stdout чанками по мере кодирования, не собирая его целиком.
+        Бюджет CPU держится, пока генератор не будет дочитан или закрыт.
+        Ненулевой код возврата или пустой вывод ffmpeg приводят к SubprocessError в конце потока,
+        поэтому потребитель (multipart загрузка) прерывается, а не отправляет битый файл.
+        """
+        source, stdin, pipe_input, temp_file = MediaHandler._prepare_ffmpeg_input(file_content, suffix)
+        args: Tuple[str] = ('ffmpeg', '-hide_banner', '-y', '-i', source, *params, 'pipe:1')
+        process: Optional[Process] = None
+        feeder: Optional[asyncio.Future] = None
+        stderr_reader: Optional[asyncio.Future] = None
+        size: int = 0
+
+        try:
+            async with cpu_scheduler.slot(weight):
+                log.debug(f'Run streaming ffmpeg subprocess with args: {args}')
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=stdin,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                if pipe_input is not None:
+                    feeder = asyncio.ensure_future(MediaHandler._feed_stdin(process, pipe_input))
+                stderr_reader = asyncio.ensure_future(process.stderr.read())
+
+                while True:
+                    chunk: bytes = await process.stdout.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    yield chunk
+
+                if feeder:
+                    await feeder
+                await process.wait()
+                err: bytes = await stderr_reader
+
+            exc_extra: dict = {'stderr': err, 'suffix': suffix, 'size': size}
+            if process.returncode != 0:
+                log.error(f'ffmpeg return code is not 0. Debug: {exc_extra}')
+                raise SubprocessError('ffmpeg return code is not 0.', exc_extra)
+            if not size:
+                raise SubprocessError('ffmpeg returned zero output.', exc_extra)
+
+        finally:
+            for task in (feeder, stderr_reader):
+                if task and not task.done():
+                    task.cancel()
+            if process and process.returncode is None:
+                process.kill()
+            if temp_file:
+                temp_file.close()
+
+    @staticmethod
+    async def _run_command(
+            command: str,
+            file_content: FileContent,
+            suffix: str,
+            *params: Tuple[str],
+            weight: int = ACTION_CPU_WEIGHTS['probe'],
+            stream_output: bool = False,
+    ) -> FileContent:
         """
         Вызывает ffmpeg/ffprobe с переданными параметрами и возвращает результат или бросает эксепшн.
         По suffix определяем форматы, которые должны быть переданы ff,peg в качестве файла на ФС.
 
         Команды работают через pipe кроме некоторых форматов аудио для ffmpeg.
         ffprobe возвращает битрейт аудио потока в bit/s
+        Подпроцесс запускается только после получения weight единиц бюджета CPU от cpu_scheduler.
 
         :param command: 'ffmpeg' или 'ffprobe'.
         :param params: Параметры запуска, разбитые в формате subprocess.
-        :param file_content: байты аудиоконтента.
+        :param file_content: байты аудиоконтента или поток чанков (только для self.pipeable_suffixes).
         :param suffix: расширение файла.
+        :param weight: Стоимость команды в единицах бюджета CPU, см. ACTION_CPU_WEIGHTS.
+        :param stream_output: Только для ffmpeg: вернуть stdout потоком чанков (см. _stream_command).
         :return: bytes stdout команды.
 
         TODO: У flac получается неправильный length при piping'е в stdout. Сделать возможность выводить в файл.
         """
-        stdin: Optional[str] = asyncio.subprocess.PIPE
-        pipe_input: Optional[bytes] = file_content
-        temp_file: object = None
+        if stream_output and command == 'ffmpeg':
+            return MediaHandler._stream_command(file_content, suffix, *params, weight=weight)
+
+        stdin: Optional[int] = asyncio.subprocess.PIPE
+        pipe_input: Optional[FileContent] = file_content
+        temp_file: Optional[NamedTemporaryFile] = None
         process: Process = None
 
         if command == 'ffmpeg':
-            ffmpeg_input_source: str = 'pipe:0'
-
-            if suffix in ('.m4a', '.mp4'):
-                log.debug('Passing data to ffmpeg as file')
-                temp_file: object = NamedTemporaryFile(suffix=suffix)
-                temp_file.write(file_content)
-                ffmpeg_input_source = temp_file.name
-                stdin = None
-                pipe_input = None
+            ffmpeg_input_source: str
+            ffmpeg_input_source, stdin, pipe_input, temp_file = MediaHandler._prepare_ffmpeg_input(file_content, suffix)
             args = ('-hide_banner', '-y', '-i', ffmpeg_input_source, *params, 'pipe:1')
 
         elif command == 'ffprobe':
-            args = ('-v', 'error', *params, '-')
+            path: Optional[str] = local_path(file_content)
+            if path:
+                stdin, pipe_input = None, None
+            args = ('-v', 'error', *params, path or '-')
         else:
             raise AudioHandlerError('Unknown command.', {'command': command})
 
         try:
             args = (command, *args)
-            log.debug(f'Run {command} subprocess with args: {args}')
-
-            process: Process = await asyncio.create_subprocess_exec(
-                *args,
-                stdin=stdin,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-            )
-            out, err = await process.communicate(input=pipe_input)
-
+            async with cpu_scheduler.slot(weight):
+                log.debug(f'Run {command} subprocess with args: {args}')
+
+                process: Process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=stdin,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                if pipe_input is None or isinstance(pipe_input, (bytes, bytearray)):
+                    out, err = await process.communicate(input=pipe_input)
+                else:
+                    out, err = await MediaHandler._communicate_stream(process, pipe_input)
+
+        except SoundHoundError:
+            # Например, TGNetworkError при обрыве скачивания входного потока.
+            raise
         except Exception as error:
             raise SubprocessError(
                 f'{command} call failed.',
@@ -113,7 +294,7 @@ class MediaHandler:
         finally:
             if process:
                 if process.returncode is None:
-                    await process.terminate()
+                    process.kill()
             if temp_file:
                 temp_file.close()
 
@@ -133,27 +314,213 @@ class MediaHandler:
 
         return out
 
+    async def probe(self, content: bytes, file_size: int) -> Dict[str, Any]:
+        """
+        ffprobe по началу файла (см. TelegramAPI.download_prefix): есть ли аудио и видео потоки, кодек, размеры
+        и длительность. Длительность из заголовков (Xing, STREAMINFO, moov) точная. Если в заголовках ее нет,
+        она оценивается по битрейту и полному размеру файла, тогда duration_estimated = True.
+
+        :param content: Начало файла.
+        :param file_size: Полный размер файла.
+        """
+        output: Dict[str, Any] = codec.loads(
+            await self._run_command(
+                'ffprobe',
+                content,
+                None,
+                '-print_format', 'json', '-show_format', '-show_streams',
+            )
+        )
+        streams: List[Dict[str, Any]] = output.get('streams', [])
+        audio: Optional[dict] = next((x for x in streams if x.get('codec_type') == 'audio'), None)
+        video: Optional[dict] = next((x for x in streams if x.get('codec_type') == 'video'), None)
+        main_stream: dict = video or audio or {}
+
+        result: Dict[str, Any] = {
+            'has_audio': bool(audio),
+            'has_video': bool(video),
+            'codec_name': main_stream.get('codec_name'),
+            'duration': None,
+            'duration_estimated': False,
+        }
+        if video:
+            result['width'] = int(video.get('width', 0))
+            result['height'] = int(video.get('height', 0))
+
+        duration: Optional[str] = main_stream.get('duration') or output.get('format', {}).get('duration')
+        bit_rate: Optional[str] = main_stream.get('bit_rate') or output.get('format', {}).get('bit_rate')
+        if duration:
+            result['duration'] = int(float(duration))
+        elif bit_rate and int(bit_rate):
+            result['duration'] = int(file_size * 8 / int(bit_rate))
+            result['duration_estimated'] = True
+
+        return result
+
+
+class TranscodePlan(NamedTuple):
+    """Решение планировщика: 'copy' - отдать вход как есть, 'remux' - вырезать без перекодирования, 'encode'."""
+    decision: str
+    reason: str
+
 
 class AudioHandler(MediaHandler):
-    async def _crop_file(self, audio: bytes, suffix: str, _format: str, time_range: Tuple[int]) -> bytes:
+    # Контейнеры, в которых может лежать Opus, который не нужно перекодировать.
+    ogg_suffixes: Tuple[str] = ('.ogg', '.oga')
+    # makeopus кодирует в 96K или 128K. Opus входы с битрейтом не выше этого отдаются как есть.
+    opus_copy_max_bitrate: int = 128000
+    # Форматы, у которых mutagen знает точную длительность: только их makeopus кодирует по сегментам.
+    segment_suffixes: Tuple[str] = ('.flac', '.wav')
+    # pre-skip libopus (lookahead 6.5 мс) и длительность пакета при -frame_duration 20, в сэмплах 48 kHz.
+    opus_pre_skip: int = 312
+    opus_frame: int = 960
+    # Сегменты кодируются с запасом перед своей границей (кроме первого) и после нее (кроме последнего),
+    # пакеты запаса при склейке выбрасываются. За секунду до границы состояние энкодера (предсказание энергии,
+    # pitch фильтр) сходится с состоянием энкодера предыдущего сегмента, и пакеты после границы совпадают
+    # с теми, что выдал бы один энкодер. После границы энкодер предыдущего сегмента видит настоящее продолжение
+    # сигнала: его lookahead и MDCT окно последнего пакета перекрываются со следующим пакетом.
+    opus_preroll_frames: int = 50
+    opus_postroll_frames: int = 2
+
+    def can_stream(self, action: str, suffix: str, duration: Optional[int] = None, local: bool = False) -> bool:
+        """
+        Можно ли отдать ffmpeg входной файл потоком, пока он еще скачивается.
+        crop и makevoice читают файл один раз. makeopus сначала меряет битрейт через ffprobe,
+        которому нужен весь файл. Исключение - flac, для которого битрейт не нужен.
+        crop wav, flac и mp3 делается без ffmpeg (см. app/crop.py), ему нужен файл целиком.
+        Длинный flac для makeopus тоже нужен целиком: он может кодироваться по сегментам (см. _make_opus_segmented).
+
+        local - файл лежит на диске локального Bot API сервера. Тогда ffmpeg читает его по пути, поэтому
+        подходят и форматы, которые не читаются из pipe (m4a, mp4), а битрейт для makeopus mutagen
+        читает из заголовков файла на диске: весь файл в память не загружается.
+        """
+        if suffix not in self.pipeable_suffixes and not local:
+            return False
+        if action == 'makeopus' and self._segmentable(suffix, duration):
+            return False
+        if action == 'crop' and suffix in native_croppers:
+            return False
+        if action == 'makevoice' and suffix in self.ogg_suffixes:
+            # Ogg может уже быть Opus без нужды в перекодировании (см. plan_transcode), это видно по файлу целиком.
+            return False
+        if action == 'makeopus' and local and suffix not in self.ogg_suffixes:
+            return True
+        return action in ('crop', 'makevoice') or (action == 'makeopus' and suffix == '.flac')
+
+    @staticmethod
+    async def _mp3_index(audio: bytes, file_id: Optional[str]) -> Optional[Mp3FrameIndex]:
+        # Индекс строится проходом по всем фреймам: в пуле, и один раз на файл.
+        index: Optional[Mp3FrameIndex] = mp3_index_cache.get(file_id)
+        if not index:
+            index = await blocking_executor.run('mp3_index', index_mp3, audio)
+            mp3_index_cache.put(file_id, index)
+        return index
+
+    async def _crop_file(
+            self,
+            audio: FileContent,
+            suffix: str,
+            _format: str,
+            time_range: Tuple[int],
+            stream_output: bool = False,
+            file_id: Optional[str] = None,
+    ) -> FileContent:
         """
         Запускает подпроцесс ffmpeg для обрезания аудио файла в заданном диапазоне.
-        Возвращает байты обрезанного файла.
+        Возвращает байты обрезанного файла или поток его чанков.
 
         :param audio: Исходник аудиофайла.
         :param suffix: Расширения исходника. Нужно для понимания как подавать данные на вход ffmpeg: pipe или файл.
         :param _format: Формат аудиопотока. Нужен для явного указания ffmpeg т.к. пишем в pipe.
         :param time_range: Отрезок времени в секундах который нужно вырезать из исходника.
+        :param file_id: file_unique_id исходника. По нему кэшируется индекс фреймов MP3.
         :return: Результирующий аудиофайл.
+
+        WAV, FLAC и MP3 режутся в процессе, без ffmpeg (native_crop): новый заголовок плюс срез исходных данных.
+        Такой результат всегда отдается потоком кусков (iter_pieces), чтобы срез не копировался ради склейки.
+        Если файл не удалось разобрать, обрезка идет через ffmpeg как для остальных форматов.
         """
+        cropped: Optional[CropResult]
+        if suffix == '.mp3' and isinstance(audio, (bytes, bytearray)):
+            index: Optional[Mp3FrameIndex] = await self._mp3_index(audio, file_id)
+            cropped = crop_mp3(audio, *time_range, index=index) if index else None
+        else:
+            cropped = native_crop(audio, suffix, time_range)
+        if cropped:
+            metrics.incr('crop.native')
+            return iter_pieces(cropped)
+
+        metrics.incr('crop.ffmpeg')
         return await self._run_command(
             'ffmpeg',
             audio,
             suffix,
             '-ss', str(time_range[0]), '-to', str(time_range[1]), '-acodec', 'copy', '-f', _format,
+            weight=ACTION_CPU_WEIGHTS['crop'],
+            stream_output=stream_output,
         )
 
-    async def _make_voice(self, audio: bytes, suffix: str, time_range: Tuple[int]) -> bytes:
+    def plan_transcode(
+            self,
+            audio: FileContent,
+            suffix: str,
+            action: str,
+            time_range: Optional[Tuple[int, int]] = None,
+    ) -> TranscodePlan:
+        """
+        Решает, нужно ли makeopus/makevoice кодировать вход заново. Только вход, который уже Opus в Ogg, может
+        обойтись без кодирования: makeopus - если битрейт не выше opus_copy_max_bitrate, makevoice - если
+        запрошен файл целиком и он меньше 1 Мб (copy), или вырезанный кусок по битрейту влезет в 1 Мб (remux).
+        Решение пишется в лог и в metrics: transcode.<action>.<decision>.
+        """
+        plan: TranscodePlan = self._plan_transcode(audio, suffix, action, time_range)
+        log.info(f'Transcode plan for {action}: {plan.decision} ({plan.reason}).')
+        metrics.incr(f'transcode.{action}.{plan.decision}')
+        return plan
+
+    def _plan_transcode(
+            self,
+            audio: FileContent,
+            suffix: str,
+            action: str,
+            time_range: Optional[Tuple[int, int]],
+    ) -> TranscodePlan:
+        if not isinstance(audio, (bytes, bytearray)):
+            return TranscodePlan('encode', 'streamed input')
+        if suffix not in self.ogg_suffixes:
+            return TranscodePlan('encode', f'{suffix} input')
+
+        meta: Optional[Dict[str, Any]] = self.get_audio_meta(audio)
+        if not meta or meta['codec_name'] != 'OggOpus':
+            return TranscodePlan('encode', f'codec {meta and meta["codec_name"]}')
+        duration: Optional[int] = meta['duration']
+        # У OggOpus в mutagen нет битрейта: средний по размеру и длительности.
+        bitrate: Optional[int] = meta['bitrate'] or (len(audio) * 8 // duration if duration else None)
+        if not bitrate:
+            return TranscodePlan('encode', 'unknown bitrate')
+
+        if action == 'makeopus':
+            if bitrate <= self.opus_copy_max_bitrate:
+                return TranscodePlan('copy', f'opus {bitrate} bit/s')
+            return TranscodePlan('encode', f'opus {bitrate} bit/s above target')
+
+        if action == 'makevoice' and time_range:
+            if time_range[0] == 0 and duration and time_range[1] >= duration and len(audio) < SIZE_1MB:
+                return TranscodePlan('copy', 'whole opus file fits a voice message')
+            # Запас на заголовки Ogg страниц.
+            if bitrate * (time_range[1] - time_range[0]) // 8 < SIZE_1MB * 0.95:
+                return TranscodePlan('remux', f'opus {bitrate} bit/s fragment fits a voice message')
+            return TranscodePlan('encode', 'opus fragment exceeds voice size limit')
+
+        return TranscodePlan('encode', 'no shortcut')
+
+    async def _make_voice(
+            self,
+            audio: FileContent,
+            suffix: str,
+            time_range: Tuple[int],
+            stream_output: bool = False,
+    ) -> FileContent:
         """
         Обрезает файл по времени, а так же конвертирует в opus ogg, вычисляя оптимальный битрейт по времени
         результирующего фрагмента.
@@ -169,6 +536,19 @@ class AudioHandler(MediaHandler):
         :param time_range: Отрезок времени в секундах который нужно вырезать из исходника.
         :return: Результирующий аудиофайл.
         """
+        plan: TranscodePlan = self.plan_transcode(audio, suffix, 'makevoice', time_range)
+        if plan.decision == 'copy':
+            return audio
+        if plan.decision == 'remux':
+            return await self._run_command(
+                'ffmpeg',
+                audio,
+                suffix,
+                '-ss', str(time_range[0]), '-to', str(time_range[1]), '-map', 'a', '-c:a', 'copy', '-f', 'oga',
+                weight=ACTION_CPU_WEIGHTS['crop'],
+                stream_output=stream_output,
+            )
+
         MAX_BITRATE: int = 512000
         bitrate: int = 8000000 // (int(time_range[1]) - int(time_range[0]))
 
@@ -181,12 +561,62 @@ class AudioHandler(MediaHandler):
             suffix,
             '-ss', str(time_range[0]), '-to', str(time_range[1]), '-map', 'a', '-c:a', 'libopus',
             '-b:a', str(bitrate), '-vbr', 'off', '-f', 'oga',
+            weight=ACTION_CPU_WEIGHTS['makevoice'],
+            stream_output=stream_output,
         )
 
-    async def _get_bitrate(self, audio: bytes, suffix: str) -> Optional[int]:
+    @staticmethod
+    def get_audio_meta(audio: FileContent, file_size: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Мета данные аудио через mutagen, в процессе, без запуска ffprobe: bitrate, duration, channels, sample_rate.
+        Возвращает None, если mutagen не распознал файл.
+
+        :param audio: Контент аудиофайла или только его начало (см. TelegramAPI.download_prefix).
+            Файл на диске (см. local_path) mutagen читает сам, только заголовки.
+        :param file_size: Полный размер файла, если audio - только начало. Длительность в заголовке есть
+            у FLAC, WAV и MP4. Для остальных форматов она оценивается по битрейту, тогда duration_estimated = True.
+        """
+        try:
+            audio_fo: Optional[FileType] = File(local_path(audio) or BytesIO(audio))
+        except Exception as exc:
+            log.debug(f'mutagen failed to parse audio: {exc}')
+            return None
+        if audio_fo is None or not getattr(audio_fo, 'info', None):
+            return None
+
+        info: Any = audio_fo.info
+        meta: Dict[str, Any] = {
+            'codec_name': type(audio_fo).__name__,
+            'bitrate': getattr(info, 'bitrate', 0) or None,
+            'duration': int(getattr(info, 'length', 0) or 0) or None,
+            'length': float(getattr(info, 'length', 0) or 0),
+            'duration_estimated': False,
+            'channels': getattr(info, 'channels', None),
+            'sample_rate': getattr(info, 'sample_rate', None),
+        }
+
+        truncated: bool = bool(file_size) and file_size > len(audio)
+        if truncated and not isinstance(audio_fo, (FLAC, MP4, WAVE)):
+            meta['duration'] = int(file_size * 8 / meta['bitrate']) if meta['bitrate'] else None
+            meta['length'] = float(meta['duration'] or 0)
+            meta['duration_estimated'] = True
+
+        return meta
+
+    async def probe(self, content: bytes, file_size: int) -> Dict[str, Any]:
+        """Сначала mutagen в процессе, ffprobe только если mutagen не справился. См. MediaHandler.probe."""
+        meta: Optional[Dict[str, Any]] = self.get_audio_meta(content, file_size)
+        if meta and meta['duration']:
+            metrics.incr('audio_meta.mutagen')
+            return {'has_audio': True, 'has_video': False, **meta}
+
+        metrics.incr('audio_meta.ffprobe')
+        return await super().probe(content, file_size)
+
+    async def _get_bitrate(self, audio: FileContent, suffix: str) -> Optional[int]:
         """
         У flac почему то не определяет bitrate но это и не нужно, т.к. все равно lossless.
-        TODO: заменить на вызов get_audio_meta по аналогии с get_video_meta.
+        Битрейт берется из get_audio_meta (mutagen). ffprobe запускается, только если mutagen его не знает.
 
         :param audio: Контент айдиофайла.
         :param suffix: Расширение файла. У flac не определяется битрейт.
@@ -195,6 +625,12 @@ class AudioHandler(MediaHandler):
         if suffix == '.flac':
             return None
 
+        meta: Optional[Dict[str, Any]] = self.get_audio_meta(audio)
+        if meta and meta['bitrate']:
+            metrics.incr('audio_meta.mutagen')
+            return meta['bitrate']
+
+        metrics.incr('audio_meta.ffprobe')
         output: bytes = await self._run_command(
             'ffprobe',
             audio,
@@ -212,29 +648,281 @@ class AudioHandler(MediaHandler):
 
         return bitrate
 
-    async def _make_opus(self, audio: bytes, suffix: str) -> bytes:
+    async def _make_opus(self, audio: FileContent, suffix: str, stream_output: bool = False) -> FileContent:
         """
         Делает opus ogg файл из переданного аудиофайла.
         Если у нас невысокий битрейт (ниже 192 Кбит), кодируем в 96К Opus. Иначе в 128K Opus.
+        Битрейт читается mutagen'ом из заголовков, поэтому обычно джоб запускает один подпроцесс (ffmpeg) вместо двух:
+        без ffprobe, которому раньше перед кодированием целиком передавался весь файл.
 
         :param audio: Файл который нужно перекодировать в opus ogg.
         :param suffix: Расширение файла. Используется при определении битрейта. TODO: убрать этот параметр.
         :return: Содержимое opus ogg файла в байтах.
         """
 
+        if self.plan_transcode(audio, suffix, 'makeopus').decision == 'copy':
+            return audio
+
         output_bitrate: str = '128K'
         input_bitrate: int = await self._get_bitrate(audio, suffix)
 
         if input_bitrate and input_bitrate < 192000:
             output_bitrate: str = '96K'
 
+        bounds: Optional[List[int]] = self._opus_segment_bounds(audio, suffix)
+        if bounds:
+            encoded: Optional[bytes] = await self._make_opus_segmented(audio, suffix, output_bitrate, bounds)
+            if encoded:
+                return encoded
+
         return await self._run_command(
             'ffmpeg',
             audio,
             suffix,
             '-c:a', 'libopus', '-b:a', output_bitrate, '-vbr', 'off', '-f', 'oga',
+            weight=ACTION_CPU_WEIGHTS['makeopus'],
+            stream_output=stream_output,
+        )
+
+    @staticmethod
+    def _voice_chunks(duration: int) -> List[Tuple[int, int]]:
+        """Делит duration на равные куски не длиннее SPLIT_VOICE_CHUNK_DURATION, каждый влезает в 1 Мб."""
+        # 10% запаса на заголовки Ogg страниц.
+        longest: int = min(SPLIT_VOICE_CHUNK_DURATION, int(SIZE_1MB * 8 * 0.9) // SPLIT_VOICE_BITRATE)
+        count: int = -(-duration // longest)
+        length: int = -(-duration // count)
+        return [(start, min(start + length, duration)) for start in range(0, duration, length)]
+
+    async def _encode_voice_chunk(
+            self,
+            audio: bytes,
+            suffix: str,
+            _format: str,
+            time_range: Tuple[int, int],
+            last: bool,
+            file_id: Optional[str],
+            precut: bool = False,
+    ) -> bytes:
+        """
+        Кодирует кусок [start, end) в голосовое. WAV, FLAC и MP3 сначала режутся в процессе (см. _crop_file),
+        чтобы ffmpeg не декодировал файл с начала ради каждого куска: границы кусков тогда точны до фрейма.
+        precut - audio уже сам кусок, вырезанный _precut_voice_chunks, он кодируется целиком.
+        Последний кусок идет до конца файла: duration целая и могла отбросить доли секунды.
+        """
+        params: Tuple[str, ...] = ('-ss', str(time_range[0])) + (() if last else ('-to', str(time_range[1])))
+        if precut:
+            suffix, params = f'.{_format}', ()
+        elif suffix in native_croppers:
+            audio = await self._crop_file(
+                audio, suffix, _format, (time_range[0], time_range[1] + (1 if last else 0)), file_id=file_id,
+            )
+            params = ()
+
+        return await self._run_command(
+            'ffmpeg',
+            audio,
+            suffix,
+            *params,
+            '-vn', '-c:a', 'libopus', '-b:a', str(SPLIT_VOICE_BITRATE), '-vbr', 'off', '-f', 'oga',
+            weight=ACTION_CPU_WEIGHTS['splitvoice'],
+        )
+
+    async def _precut_voice_chunks(
+            self,
+            audio: bytes,
+            suffix: str,
+            _format: str,
+            ranges: List[Tuple[int, int]],
+    ) -> Optional[List[bytes]]:
+        """
+        Режет вход на куски ranges без перекодирования, одним проходом ffmpeg -f segment: иначе каждый кусок
+        m4a или ogg ffmpeg декодировал бы с начала файла до своего -ss, и работа росла бы квадратично.
+        Граница куска - первый пакет не раньше нее (у AAC и Opus это 20-23 мс). Куски пишутся во временный
+        каталог. None - вход не удалось порезать (например, кодек не помещается в _format): тогда каждый кусок
+        режется сам через -ss/-to.
+        """
+        source, stdin, pipe_input, temp_file = self._prepare_ffmpeg_input(audio, suffix)
+        process: Optional[Process] = None
+        try:
+            with TemporaryDirectory() as directory:
+                args: Tuple[str, ...] = (
+                    'ffmpeg', '-hide_banner', '-y', '-i', source, '-map', 'a', '-c', 'copy',
+                    '-f', 'segment', '-segment_format', _format, '-reset_timestamps', '1',
+                    '-segment_times', ','.join(str(start) for start, _ in ranges[1:]),
+                    os.path.join(directory, f'%04d.{_format}'),
+                )
+                async with cpu_scheduler.slot(ACTION_CPU_WEIGHTS['crop']):
+                    log.debug(f'Run ffmpeg subprocess with args: {args}')
+                    process = await asyncio.create_subprocess_exec(
+                        *args, stdin=stdin, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                    )
+                    _, err = await process.communicate(input=pipe_input)
+                pieces: List[bytes] = [path.read_bytes() for path in sorted(Path(directory).iterdir())]
+        finally:
+            if process and process.returncode is None:
+                process.kill()
+            if temp_file:
+                temp_file.close()
+
+        if process.returncode != 0 or len(pieces) != len(ranges) or not all(pieces):
+            log.warning(f'Unable to pre-cut {suffix} into {len(ranges)} chunks, got {len(pieces)}: {err[-500:]!r}')
+            metrics.incr('splitvoice.precut_failed')
+            return None
+        return pieces
+
+    async def split_voice(
+            self,
+            audio: bytes,
+            file_meta: dict,
+            duration: int,
+    ) -> AsyncIterator[Tuple[bytes, Tuple[int, int]]]:
+        """
+        Делит аудио на последовательные голосовые сообщения (см. _voice_chunks) и отдает их по порядку вместе
+        с их time range. Кусков в работе (кодируется или отправляется) не больше SPLIT_VOICE_PARALLEL: первый
+        кусок отправляется, пока кодируются следующие, а новый кусок запускается, когда потребитель вернулся
+        за следующим. Так один длинный файл не занимает весь бюджет CPU и очередь cpu_scheduler.
+        Незабранные куски отменяются при закрытии генератора (aclose).
+        """
+        suffix, _format = self._get_suffix_and_format(file_meta)
+        file_id: Optional[str] = file_meta.get('file_unique_id')
+        if suffix == '.mp3':
+            # Индекс нужен всем кускам: строим один раз до их запуска.
+            await self._mp3_index(audio, file_id)
+
+        ranges: List[Tuple[int, int]] = self._voice_chunks(duration)
+        pieces: Optional[List[bytes]] = None
+        if suffix not in native_croppers and len(ranges) > 1:
+            pieces = await self._precut_voice_chunks(audio, suffix, _format, ranges)
+
+        pending: Deque[Tuple[Tuple[int, int], asyncio.Future]] = deque()
+        queued: int = 0
+        try:
+            while queued < len(ranges) or pending:
+                while queued < len(ranges) and len(pending) < max(1, SPLIT_VOICE_PARALLEL):
+                    task: asyncio.Future = asyncio.ensure_future(self._encode_voice_chunk(
+                        pieces[queued] if pieces else audio, suffix, _format, ranges[queued],
+                        queued == len(ranges) - 1, file_id, precut=bool(pieces),
+                    ))
+                    if pieces:
+                        # Кусок нужен только своему ffmpeg: не держим все куски в памяти до конца.
+                        pieces[queued] = b''
+                    pending.append((ranges[queued], task))
+                    queued += 1
+
+                time_range, task = pending[0]
+                chunk: bytes = await task
+                pending.popleft()
+                metrics.incr('splitvoice.chunks')
+                yield chunk, time_range
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _segmentable(suffix: str, duration: Optional[int]) -> bool:
+        return (
+            OPUS_SEGMENTS > 1 and suffix in AudioHandler.segment_suffixes
+            and bool(duration) and duration >= OPUS_SEGMENT_MIN_DURATION
         )
 
+    def _opus_segment_bounds(self, audio: FileContent, suffix: str) -> Optional[List[int]]:
+        """
+        Границы сегментов для _make_opus_segmented в сэмплах 48 kHz, или None, если кодировать одним ffmpeg.
+        По сегментам кодируется только длинный файл и только когда бюджет CPU свободен: иначе параллельные
+        сегменты отнимут CPU у чужих джобов, а общая пропускная способность не вырастет.
+        """
+        if not isinstance(audio, (bytes, bytearray)) or cpu_scheduler.in_use or cpu_scheduler.depth:
+            return None
+        meta: Optional[Dict[str, Any]] = self.get_audio_meta(audio)
+        if not meta or not self._segmentable(suffix, meta['duration']):
+            return None
+
+        segments: int = min(OPUS_SEGMENTS, cpu_scheduler.budget // max(1, ACTION_CPU_WEIGHTS['makeopus']))
+        if segments < 2:
+            return None
+        # Первый сегмент вместе с pre-skip и остальные (кроме последнего) кодируются в целое число пакетов:
+        # тогда в склейке нет неполных пакетов посередине, хвост паддинга есть только у последнего.
+        frames: int = int(meta['length'] * 48000) // self.opus_frame // segments
+        return [index * frames * self.opus_frame - self.opus_pre_skip for index in range(1, segments)]
+
+    async def _make_opus_segmented(
+            self,
+            audio: bytes,
+            suffix: str,
+            output_bitrate: str,
+            bounds: List[int],
+    ) -> Optional[bytes]:
+        """
+        Кодирует audio в Opus len(bounds) + 1 параллельными ffmpeg и склеивает их в один Ogg поток без пауз.
+
+        Каждый ffmpeg режет свой отрезок через atrim с точностью до сэмпла после ресемплинга в 48 kHz,
+        с запасом opus_preroll_frames пакетов перед границей и opus_postroll_frames после нее. Пакеты запаса
+        выбрасываются, granule position и номера страниц пересчитываются (см. app/ogg.py).
+        Результат проверяется: длительность склейки должна совпасть с длительностью входа. Если нет, или
+        ffmpeg выдал не то число пакетов, возвращается None и файл кодируется обычным путем.
+        """
+        preroll: int = self.opus_preroll_frames * self.opus_frame - self.opus_pre_skip
+        postroll: int = self.opus_postroll_frames * self.opus_frame
+        starts: List[int] = [0] + [bound - preroll for bound in bounds]
+        ends: List[Optional[int]] = [*bounds, None]
+
+        started: float = time.monotonic()
+        outputs: List[bytes] = await asyncio.gather(*[
+            self._run_command(
+                'ffmpeg',
+                audio,
+                suffix,
+                '-vn',
+                '-af', f'aresample=48000,atrim=start_sample={start}' + (f':end_sample={end + postroll}' if end else '')
+                + ',asetpts=PTS-STARTPTS',
+                '-c:a', 'libopus', '-b:a', output_bitrate, '-vbr', 'off', '-frame_duration', '20', '-f', 'oga',
+                weight=ACTION_CPU_WEIGHTS['makeopus'],
+            )
+            for start, end in zip(starts, ends)
+        ])
+
+        streams: List[Optional[OpusStream]] = [parse_opus(output) for output in outputs]
+        if None in streams:
+            return self._segments_failed('unparsable segment')
+
+        packets: List[bytes] = []
+        samples: int = 0
+        for index, (stream, start, end) in enumerate(zip(streams, starts, ends)):
+            if stream.pre_skip != self.opus_pre_skip:
+                return self._segments_failed(f'pre-skip {stream.pre_skip}')
+            # Сколько сэмплов получил энкодер и сколько из них относятся к самому сегменту.
+            fed: int = stream.granule - stream.pre_skip
+            if end and fed != end + postroll - start:
+                return self._segments_failed(f'segment {index} has {fed} samples instead of {end + postroll - start}')
+            own: int = fed - (preroll if index else 0) - (postroll if end else 0)
+
+            skip: int = self.opus_preroll_frames if index else 0
+            tail: int = self.opus_postroll_frames if end else 0
+            kept_packets: List[bytes] = stream.packets[skip:len(stream.packets) - tail]
+            if any(opus_packet_samples(packet) != self.opus_frame for packet in stream.packets[:skip] + kept_packets):
+                return self._segments_failed(f'segment {index} frame size')
+            kept: int = len(kept_packets) * self.opus_frame
+            expected: int = own + (stream.pre_skip if index == 0 else 0)
+            if end and kept != expected or not end and not expected <= kept < expected + self.opus_frame:
+                return self._segments_failed(f'segment {index} decodes to {kept} samples instead of {expected}')
+
+            packets.extend(kept_packets)
+            samples += own
+
+        length: float = self.get_audio_meta(audio)['length']
+        if abs(samples / 48000 - length) > 0.001:
+            return self._segments_failed(f'joined duration {samples / 48000:.3f}s, input {length:.3f}s')
+
+        log.info(f'Encoded {length:.0f}s of audio in {len(streams)} segments in {time.monotonic() - started:.2f}s.')
+        metrics.incr('opus_segments.joined')
+        return write_opus(streams[0].head, streams[0].tags, packets, samples)
+
+    @staticmethod
+    def _segments_failed(reason: str) -> None:
+        log.warning(f'Segmented opus encoding failed, falling back to single encoder: {reason}.')
+        metrics.incr('opus_segments.fallback')
+        return None
+
     @staticmethod
     def _set_cover_pic(audio: bytes, pic: bytes, suffix: str) -> bytes:
         """
@@ -285,37 +973,41 @@ class AudioHandler(MediaHandler):
 
     async def handle_file(
             self,
-            file: bytes,
+            file: FileContent,
             file_meta: dict,
             action: str,
             parameters: Any,
             pic: Optional[bytes] = None,
-    ) -> bytes:
+            stream_output: bool = False,
+    ) -> FileContent:
         """
         Публичный метод, принимающий action и соотв. ему paramaters из внешнего кода.
         Роутит по приватным методам класса, получает от них обработанные байты, и возвращает их обратно в внешний код.
 
-        :param file: Исходник аудиофайла.
+        :param file: Исходник аудиофайла. Поток чанков допустим, только если can_stream() для action и suffix.
         :param file_meta: Метажанные файла. Из них нужно только расширение файла.
         :param action: Дейстфие из меню. По нему роутится дальше по методам.
         :param parameters: На данный момент это time range tuple.
         :param pic: Исходник изображения к вставке в исходник аудио.
+        :param stream_output: Вернуть результат ffmpeg потоком чанков, а не байтами. setcover всегда отдает байты.
         :return: Результирующий файл.
         """
-        audio: bytes = b''
+        audio: FileContent = b''
         suffix, _format = self._get_suffix_and_format(file_meta)
 
         if action == 'crop':
-            audio = await self._crop_file(file, suffix, _format, parameters)
+            audio = await self._crop_file(
+                file, suffix, _format, parameters, stream_output, file_meta.get('file_unique_id'),
+            )
 
         elif action == 'makevoice':
-            audio = await self._make_voice(file, suffix, parameters)
+            audio = await self._make_voice(file, suffix, parameters, stream_output)
 
         elif action == 'makeopus':
-            audio = await self._make_opus(file, suffix)
+            audio = await self._make_opus(file, suffix, stream_output)
 
         elif action == 'setcover':
-            audio = self._set_cover_pic(file, pic, suffix)
+            audio = await blocking_executor.run('set_cover_pic', self._set_cover_pic, file, pic, suffix)
         else:
             log.error(f'Task handler for action: {action} is not implemented')
 
@@ -323,11 +1015,18 @@ class AudioHandler(MediaHandler):
 
 
 class VideoHandler(MediaHandler):
-    async def make_rounded(self, video: bytes, meta: Dict[str, Any], time_range: Tuple[int]) -> Tuple[bytes, int]:
+    async def make_rounded(
+            self,
+            video: FileContent,
+            meta: Dict[str, Any],
+            time_range: Tuple[int],
+            stream_output: bool = False,
+    ) -> Tuple[FileContent, int]:
         """
         :param video: Входящий файл в виде байт.
         :param meta: Metadata входящего файла.
         :param time_range: Первая и последняя секунда по которым надо обрезать файл.
+        :param stream_output: Вернуть видео потоком чанков stdout ffmpeg.
         :return: Обработанный файл в виде байт, результирующий радиус для того чтобы отправить VideoNote в Telegram.
 
         https://video.stackexchange.com/questions/4563/how-can-i-crop-a-video-with-ffmpeg
@@ -350,17 +1049,19 @@ class VideoHandler(MediaHandler):
             log.debug('Need to downscale')
             scale = f'scale={VIDEO_NOTE_MAX_RADIUS}:-2'
 
-        rounded_video: bytes = await self._run_command(
+        rounded_video: FileContent = await self._run_command(
             'ffmpeg',
             video,
             suffix,
             '-ss', str(time_range[0]), '-to', str(time_range[1]),
             '-vf', f'{crop},{scale}'.rstrip(','), '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4',
+            weight=ACTION_CPU_WEIGHTS['makerounded'],
+            stream_output=stream_output,
         )
 
         return rounded_video, radius
 
-    async def get_video_meta(self, video: bytes, fields: Tuple[str]) -> Dict[str, Any]:
+    async def get_video_meta(self, video: FileContent, fields: Tuple[str]) -> Dict[str, Any]:
         """
         Получает мета данные о файле через ffprobe из переданного контента.
         Фильтрует вывод ffprobe по запрошенным полям и возвращает полученные значения.
@@ -370,7 +1071,7 @@ class VideoHandler(MediaHandler):
         :return: Словарь из запрошенных field=value пар.
         """
         result_meta: Dict[str, Any] = {}
-        meta: Dict[str, Any] = json.loads(
+        meta: Dict[str, Any] = codec.loads(
             await self._run_command(
                 'ffprobe',
                 video,
@@ -0,0 +1,64 @@
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Union
+
+
+class TimingStats:
+    """Простая статистика по длительностям: количество, среднее, максимум и перцентили по последним замерам."""
+    def __init__(self, window: Optional[int] = 1000):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, pct: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered: list = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class MetricsRegistry:
+    """
+    Process-wide реестр метрик. Отдается целиком через GET /stats/ (см. app/stats.py).
+    gauges - функции, вызываемые в момент снятия снимка (например, текущая глубина очереди).
+    """
+    def __init__(self):
+        self.timings: Dict[str, TimingStats] = {}
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, Callable[[], Union[int, float]]] = {}
+
+    def timing(self, name: str) -> TimingStats:
+        if name not in self.timings:
+            self.timings[name] = TimingStats()
+        return self.timings[name]
+
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, func: Callable[[], Union[int, float]]):
+        self.gauges[name] = func
+
+    def snapshot(self) -> dict:
+        return {
+            'timings': {name: stats.snapshot() for name, stats in self.timings.items()},
+            'counters': dict(self.counters),
+            'gauges': {name: func() for name, func in self.gauges.items()},
+        }
+
+
+metrics: MetricsRegistry = MetricsRegistry()
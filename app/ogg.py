@@ -0,0 +1,173 @@
+"""
+Разбор и сборка Ogg Opus (RFC 3533, RFC 7845) без ffmpeg: нужно для склейки сегментов, закодированных параллельно
+(см. AudioHandler._make_opus_segmented).
+
+parse_opus достает из потока OpusHead, OpusTags и пакеты, write_opus собирает новый поток с заново
+посчитанными granule position, номерами страниц и CRC. Поддерживается только один логический поток в файле,
+как его пишет ffmpeg -f oga. Если файл не удалось разобрать, parse_opus возвращает None.
+"""
+import struct
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+OGG_CONTINUED: int = 0x01
+OGG_BOS: int = 0x02
+OGG_EOS: int = 0x04
+# capture pattern, version, header_type, granule, serial, sequence, crc, число сегментов.
+OGG_HEADER: struct.Struct = struct.Struct('<4sBBqIIIB')
+# Страница закрывается после пакета, на котором тело страницы стало не меньше этого размера.
+OGG_PAGE_SIZE: int = 4096
+
+# Длительность одного фрейма в сэмплах 48 kHz по номеру конфигурации из TOC байта (RFC 6716, 3.1).
+OPUS_FRAME_SAMPLES: Tuple[int] = (
+    (480, 960, 1920, 2880) * 3  # SILK: 10, 20, 40, 60 мс
+    + (480, 960) * 2  # Hybrid: 10, 20 мс
+    + (120, 240, 480, 960) * 4  # CELT: 2.5, 5, 10, 20 мс
+)
+
+
+def _crc_table() -> Tuple[int]:
+    table: List[int] = []
+    for byte in range(256):
+        crc: int = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return tuple(table)
+
+
+OGG_CRC_TABLE: Tuple[int] = _crc_table()
+
+
+def ogg_crc(data: bytes) -> int:
+    """CRC-32 Ogg страницы: полином 0x04C11DB7, без отражения, начальное значение 0."""
+    crc: int = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ OGG_CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def opus_packet_samples(packet: bytes) -> int:
+    """Число сэмплов (48 kHz) в Opus пакете по его TOC байту."""
+    if not packet:
+        return 0
+    toc: int = packet[0]
+    frames: int = toc & 0x03
+    if frames == 3:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    elif frames:
+        frames = 2
+    else:
+        frames = 1
+    return OPUS_FRAME_SAMPLES[toc >> 3] * frames
+
+
+class OpusStream(NamedTuple):
+    head: bytes
+    tags: bytes
+    packets: List[bytes]
+    # granule position последней страницы: pre-skip плюс число сэмплов в потоке.
+    granule: int
+
+    @property
+    def pre_skip(self) -> int:
+        return struct.unpack_from('<H', self.head, 10)[0]
+
+
+def parse_opus(data: bytes) -> Optional[OpusStream]:
+    packets: List[bytes] = []
+    packet: bytearray = bytearray()
+    serial: Optional[int] = None
+    granule: int = 0
+    pos: int = 0
+
+    while pos < len(data):
+        if len(data) - pos < OGG_HEADER.size:
+            return None
+        capture, version, _, page_granule, page_serial, _, _, segments = OGG_HEADER.unpack_from(data, pos)
+        if capture != b'OggS' or version != 0 or serial not in (None, page_serial):
+            return None
+        serial = page_serial
+        lacing: bytes = data[pos + OGG_HEADER.size:pos + OGG_HEADER.size + segments]
+        pos += OGG_HEADER.size + segments
+        if len(lacing) != segments or pos + sum(lacing) > len(data):
+            return None
+
+        for value in lacing:
+            packet += data[pos:pos + value]
+            pos += value
+            if value < 255:
+                packets.append(bytes(packet))
+                packet = bytearray()
+        if page_granule != -1:
+            granule = page_granule
+
+    if len(packets) < 2 or not packets[0].startswith(b'OpusHead') or not packets[1].startswith(b'OpusTags'):
+        return None
+    return OpusStream(packets[0], packets[1], packets[2:], granule)
+
+
+def _page(header_type: int, granule: int, serial: int, sequence: int, lacing: List[int], body: bytes) -> bytes:
+    page: bytearray = bytearray(OGG_HEADER.pack(b'OggS', 0, header_type, granule, serial, sequence, 0, len(lacing)))
+    page += bytes(lacing)
+    page += body
+    struct.pack_into('<I', page, 22, ogg_crc(page))
+    return bytes(page)
+
+
+def _paginate(
+        packets: Sequence[bytes],
+        granules: Sequence[int],
+        serial: int,
+        sequence: int,
+        header_type: int = 0,
+        eos: bool = False,
+) -> Tuple[bytes, int]:
+    """Раскладывает пакеты по страницам, начиная с новой. Возвращает страницы и следующий номер страницы."""
+    pages: bytearray = bytearray()
+    lacing: List[int] = []
+    body: bytearray = bytearray()
+    granule: int = -1
+
+    for index, (packet, packet_granule) in enumerate(zip(packets, granules)):
+        values: List[int] = [255] * (len(packet) // 255) + [len(packet) % 255]
+        position: int = 0
+        for value_index, value in enumerate(values):
+            if len(lacing) == 255:
+                pages += _page(header_type, granule, serial, sequence, lacing, body)
+                sequence += 1
+                header_type = OGG_CONTINUED if value_index else 0
+                lacing, body, granule = [], bytearray(), -1
+            lacing.append(value)
+            body += packet[position:position + value]
+            position += value
+        granule = packet_granule
+
+        last: bool = index == len(packets) - 1
+        if last or len(body) >= OGG_PAGE_SIZE:
+            pages += _page(header_type | (OGG_EOS if last and eos else 0), granule, serial, sequence, lacing, body)
+            sequence += 1
+            header_type = 0
+            lacing, body, granule = [], bytearray(), -1
+
+    return bytes(pages), sequence
+
+
+def write_opus(head: bytes, tags: bytes, packets: Sequence[bytes], samples: int, serial: int = 1) -> bytes:
+    """
+    Собирает Ogg Opus поток: OpusHead и OpusTags на отдельных страницах, затем пакеты.
+    Granule position считается по длительности пакетов с учетом pre-skip из head, у последней страницы
+    она равна pre-skip + samples: декодер отрежет хвост последнего пакета, который длиннее samples.
+    """
+    pre_skip: int = struct.unpack_from('<H', head, 10)[0]
+    granules: List[int] = []
+    total: int = 0
+    for packet in packets:
+        total += opus_packet_samples(packet)
+        granules.append(total)
+    if granules:
+        granules[-1] = pre_skip + samples
+
+    head_page, sequence = _paginate([head], [0], serial, 0, header_type=OGG_BOS)
+    tags_pages, sequence = _paginate([tags], [0], serial, sequence)
+    audio_pages, _ = _paginate(packets, granules, serial, sequence, eos=True)
+    return head_page + tags_pages + audio_pages
@@ -0,0 +1,100 @@
+import asyncio
+from collections import OrderedDict
+import logging
+from logging import Logger
+import time
+from typing import Optional
+
+from app.config import (
+    DEBUGLEVEL,
+    TG_CHAT_BURST,
+    TG_CHAT_RATE,
+    TG_GLOBAL_BURST,
+    TG_GLOBAL_RATE,
+)
+from app.metrics import metrics
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+class TokenBucket:
+    """
+    Token bucket: rate токенов в секунду, не больше capacity накопленных.
+    Ожидающие обслуживаются по очереди (FIFO) через lock, чтобы поздний запрос не обогнал ранний.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = max(1.0, capacity)
+        self.tokens: float = self.capacity
+        self.updated: float = time.monotonic()
+        # Lock создается при первом ожидании: в python 3.8 он привязывается к текущему event loop.
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self):
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self) -> bool:
+        """Бакет полон и его никто не ждет: его можно выбросить, новый будет таким же."""
+        self._refill()
+        return self.tokens >= self.capacity and not (self._lock and self._lock.locked())
+
+    async def acquire(self):
+        if not self._lock:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class SendRateLimiter:
+    """
+    Лимиты Telegram на отправку сообщений: общий на бота (около 30 в секунду) и на один чат (около 1 в секунду,
+    короткие всплески допустимы). Каждый send-запрос к API берет токен из общего бакета и из бакета чата.
+    Лимиты действуют в пределах процесса: при нескольких процессах (media воркеры) TG_GLOBAL_RATE делится между ними.
+    Бакеты чатов хранятся в LRU, простаивающие выбрасываются.
+    """
+    def __init__(
+            self,
+            global_rate: float = TG_GLOBAL_RATE,
+            global_burst: float = TG_GLOBAL_BURST,
+            chat_rate: float = TG_CHAT_RATE,
+            chat_burst: float = TG_CHAT_BURST,
+            max_chats: int = 10000,
+    ):
+        self.global_bucket: TokenBucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate: float = chat_rate
+        self.chat_burst: float = chat_burst
+        self.max_chats: int = max_chats
+        self.chats: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+
+        metrics.gauge('ratelimit.chats', lambda: len(self.chats))
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket: Optional[TokenBucket] = self.chats.get(chat_id)
+        if bucket:
+            self.chats.move_to_end(chat_id)
+            return bucket
+
+        if len(self.chats) >= self.max_chats:
+            for key in [key for key, value in self.chats.items() if value.idle]:
+                del self.chats[key]
+
+        bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id: int):
+        started: float = time.monotonic()
+        # Сначала чат: запрос, который ждет свой чат, не должен держать токен общего бакета.
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+        metrics.timing('ratelimit.wait').observe(time.monotonic() - started)
+
+
+send_limiter: SendRateLimiter = SendRateLimiter()
@@ -0,0 +1,121 @@
+import asyncio
+from asyncio import Future
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import logging
+from logging import Logger
+import time
+from typing import Deque, Tuple
+
+from app.config import CPU_BUDGET, DEBUGLEVEL
+from app.metrics import metrics
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+# Сколько единиц бюджета текущий джоб уже держит через CPUScheduler.reserve.
+reserved_weight: ContextVar[int] = ContextVar('reserved_weight', default=0)
+
+
+class CPUScheduler:
+    """
+    Process-wide ограничитель одновременных ffmpeg/ffprobe подпроцессов.
+    У процесса есть бюджет CPU в условных единицах (CPU_BUDGET), каждая команда занимает weight единиц
+    (см. ACTION_CPU_WEIGHTS). Команды, которые не влезают в бюджет, ждут в FIFO очереди.
+    Очередь строгая: тяжелый джоб в голове очереди не обгоняется легкими, иначе он может ждать вечно.
+    Глубина очереди, занятый бюджет и время ожидания доступны в metrics под префиксом scheduler.
+    """
+    def __init__(self, budget: int):
+        self.budget: int = max(1, budget)
+        self.in_use: int = 0
+        self._waiters: Deque[Tuple[int, Future]] = deque()
+
+        metrics.gauge('scheduler.queue_depth', lambda: self.depth)
+        metrics.gauge('scheduler.in_use', lambda: self.in_use)
+        metrics.gauge('scheduler.budget', lambda: self.budget)
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for _, waiter in self._waiters if not waiter.done())
+
+    def _weight(self, weight: int) -> int:
+        # Команда тяжелее всего бюджета все равно должна иметь возможность выполниться: одна, на весь бюджет.
+        return min(max(1, weight), self.budget)
+
+    async def acquire(self, weight: int) -> int:
+        weight = self._weight(weight)
+        started: float = time.monotonic()
+
+        if not self._waiters and self.in_use + weight <= self.budget:
+            self.in_use += weight
+        else:
+            waiter: Future = asyncio.get_event_loop().create_future()
+            self._waiters.append((weight, waiter))
+            log.debug(f'CPU budget exhausted ({self.in_use}/{self.budget}), queued job of weight {weight}.')
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Бюджет мог быть уже выдан этому waiter'у до отмены: вернем его.
+                if waiter.done() and not waiter.cancelled():
+                    self.release(weight)
+                self._wake()
+                raise
+
+        waited: float = time.monotonic() - started
+        metrics.timing('scheduler.wait').observe(waited)
+        if waited > 1:
+            log.info(f'Job of weight {weight} waited {waited:.2f}s for CPU budget.')
+        return weight
+
+    def release(self, weight: int):
+        self.in_use -= self._weight(weight)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            weight, waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+                continue
+            if self.in_use + weight > self.budget:
+                break
+            self._waiters.popleft()
+            self.in_use += weight
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, weight: int):
+        if reserved_weight.get() >= self._weight(weight):
+            # Бюджет уже занят заранее через reserve.
+            yield
+            return
+
+        await self.acquire(weight)
+        try:
+            yield
+        finally:
+            self.release(weight)
+
+    @asynccontextmanager
+    async def reserve(self, weight: int):
+        """
+        Занимает weight единиц бюджета на весь блок: команды внутри блока (slot не тяжелее) бюджет уже не ждут.
+        Нужно, когда ffmpeg читает вход из открытого HTTP скачивания или пишет в тело HTTP загрузки:
+        ожидание бюджета должно случиться до открытия запроса, иначе очередь превращается в таймауты передачи.
+        weight 0 - ничего не занимать.
+        """
+        if not weight or reserved_weight.get() >= self._weight(weight):
+            yield
+            return
+
+        weight = await self.acquire(weight)
+        token = reserved_weight.set(weight)
+        try:
+            yield
+        finally:
+            reserved_weight.reset(token)
+            self.release(weight)
+
+
+cpu_scheduler: CPUScheduler = CPUScheduler(CPU_BUDGET)
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from logging import Logger
+import time
+from typing import List, Optional
+
+from app.config import DEBUGLEVEL, SENDER_QUEUE_SIZE, SENDER_WORKERS
+from app.exceptions.base import SoundHoundError
+from app.metrics import metrics
+from app.tg_api import TelegramAPI
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+class BackgroundSender:
+    """
+    Фоновая отправка текстовых сообщений в Telegram, чтобы webhook никогда не ждал Telegram API.
+    Webhook кладет пачку sendMessage параметров одного update в ограниченную очередь и сразу отвечает.
+    Пачка отправляется одним воркером по порядку. Если очередь переполнена, пачка отбрасывается:
+    лучше потерять ответ, чем задерживать прием update'ов.
+    """
+    def __init__(
+            self,
+            tg_api: TelegramAPI,
+            workers: Optional[int] = SENDER_WORKERS,
+            queue_size: Optional[int] = SENDER_QUEUE_SIZE,
+    ):
+        self.tg_api: TelegramAPI = tg_api
+        self.workers: int = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+
+        metrics.gauge('sender.queue_depth', self.queue.qsize)
+
+    def submit(self, messages: List[dict]) -> bool:
+        try:
+            self.queue.put_nowait(messages)
+        except asyncio.QueueFull:
+            metrics.incr('sender.dropped')
+            log.error(f'Sender queue is full, {len(messages)} message(s) dropped.')
+            return False
+        return True
+
+    async def _work(self):
+        while True:
+            messages: List[dict] = await self.queue.get()
+            started: float = time.monotonic()
+            try:
+                await self.tg_api.send_messages(messages)
+            except SoundHoundError as exc:
+                metrics.incr('sender.failed')
+                log.error(f'Background send failed: {exc.err_msg}')
+            except Exception:
+                metrics.incr('sender.failed')
+                log.exception('Background send failed.')
+            finally:
+                metrics.timing('sender.send').observe(time.monotonic() - started)
+                self.queue.task_done()
+
+    async def start(self, *_):
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, *_):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        log.debug('Background sender is stopped')
@@ -0,0 +1,143 @@
+"""
+Быстрый разбор входящего update без полной схемы Update.
+
+Полная marshmallow схема проходит по всему Message: Chat, reply_to_message, pinned_message, entities,
+Timestamp и т.д. Боту из этого нужны только отправитель, текст, данные кнопки и файловые объекты.
+parse_update проверяет типы и достает только эти поля. Ошибки - тот же marshmallow ValidationError,
+что и у Update().load, поэтому webhook обрабатывает их одинаково.
+Для отладки полной схемой см. FULL_UPDATE_SCHEMA в config.py.
+"""
+from typing import Any, Dict, FrozenSet, Optional, Type
+
+from marshmallow import Schema
+from marshmallow.exceptions import ValidationError
+from marshmallow.fields import Boolean, Field, Integer, List, Nested, String
+
+from app.serializers.telegram import (
+    Animation,
+    Audio,
+    Document,
+    Message,
+    PhotoSize,
+    Update,
+    User,
+    Video,
+    Voice,
+)
+
+FIELD_TYPES: Dict[Type[Field], tuple] = {
+    Integer: (int,),
+    String: (str,),
+    Boolean: (bool,),
+    Nested: (dict,),
+    List: (list,),
+}
+MESSAGE_MEDIA: Dict[str, Type[Schema]] = {
+    'audio': Audio,
+    'voice': Voice,
+    'document': Document,
+    'video': Video,
+    'animation': Animation,
+}
+# Поля Message со схемами-заглушками: полная схема отвергает их содержимое, значит и мы тоже.
+UNSUPPORTED_MESSAGE_KEYS: FrozenSet[str] = frozenset((
+    'game', 'sticker', 'video_note', 'contact', 'location', 'venue', 'poll', 'invoice', 'successful_payment',
+    'passport_data',
+))
+
+
+def _data_keys(schema: Type[Schema]) -> FrozenSet[str]:
+    return frozenset(field.data_key or name for name, field in schema._declared_fields.items())
+
+
+UPDATE_KEYS: FrozenSet[str] = _data_keys(Update)
+MESSAGE_KEYS: FrozenSet[str] = _data_keys(Message)
+
+
+def _check(value: Any, types: tuple, path: str):
+    # bool - подкласс int, а в Telegram API это разные типы.
+    if not isinstance(value, types) or (bool not in types and isinstance(value, bool)):
+        raise ValidationError({path: [f'Invalid type: expected {types[0].__name__}.']})
+
+
+def _pick(data: Any, schema: Type[Schema], path: str) -> dict:
+    """Копирует из data только объявленные в schema поля, проверяя их типы. Вложенные объекты не разбирает."""
+    _check(data, (dict,), path)
+    result: dict = {}
+    for name, field in schema._declared_fields.items():
+        key: str = field.data_key or name
+        if key not in data:
+            continue
+        types: Optional[tuple] = FIELD_TYPES.get(type(field))
+        if types:
+            _check(data[key], types, f'{path}.{key}')
+        result[key] = data[key]
+    return result
+
+
+def _parse_message(data: Any, path: str) -> dict:
+    _check(data, (dict,), path)
+
+    unknown = set(data) - MESSAGE_KEYS
+    if unknown:
+        raise ValidationError({path: [f'Unknown field(s): {sorted(unknown)}']})
+    unsupported = UNSUPPORTED_MESSAGE_KEYS.intersection(data)
+    if unsupported:
+        raise ValidationError({path: [f'Unsupported content: {sorted(unsupported)}']})
+
+    message: dict = {}
+    if 'message_id' in data:
+        _check(data['message_id'], (int,), f'{path}.message_id')
+        message['message_id'] = data['message_id']
+    if 'from' in data:
+        message['from'] = _pick(data['from'], User, f'{path}.from')
+    if 'chat' in data:
+        _check(data['chat'], (dict,), f'{path}.chat')
+        message['chat'] = {key: data['chat'][key] for key in ('id', 'type') if key in data['chat']}
+    if 'text' in data:
+        _check(data['text'], (str,), f'{path}.text')
+        message['text'] = data['text']
+    for key, schema in MESSAGE_MEDIA.items():
+        if key in data:
+            message[key] = _pick(data[key], schema, f'{path}.{key}')
+    if 'photo' in data:
+        _check(data['photo'], (list,), f'{path}.photo')
+        message['photo'] = [_pick(size, PhotoSize, f'{path}.photo') for size in data['photo']]
+
+    return message
+
+
+def parse_update(data: Any) -> dict:
+    """
+    Возвращает update в том же виде, что и Update().load, но только с полями, которые использует бот:
+    message (from, chat, text, файлы) и callback_query (from, data, message).
+    """
+    _check(data, (dict,), 'update')
+
+    unknown = set(data) - UPDATE_KEYS
+    if unknown:
+        raise ValidationError({'update': [f'Unknown field(s): {sorted(unknown)}']})
+
+    update: dict = {}
+    if 'update_id' in data:
+        _check(data['update_id'], (int,), 'update.update_id')
+        update['update_id'] = data['update_id']
+    if 'message' in data:
+        update['message'] = _parse_message(data['message'], 'message')
+    if 'callback_query' in data:
+        query: Any = data['callback_query']
+        _check(query, (dict,), 'callback_query')
+        callback_query: dict = {}
+        if 'id' in query:
+            _check(query['id'], (str,), 'callback_query.id')
+            callback_query['id'] = query['id']
+        if 'from' in query:
+            callback_query['from'] = _pick(query['from'], User, 'callback_query.from')
+        if 'data' in query:
+            _check(query['data'], (str,), 'callback_query.data')
+            callback_query['data'] = query['data']
+        if 'message' in query:
+            callback_query['message'] = _parse_message(query['message'], 'callback_query.message')
+        update['callback_query'] = callback_query
+
+    return update
@@ -1,15 +1,26 @@
 from dataclasses import dataclass, field
-from typing import Any, Dict
+import pickle
+from typing import Any, Dict, List
 from typing import Tuple as Tuple
 
-from marshmallow import Schema
+import msgpack
+from marshmallow import Schema, ValidationError
 from marshmallow.fields import Boolean
 from marshmallow.fields import Dict as DictField
 from marshmallow.fields import Integer, String
+from marshmallow.fields import List as ListField
 from marshmallow.fields import Tuple as TupleField
 
 from app.serializers.utils import BytesField
 
+# Первый байт закодированного стейта. Старый формат (pickle) всегда начинается с 0x80.
+STATE_CODEC_VERSION: int = 1
+PICKLE_PROTO_BYTE: int = 0x80
+
+SCALAR_FIELDS: Tuple[str] = ('id', 'action', 'actions_sent', 'time_range', 'audio_metadata')
+# Байтовые поля хранятся отдельными ключами redis и загружаются только когда нужны.
+BLOB_FIELDS: Tuple[str] = ('audio_file', 'thumbnail_file', 'tg_thumbnail_file')
+
 
 @dataclass
 class UserStateModel:
@@ -21,6 +32,11 @@ class UserStateModel:
     audio_file: bytes = None
     thumbnail_file: bytes = None
     tg_thumbnail_file: bytes = None
+    # Имена байтовых полей, которые сохранены в redis отдельно от стейта (см. BLOB_FIELDS).
+    blobs: List[str] = field(default_factory=list)
+
+    def has_blob(self, name: str) -> bool:
+        return name in self.blobs or getattr(self, name) is not None
 
 
 class UserStateSchema(Schema):
@@ -32,3 +48,45 @@ class UserStateSchema(Schema):
     audio_file = BytesField(required=False, allow_none=True)
     thumbnail_file = BytesField(required=False, allow_none=True)
     tg_thumbnail_file = BytesField(required=False, allow_none=True)
+    blobs = ListField(String(), required=False)
+
+
+# Схема только для скалярных полей: байтовые поля не проходят через marshmallow (и asdict), он копирует их целиком.
+scalar_schema: UserStateSchema = UserStateSchema(only=SCALAR_FIELDS + ('blobs',))
+
+
+def encode_state(user_state: UserStateModel) -> Tuple[bytes, Dict[str, bytes]]:
+    """
+    Кодирует скалярные поля стейта в msgpack с байтом версии впереди.
+    Возвращает закодированный стейт и словарь байтовых полей, которые нужно записать в отдельные ключи.
+    Валидность скалярных полей проверяется scalar_schema только здесь, при записи. У байтовых - только тип.
+    Чтение не валидирует повторно.
+    """
+    blobs: Dict[str, bytes] = {name: getattr(user_state, name) for name in BLOB_FIELDS if getattr(user_state, name)}
+    for name, value in blobs.items():
+        if not isinstance(value, bytes):
+            raise ValidationError({name: ['Invalid input type.']})
+
+    payload: Dict[str, Any] = {name: getattr(user_state, name) for name in SCALAR_FIELDS}
+    payload['blobs'] = sorted(set(user_state.blobs) | set(blobs))
+    scalar_schema.load(payload)
+
+    return bytes((STATE_CODEC_VERSION,)) + msgpack.packb(payload, use_bin_type=True), blobs
+
+
+def decode_state(data: bytes) -> UserStateModel:
+    """
+    Декодирует стейт без байтовых полей: они остаются None до явной загрузки, их имена лежат в blobs.
+    Стейт старого формата (pickle) читается целиком через UserStateSchema, как раньше.
+    """
+    if data[0] == PICKLE_PROTO_BYTE:
+        return UserStateModel(**UserStateSchema().load(pickle.loads(data)))
+
+    if data[0] != STATE_CODEC_VERSION:
+        raise ValueError(f'Unknown user state codec version: {data[0]}')
+
+    payload: Dict[str, Any] = msgpack.unpackb(data[1:], raw=False)
+    if payload.get('time_range'):
+        payload['time_range'] = tuple(payload['time_range'])
+
+    return UserStateModel(**payload)
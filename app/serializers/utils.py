@@ -5,7 +5,7 @@ from logging import Logger
 from marshmallow.fields import DateTime, Field, ValidationError
 
 log: Logger = logging.getLogger(__name__)
-logging.basicConfig(level='debug')
+logging.basicConfig(level='DEBUG')
 
 
 class Timestamp(DateTime):
@@ -0,0 +1,132 @@
+import logging
+from logging import Logger
+from typing import Dict, List, Optional, Tuple
+
+from aioredis import WatchVariableError
+from aioredis.commands import Redis
+
+from app.config import DEBUGLEVEL, STATE_BLOB_TTL, STATE_TTL
+from app.lease import UserLease
+from app.serializers.user_state import BLOB_FIELDS, UserStateModel, decode_state, encode_state
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+class StateSession:
+    """
+    Unit of work над стейтом пользователя в рамках одного dispatch.
+    Стейт читается из redis один раз, при первом обращении. Изменения (set/clear) копятся в памяти
+    и записываются одной транзакцией MULTI/EXEC в flush(), вместе с освобождением lease пользователя,
+    и только пока lease принадлежит этому джобу.
+    Байтовые поля стейта (картинки) дочитываются отдельно и только по запросу: load_blobs().
+    Каждый flush продлевает idle TTL стейта: STATE_TTL, или более короткий STATE_BLOB_TTL для стейта с картинками.
+    """
+    def __init__(self, redis_conn: Redis, user_id: int):
+        self.redis: Redis = redis_conn
+        self.user_id: int = user_id
+        self._state: Optional[UserStateModel] = None
+        self._loaded: bool = False
+        self._dirty: bool = False
+        self._cleared: bool = False
+
+    @property
+    def state_key(self) -> str:
+        return f'{self.user_id}-state'
+
+    def blob_key(self, name: str) -> str:
+        return f'{self.user_id}-state-{name}'
+
+    async def get(self) -> Optional[UserStateModel]:
+        """Стейт пользователя без байтовых полей или None, если диалог еще не начат."""
+        if not self._loaded:
+            with await self.redis as redis_conn:
+                binary_data: Optional[bytes] = await redis_conn.get(self.state_key)
+            self._state = decode_state(binary_data) if binary_data else None
+            self._loaded = True
+        return self._state
+
+    def set(self, user_state: UserStateModel):
+        self._state = user_state
+        self._loaded = True
+        self._dirty = True
+
+    @staticmethod
+    def ttl_for(user_state: UserStateModel) -> int:
+        return STATE_BLOB_TTL if user_state.blobs or any(getattr(user_state, n) for n in BLOB_FIELDS) else STATE_TTL
+
+    def clear(self):
+        """Удаляет стейт вместе с байтовыми полями. Последующий set() в этой же сессии запишется после удаления."""
+        self._state = None
+        self._loaded = True
+        self._dirty = False
+        self._cleared = True
+
+    async def load_blobs(self, user_state: UserStateModel, names: Tuple[str]):
+        """Дочитывает в user_state байтовые поля, сохраненные отдельными ключами. Одним MGET."""
+        names = tuple(name for name in names if name in user_state.blobs and getattr(user_state, name) is None)
+        if not names:
+            return
+
+        with await self.redis as redis_conn:
+            values: List[Optional[bytes]] = await redis_conn.mget(*[self.blob_key(name) for name in names])
+
+        for name, value in zip(names, values):
+            setattr(user_state, name, value)
+
+    async def flush(self, lease: Optional[UserLease] = None, lease_token: Optional[str] = None):
+        """
+        Записывает накопленные изменения стейта, продлевает его TTL и снимает lease одной транзакцией.
+        С lease транзакция условная (WATCH на ключ lease): если lease уже перехватили (/start), изменения
+        этого джоба отбрасываются и не перетирают стейт нового владельца.
+        Если стейт не сериализуется, изменения тоже отбрасываются, а lease все равно снимается.
+        Если стейт не читался, не менялся и lease не передан - в redis не ходит.
+        """
+        if not (self._cleared or self._dirty or self._state or lease_token):
+            return
+
+        owned: bool = bool(lease and lease_token)
+        encoded: Optional[Tuple[bytes, Dict[str, bytes]]] = None
+        if self._dirty and self._state:
+            try:
+                encoded = encode_state(self._state)
+            except Exception as exc:
+                log.error(f'Unable to encode state for user {self.user_id}, changes dropped: {exc!r}')
+                self._state, self._cleared, self._dirty = None, False, False
+                if owned:
+                    await lease.release(self.user_id, lease_token)
+                return
+
+        with await self.redis as redis_conn:
+            if owned and not await lease.watch(redis_conn, self.user_id, lease_token):
+                log.warning(f'Lease for user {self.user_id} was already lost, state changes dropped.')
+                self._cleared = False
+                self._dirty = False
+                return
+
+            transaction = redis_conn.multi_exec()
+            if self._cleared:
+                transaction.delete(self.state_key, *[self.blob_key(name) for name in BLOB_FIELDS])
+            if encoded:
+                state: bytes
+                blobs: Dict[str, bytes]
+                state, blobs = encoded
+                transaction.mset(
+                    self.state_key, state,
+                    *[item for name, value in blobs.items() for item in (self.blob_key(name), value)],
+                )
+            if self._state:
+                ttl: int = self.ttl_for(self._state)
+                transaction.expire(self.state_key, ttl)
+                for name in set(self._state.blobs) | {n for n in BLOB_FIELDS if getattr(self._state, n)}:
+                    transaction.expire(self.blob_key(name), ttl)
+            if owned:
+                lease.release_in(transaction, self.user_id)
+            try:
+                await transaction.execute()
+            except WatchVariableError:
+                log.warning(f'Lease for user {self.user_id} was taken over during flush, state changes dropped.')
+
+        self._cleared = False
+        self._dirty = False
+        log.debug(f'State for {self.user_id} flushed.')
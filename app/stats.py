@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from logging import Logger
+import os
+import socket
+import time
+from typing import Dict, Optional
+
+from aiohttp.web import Response, View, json_response
+from aioredis.commands import Redis
+
+from app import codec
+from app.config import DEBUGLEVEL, METRICS_KEY, METRICS_PUBLISH_INTERVAL
+from app.metrics import metrics
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+class MetricsPublisher:
+    """
+    Метрики живут в памяти процесса, а /stats/ отдает только gunicorn воркер. Поэтому каждый процесс
+    (gunicorn воркеры и media воркеры) раз в interval секунд пишет свой снимок в redis hash METRICS_KEY,
+    поле - имя процесса. Снимки, которые давно не обновлялись (процесс умер), /stats/ удаляет.
+    """
+    def __init__(self, redis: Redis, role: str, interval: int = METRICS_PUBLISH_INTERVAL):
+        self.redis: Redis = redis
+        self.source: str = f'{role}:{socket.gethostname()}:{os.getpid()}'
+        self.interval: int = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def publish(self):
+        snapshot: dict = {**metrics.snapshot(), 'published': time.time()}
+        await self.redis.hset(METRICS_KEY, self.source, codec.dumps(snapshot))
+
+    async def _run(self):
+        while True:
+            try:
+                await self.publish()
+            except Exception as exc:
+                log.warning(f'Unable to publish metrics: {exc}')
+            await asyncio.sleep(self.interval)
+
+    async def start(self, *_):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, *_):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        try:
+            await self.redis.hdel(METRICS_KEY, self.source)
+        except Exception as exc:
+            log.warning(f'Unable to remove published metrics: {exc}')
+
+    async def collect(self) -> Dict[str, dict]:
+        """Снимки всех живых процессов. Снимок своего процесса берется текущий, а не последний опубликованный."""
+        published: Dict[str, str] = await self.redis.hgetall(METRICS_KEY, encoding='utf-8')
+        snapshots: Dict[str, dict] = {}
+        stale: list = []
+        deadline: float = time.time() - 3 * self.interval
+        for source, value in published.items():
+            snapshot: dict = codec.loads(value)
+            if snapshot.get('published', 0) < deadline:
+                stale.append(source)
+            else:
+                snapshots[source] = snapshot
+        if stale:
+            await self.redis.hdel(METRICS_KEY, *stale)
+
+        snapshots[self.source] = {**metrics.snapshot(), 'published': time.time()}
+        return snapshots
+
+
+def aggregate(snapshots: Dict[str, dict]) -> dict:
+    """
+    Сумма по процессам: counters и gauges складываются, у timings складывается count, avg взвешивается
+    по count, max и p99 - максимум по процессам (для p99 это оценка сверху). p50 по процессам не сводится.
+    """
+    total: dict = {'timings': {}, 'counters': {}, 'gauges': {}}
+    for snapshot in snapshots.values():
+        for group in ('counters', 'gauges'):
+            for name, value in snapshot.get(group, {}).items():
+                total[group][name] = total[group].get(name, 0) + value
+
+        for name, stats in snapshot.get('timings', {}).items():
+            merged: dict = total['timings'].setdefault(name, {'count': 0, 'avg': 0.0, 'max': 0.0, 'p99': 0.0})
+            count: int = merged['count'] + stats['count']
+            if count:
+                merged['avg'] = (merged['avg'] * merged['count'] + stats['avg'] * stats['count']) / count
+            merged['count'] = count
+            merged['max'] = max(merged['max'], stats['max'])
+            merged['p99'] = max(merged['p99'], stats['p99'])
+    return total
+
+
+class StatsHandler(View):
+    """
+    Отдает метрики всех процессов бота: очереди, времена ожидания, счетчики.
+    total - сумма по процессам (см. aggregate), processes - снимок каждого процесса.
+    """
+    async def get(self) -> Response:
+        snapshots: Dict[str, dict] = await self.request.app['metrics_publisher'].collect()
+        return json_response({'total': aggregate(snapshots), 'processes': snapshots}, dumps=codec.dumps)
@@ -1,28 +1,95 @@
+import asyncio
 from concurrent.futures import CancelledError
-from io import BytesIO
-import json
+from contextlib import asynccontextmanager
+from functools import lru_cache
 import logging
 import os
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-from aiohttp import ClientConnectorError, ClientSession, ContentTypeError
+from aiohttp import (
+    ClientConnectorError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    ContentTypeError,
+    TCPConnector,
+)
 from aiohttp.formdata import FormData
 
+from app import codec
+from app.actions_dict import action_buttons
+from app.cache import FileMetaCache
 from app.config import (
     DEBUGLEVEL,
+    PROBE_PREFIX_SIZE,
     PUBLIC_PORT,
+    RANGE_DOWNLOAD_PARTS,
+    RANGE_DOWNLOAD_THRESHOLD,
     SERVER_NAME,
-    SIZE_20MB,
-    SIZE_50MB,
+    SIZE_1MB,
+    STREAM_CHUNK_SIZE,
+    TG_API_BASE_URL,
+    TG_API_CONNECTIONS,
+    TG_API_TIMEOUT,
+    TG_DNS_CACHE_TTL,
+    TG_DOWNLOAD_LIMIT,
+    TG_FILE_CONNECTIONS,
+    TG_FILE_TIMEOUT,
+    TG_KEEPALIVE_TIMEOUT,
+    TG_LOCAL_MODE,
+    TG_MAX_RETRIES,
+    TG_UPLOAD_LIMIT,
     TOKEN,
 )
+from app.exceptions.base import SoundHoundError
 from app.exceptions.tg_api import FileError, TGApiError, TGNetworkError
+from app.metrics import metrics
+from app.ratelimit import SendRateLimiter, send_limiter
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=DEBUGLEVEL)
 
 
+@lru_cache(maxsize=64)
+def encode_keyboard(buttons: Tuple[Tuple[str, str], ...]) -> str:
+    """Telegram Inline Keyboard по кнопкам ('id кнопки', 'title кнопки'). Набор клавиатур бота мал, кэшируем."""
+    return codec.dumps({
+        'inline_keyboard': [[{"callback_data": k[0], "text": k[1]}] for k in buttons]
+    })
+
+
+# Клавиатура со списком действий одна для всех пользователей: кодируется один раз при импорте.
+encode_keyboard(action_buttons)
+
+
+def create_api_session() -> ClientSession:
+    """HTTP клиент для вызовов методов Bot API: короткие таймауты, keep-alive пул с кэшем DNS."""
+    return ClientSession(
+        connector=TCPConnector(
+            limit=TG_API_CONNECTIONS, ttl_dns_cache=TG_DNS_CACHE_TTL, keepalive_timeout=TG_KEEPALIVE_TIMEOUT,
+        ),
+        timeout=ClientTimeout(total=TG_API_TIMEOUT, connect=10),
+        trust_env=True,
+    )
+
+
+def create_file_session() -> ClientSession:
+    """HTTP клиент для скачивания и загрузки файлов: свой пул, чтобы большие передачи не занимали соединения API."""
+    return ClientSession(
+        connector=TCPConnector(
+            limit=TG_FILE_CONNECTIONS, ttl_dns_cache=TG_DNS_CACHE_TTL, keepalive_timeout=TG_KEEPALIVE_TIMEOUT,
+        ),
+        # Без общего таймаута: большой файл или ffmpeg, кодирующий тело загрузки, законно идут долго.
+        # Ограничено время без данных от сервера.
+        timeout=ClientTimeout(total=None, connect=10, sock_read=TG_FILE_TIMEOUT),
+        trust_env=True,
+    )
+
+
 class TelegramAPI:
     audio_suffix_mimetype_map = {
         'audio/mpeg': '.mp3',
@@ -42,42 +109,96 @@ class TelegramAPI:
         'video/mp4': '.mp4',
         'video/x-msvideo': '.avi',
     }
+    # Поле с файлом в Message -> метод, которым этот файл можно переслать по file_id.
+    resend_methods = {
+        'audio': 'sendAudio',
+        'voice': 'sendVoice',
+        'video_note': 'sendVideoNote',
+        'document': 'sendDocument',
+    }
     webhook_url: str = f'https://{SERVER_NAME}:{PUBLIC_PORT}/webhook/'
     token: str = TOKEN
-    api_url: str = f'https://api.telegram.org/bot{TOKEN}/'
+    api_url: str = f'{TG_API_BASE_URL}/bot{TOKEN}/'
+    file_url: str = f'{TG_API_BASE_URL}/file/bot{TOKEN}/'
+
+    # Методы отправки в чат: на них действуют лимиты Telegram, см. SendRateLimiter.
+    send_methods = frozenset(('sendMessage', 'sendAudio', 'sendVoice', 'sendVideoNote', 'sendDocument'))
 
-    def __init__(self, http_client_session: ClientSession):
+    def __init__(
+            self,
+            http_client_session: ClientSession,
+            file_client_session: Optional[ClientSession] = None,
+            limiter: Optional[SendRateLimiter] = None,
+            file_meta_cache: Optional[FileMetaCache] = None,
+    ):
         self.session: ClientSession = http_client_session
+        # Скачивание и загрузка файлов идут через отдельный пул со своими таймаутами.
+        self.file_session: ClientSession = file_client_session or http_client_session
+        self.limiter: SendRateLimiter = limiter or send_limiter
+        self.file_meta_cache: Optional[FileMetaCache] = file_meta_cache
 
     async def _request(
             self,
             path: str,
             method: Optional[str] = 'get',
             params: Optional[Dict[str, Any]] = None,
-            form_data: Optional[Dict[str, Any]] = None,
+            form_data: Optional[Union[FormData, Callable[[], FormData]]] = None,
     ) -> dict:
-        """Внутренний метод реализующий запрос к Telegram API. Другие методы используют его. Кроме зарузки файла."""
+        """
+        Внутренний метод реализующий запрос к Telegram API. Другие методы используют его. Кроме зарузки файла.
+        Send-методы ждут токен SendRateLimiter. На 429 запрос повторяется через parameters.retry_after
+        (со случайной добавкой, чтобы повторы не пришли разом), не больше TG_MAX_RETRIES раз.
+        Тело FormData читается один раз: запрос с телом повторяется, только если form_data - функция, собирающая его.
+        """
+        attempt: int = 0
+        while True:
+            if path in self.send_methods and params and params.get('chat_id'):
+                await self.limiter.acquire(int(params['chat_id']))
+
+            resp: dict = await self._send(path, method, params, form_data() if callable(form_data) else form_data)
+            if resp.get('ok'):
+                return resp['result']
+
+            retry_after: Optional[int] = (resp.get('parameters') or {}).get('retry_after')
+            replayable: bool = form_data is None or callable(form_data)
+            if resp.get('error_code') == 429 and retry_after and replayable and attempt < TG_MAX_RETRIES:
+                attempt += 1
+                metrics.incr('tg_api.retry_after')
+                delay: float = retry_after + random.uniform(0, 1 + retry_after * 0.1)
+                log.warning(f'Telegram API flood limit on {path}, retry {attempt} in {delay:.1f}s.')
+                await asyncio.sleep(delay)
+                continue
+
+            log.error(f"Telegram API returned error: {resp['error_code']}: {resp['description']}.")
+            raise TGApiError(f"Telegram API returned error: {resp['error_code']}: {resp['description']}.", resp)
+
+    async def _send(
+            self,
+            path: str,
+            method: str,
+            params: Optional[Dict[str, Any]],
+            form_data: Optional[FormData],
+    ) -> dict:
+        """Один HTTP запрос к Telegram API. Возвращает тело ответа как есть, с 'ok' или без."""
         url: str = os.path.join(self.api_url, path)
         debug_extra: dict = {'url': url, 'params': params, 'with_data': True if form_data else False}
         log.debug(f'Request to TG API: {debug_extra}')
+        session: ClientSession = self.file_session if form_data else self.session
         try:
-            async with self.session.request(method=method, url=url, params=params, data=form_data) as response:
+            async with session.request(method=method, url=url, params=params, data=form_data) as response:
                 try:
-                    resp: dict = await response.json()
+                    return await response.json(loads=codec.loads)
                 except ContentTypeError:
                     raise TGApiError('Unable to parse response body', response)
+        except SoundHoundError:
+            # Ошибка из потокового тела запроса: ffmpeg упал или превышен лимит размера.
+            raise
         except (CancelledError, ClientConnectorError) as exc:
             raise TGNetworkError('Request to Telegram API failed due to network issues.', debug_extra, exc)
         except Exception as exc:
             log.error(f'Telegram API request ended with unexpected exception: {exc}.')
             raise TGNetworkError('Request to Telegram API failed.', debug_extra, exc)
 
-        if not resp.get('ok'):
-            log.error(f"Telegram API returned error: {resp['error_code']}: {resp['description']}.")
-            raise TGApiError(f"Telegram API returned error: {resp['error_code']}: {resp['description']}.", resp)
-
-        return resp['result']
-
     async def set_webhook(self) -> str:
         """
         Инициализация вебхука.
@@ -90,39 +211,74 @@ class TelegramAPI:
         return self.webhook_url
 
     @staticmethod
-    def _inline_keyboard_from_buttons(buttons: Optional[List[Tuple[str]]]):
+    def _inline_keyboard_from_buttons(buttons: Optional[Sequence[Tuple[str, str]]]):
         """Принимает list tuple объектов ('id кнопки', 'title кнопки') и возвращает Telegram Inline Keyboard из них."""
         if not buttons:
             return ''
-        return json.dumps({
-            'inline_keyboard': [[{"callback_data": k[0], "text": k[1]}] for k in buttons]
-        })
+        return encode_keyboard(tuple(buttons))
 
-    async def send_message(self, user_id: int, message: str, buttons: Optional[List[Tuple[str]]] = None) -> dict:
-        """Публичный метод отправки текстового сообщения пользователю."""
-        return await self._request(
-            'sendMessage',
-            params={
-                'chat_id': user_id,
-                'text': message,
-                'reply_markup': self._inline_keyboard_from_buttons(buttons),
-                'parse_mode': 'Markdown',
-            }
-        )
+    def message_params(
+            self,
+            user_id: int,
+            message: str,
+            buttons: Optional[Sequence[Tuple[str, str]]] = None,
+    ) -> dict:
+        """Параметры метода sendMessage. Используются и для запроса к API, и для ответа прямо в webhook."""
+        return {
+            'chat_id': user_id,
+            'text': message,
+            'reply_markup': self._inline_keyboard_from_buttons(buttons),
+            'parse_mode': 'Markdown',
+        }
 
-    async def download_file(
+    async def send_message(
             self,
-            meta: dict,
-            file_type: str,
-    ) -> Tuple[bytes, dict]:
+            user_id: int,
+            message: str,
+            buttons: Optional[Sequence[Tuple[str, str]]] = None,
+    ) -> dict:
+        """Публичный метод отправки текстового сообщения пользователю."""
+        return await self._request('sendMessage', params=self.message_params(user_id, message, buttons))
+
+    async def send_messages(self, messages: List[dict]):
+        """Отправляет подготовленные message_params() сообщения строго по очереди."""
+        for params in messages:
+            await self._request('sendMessage', params=params)
+
+    async def _get_file(self, file_id: str) -> dict:
+        """getFile через FileMetaCache, если он подключен."""
+        if self.file_meta_cache:
+            cached: Optional[dict] = await self.file_meta_cache.get(file_id)
+            if cached:
+                return cached
+
+        file_meta: dict = await self._request('getFile', method='post', params={'file_id': file_id})
+        if self.file_meta_cache and file_meta.get('file_path'):
+            await self.file_meta_cache.store(file_id, file_meta)
+        return file_meta
+
+    async def _check_download(self, response: ClientResponse, meta: dict):
+        """Ссылка из getFile могла протухнуть раньше TTL кэша: сбрасываем ее, следующий запрос сделает getFile."""
+        if response.status in (200, 206):
+            return
+        if self.file_meta_cache:
+            await self.file_meta_cache.invalidate(meta['file_id'])
+        raise TGApiError(f'File download returned HTTP {response.status}.', {'status': response.status, **meta})
+
+    async def _get_file_meta(self, meta: dict, file_type: str) -> Tuple[dict, str]:
         """
-        Публичный метод получения файла с серверов Telegram.
-        For the moment, bots can download files of up to 20MB in size.
+        Вызывает getFile, определяет расширение файла и проверяет что оно поддерживается для file_type.
+        Возвращает метаданные файла и URL для скачивания его содержимого,
+        или абсолютный путь к файлу, если Bot API сервер локальный (TG_LOCAL_MODE).
+        For the moment, bots can download files of up to 20MB in size. Локальный сервер - до TG_DOWNLOAD_LIMIT.
         """
-        if meta['file_size'] >= SIZE_20MB:
-            raise FileError('File is too big. File should not exceed 20 Mb to be handled.', meta['file_size'])
+        if meta['file_size'] >= TG_DOWNLOAD_LIMIT:
+            raise FileError(
+                f'File is too big. File should not exceed {TG_DOWNLOAD_LIMIT // SIZE_1MB} Mb to be handled.',
+                meta['file_size'],
+            )
 
-        file_meta: dict = await self._request('getFile', method='post', params={'file_id': meta['file_id']})
+        file_meta: dict = await self._get_file(meta['file_id'])
         file_path: str = file_meta.get('file_path')
 
         file_meta['mime_type'] = meta.get('mime_type')
@@ -151,22 +307,259 @@ class TelegramAPI:
                 }
             )
 
-        url: str = os.path.join(f'https://api.telegram.org/file/bot{self.token}', file_path)
-        buf: BytesIO = BytesIO()
+        if self.is_local_path(file_path):
+            return file_meta, file_path
+        return file_meta, os.path.join(self.file_url, file_path)
+
+    @staticmethod
+    def is_local_path(file_path: str) -> bool:
+        """Локальный Bot API сервер отдает в getFile абсолютный путь, а не относительный путь для скачивания."""
+        return TG_LOCAL_MODE and os.path.isabs(file_path)
+
+    async def download_file(
+            self,
+            meta: dict,
+            file_type: str,
+    ) -> Tuple[Union[bytes, bytearray], dict]:
+        """
+        Публичный метод получения файла с серверов Telegram целиком. С локального сервера - прямо с диска.
+        Большой файл качается параллельными Range запросами, тогда содержимое - bytearray буфера загрузки.
+        """
+        file_meta: dict
+        url: str
+        file_meta, url = await self._get_file_meta(meta, file_type)
+
+        if self.is_local_path(url):
+            return await LocalFileStream(url, file_meta).read(), file_meta
+
+        started: float = time.monotonic()
+        part_size: Optional[int] = self._range_part_size(meta)
+        try:
+            if part_size:
+                content: Union[bytes, bytearray] = await self._download_ranges(url, meta, part_size)
+            else:
+                async with self.file_session.get(url) as response:
+                    await self._check_download(response, meta)
+                    content = await response.read()
+        except SoundHoundError:
+            raise
+        except Exception as exc:
+            raise TGNetworkError('Receiving file content is failed.', file_meta, exc)
+
+        metrics.timing('tg_api.download').observe(time.monotonic() - started)
+        return content, file_meta
+
+    async def download_prefix(
+            self,
+            meta: dict,
+            file_type: str,
+            size: Optional[int] = PROBE_PREFIX_SIZE,
+    ) -> Tuple[bytes, dict]:
+        """
+        Скачивает только первые size байт файла (Range запрос), для проверки файла до полного скачивания.
+        Если сервер не поддерживает Range, ответ обрывается после size байт.
+        getFile для последующего полного скачивания берется из FileMetaCache.
+        """
+        file_meta: dict
+        url: str
+        file_meta, url = await self._get_file_meta(meta, file_type)
+
+        if self.is_local_path(url):
+            def read_prefix() -> bytes:
+                with open(url, 'rb') as file:
+                    return file.read(size)
+            try:
+                return await asyncio.get_event_loop().run_in_executor(None, read_prefix), file_meta
+            except OSError as exc:
+                raise TGNetworkError('Reading local file is failed.', file_meta, exc)
 
+        prefix: bytearray = bytearray()
         try:
-            async with self.session.get(url) as response:
-                buf.write(await response.read())
+            async with self.file_session.get(url, headers={'Range': f'bytes=0-{size - 1}'}) as response:
+                await self._check_download(response, meta)
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    prefix += chunk
+                    if len(prefix) >= size:
+                        break
+        except SoundHoundError:
+            raise
         except Exception as exc:
-            buf.close()
             raise TGNetworkError('Receiving file content is failed.', file_meta, exc)
 
-        return buf.getvalue(), file_meta
+        return bytes(prefix[:size]), file_meta
+
+    @staticmethod
+    def _range_part_size(meta: dict) -> Optional[int]:
+        """Размер части для параллельного скачивания Range запросами или None, если файл качается одним запросом."""
+        if RANGE_DOWNLOAD_PARTS > 1 and meta.get('file_size', 0) >= RANGE_DOWNLOAD_THRESHOLD:
+            return -(-meta['file_size'] // RANGE_DOWNLOAD_PARTS)
+        return None
+
+    async def _download_ranges(self, url: str, meta: dict, part_size: int) -> Union[bytes, bytearray]:
+        """
+        Скачивает файл параллельными Range запросами по part_size байт в заранее выделенный буфер (RangedFileStream)
+        и отдает сам буфер, без копирования. Первый запрос заодно проверяет поддержку Range: если сервер ответил
+        200 а не 206, файл дочитывается из этого же ответа одним потоком.
+        """
+        response: ClientResponse = await self.file_session.get(url, headers={'Range': f'bytes=0-{part_size - 1}'})
+        try:
+            await self._check_download(response, meta)
+            if response.status != 206:
+                metrics.incr('tg_api.download_range_unsupported')
+                return await response.read()
+
+            size: int = self._range_file_size(response, meta, part_size)
+            stream: RangedFileStream = RangedFileStream(self, url, response, meta, part_size, size)
+            try:
+                content: bytearray = await stream.read()
+            finally:
+                await stream.close()
+        finally:
+            response.release()
+
+        metrics.incr('tg_api.download_ranged')
+        return content
+
+    async def _fetch_range(self, url: str, meta: dict, buffer: bytearray, start: int, end: int):
+        try:
+            async with self.file_session.get(url, headers={'Range': f'bytes={start}-{end - 1}'}) as response:
+                await self._check_download(response, meta)
+                if response.status != 206:
+                    raise TGApiError(
+                        'File server stopped honouring Range requests.', {'status': response.status, **meta},
+                    )
+                await self._read_range(response, buffer, start, end)
+        except SoundHoundError:
+            raise
+        except Exception as exc:
+            raise TGNetworkError('Receiving file content is failed.', meta, exc)
+
+    @staticmethod
+    def _range_file_size(response: ClientResponse, meta: dict, part_size: int) -> int:
+        """
+        Размер файла из Content-Range ответа 206 на первую часть: bytes 0-1048575/19922944.
+        По нему выделяется буфер и нарезаются части, поэтому он должен совпасть с file_size из Telegram
+        и не превышать TG_DOWNLOAD_LIMIT. Иначе, как и при неразборчивом заголовке, - TGApiError.
+        """
+        content_range: str = response.headers.get('Content-Range', '')
+        match = re.fullmatch(r'bytes 0-(\d+)/(\d+)', content_range.strip())
+        if not match:
+            raise TGApiError('File server returned malformed Content-Range.', {'content_range': content_range, **meta})
+        size: int = int(match.group(2))
+        if size != meta.get('file_size') or size > TG_DOWNLOAD_LIMIT or int(match.group(1)) != min(part_size, size) - 1:
+            raise TGApiError(
+                'File server returned unexpected Content-Range.',
+                {'content_range': content_range, 'limit': TG_DOWNLOAD_LIMIT, **meta},
+            )
+        return size
+
+    @staticmethod
+    async def _read_range(response: ClientResponse, buffer: bytearray, start: int, end: int):
+        offset: int = start
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            if offset + len(chunk) > end:
+                raise TGApiError('File server returned more bytes than requested.', {'start': start, 'end': end})
+            buffer[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        if offset != end:
+            raise TGApiError('File server returned incomplete range.', {'start': start, 'end': end, 'got': offset})
+
+    async def local_file(self, meta: dict, file_type: str) -> Optional['LocalFileStream']:
+        """Файл на диске локального Bot API сервера (TG_LOCAL_MODE) или None, если файл надо скачивать."""
+        file_meta: dict
+        url: str
+        file_meta, url = await self._get_file_meta(meta, file_type)
+        return LocalFileStream(url, file_meta) if self.is_local_path(url) else None
+
+    async def resolve_file(self, meta: dict, file_type: str) -> Tuple[dict, str]:
+        """Метаданные файла (в т.ч. suffix) и URL для stream_file, без начала скачивания."""
+        return await self._get_file_meta(meta, file_type)
+
+    @asynccontextmanager
+    async def stream_file(
+            self,
+            meta: dict,
+            file_type: str,
+            resolved: Optional[Tuple[dict, str]] = None,
+    ) -> AsyncIterator[Union['FileStream', 'RangedFileStream', 'LocalFileStream']]:
+        """
+        Публичный метод получения файла с серверов Telegram потоком.
+        Отдает FileStream, по которому можно итерироваться чанками, пока файл еще скачивается.
+        Большой файл качается параллельными Range запросами, как в download_file (см. RangedFileStream).
+        Соединения закрываются при выходе из контекста, даже если файл не был дочитан.
+        resolved - результат resolve_file, если он уже получен.
+        """
+        file_meta: dict
+        url: str
+        file_meta, url = resolved or await self._get_file_meta(meta, file_type)
+
+        if self.is_local_path(url):
+            yield LocalFileStream(url, file_meta)
+            return
+
+        part_size: Optional[int] = self._range_part_size(meta)
+        try:
+            response: ClientResponse = await self.file_session.get(
+                url, headers={'Range': f'bytes=0-{part_size - 1}'} if part_size else None,
+            )
+        except Exception as exc:
+            raise TGNetworkError('Receiving file content is failed.', file_meta, exc)
+
+        try:
+            await self._check_download(response, meta)
+            if part_size and response.status == 206:
+                metrics.incr('tg_api.download_ranged')
+                size: int = self._range_file_size(response, meta, part_size)
+                stream: RangedFileStream = RangedFileStream(self, url, response, file_meta, part_size, size)
+                try:
+                    yield stream
+                finally:
+                    await stream.close()
+            else:
+                if part_size:
+                    metrics.incr('tg_api.download_range_unsupported')
+                yield FileStream(response, file_meta)
+        finally:
+            response.release()
+
+    @staticmethod
+    def _limit_upload_size(
+            file_content: Union[bytes, AsyncIterator[bytes]],
+    ) -> Union[bytes, AsyncIterator[bytes]]:
+        """
+        Проверяет лимит размера загружаемого файла. Для байт сразу, для потока - по мере отдачи чанков:
+        поток прерывается FileError, как только лимит превышен, и запрос к Telegram падает вместе с ним.
+        """
+        # TODO: кажется на самом деле свыше около 20 МБ телеграм уже не принимает.
+        if isinstance(file_content, (bytes, bytearray)):
+            if len(file_content) >= TG_UPLOAD_LIMIT:
+                raise FileError(
+                    f'Uploading file size limit exceeded. Size: {len(file_content)}, limit: {TG_UPLOAD_LIMIT}',
+                    {'size': len(file_content), 'limit': TG_UPLOAD_LIMIT}
+                )
+            return file_content
+
+        async def limited() -> AsyncIterator[bytes]:
+            size: int = 0
+            try:
+                async for chunk in file_content:
+                    size += len(chunk)
+                    if size >= TG_UPLOAD_LIMIT:
+                        raise FileError(
+                            f'Uploading file size limit exceeded. Size: {size}, limit: {TG_UPLOAD_LIMIT}',
+                            {'size': size, 'limit': TG_UPLOAD_LIMIT}
+                        )
+                    yield chunk
+            finally:
+                # Закрываем источник явно, чтобы подпроцесс ffmpeg не пережил оборванную загрузку.
+                await file_content.aclose()
+
+        return limited()
 
     async def upload_file(
             self,
             user_id: int,
-            file_content: bytes,
+            file_content: Union[bytes, AsyncIterator[bytes]],
             file_meta: dict,
             as_voice: bool,
             thumbnail: bytes = None,
@@ -174,15 +567,12 @@ class TelegramAPI:
         """
         Публичный метод загрузки файла на сервера Telegram.
         Thumbnail: Шлется только байтами, только если аудиофайл так же шлется байтами, только для метода sendAudio.
+        file_content может быть потоком чанков (stdout ffmpeg): тогда multipart тело отправляется chunked
+        по мере кодирования.
         """
         path: str
         params: dict = {'chat_id': str(user_id), 'duration': int(file_meta.get('duration', 0))}
-        # TODO: кажется на самом деле свыше около 20 МБ телеграм уже не принимает.
-        if len(file_content) >= SIZE_50MB:
-            raise FileError(
-                f'Uploading file size limit exceeded. Size: {len(file_content)}, limit: {SIZE_50MB}',
-                {'size': len(file_content), 'limit': SIZE_50MB}
-            )
+        file_content = self._limit_upload_size(file_content)
 
         suffix: str = self.audio_suffix_mimetype_map[file_meta['mime_type']]
         performer: str = file_meta.get('performer', '')
@@ -194,29 +584,199 @@ class TelegramAPI:
         else:
             filename = f'{file_unique_id}'
 
-        form_data: FormData = FormData(quote_fields=False)
         if as_voice:
             path = 'sendVoice'
-            form_data.add_field('voice', file_content, filename=f"{filename}.ogg", content_type='audio/ogg')
             if thumbnail:
                 log.error('Thumbnails allowed for sendAudio only.')
         else:
             path = 'sendAudio'
             params.update({'performer': performer, 'title': title})
-            form_data.add_field(
-                'audio',
-                file_content,
-                filename=f"{filename}{suffix}",
-                content_type=file_meta['mime_type']
-            )
-            if thumbnail:
-                form_data.add_field('thumb', thumbnail, filename=f"thumb.jpeg", content_type='image/jpeg')
 
-        return await self._request(path, params=params, form_data=form_data)
+        def build_form() -> FormData:
+            form_data: FormData = FormData(quote_fields=False)
+            if as_voice:
+                form_data.add_field('voice', file_content, filename=f"{filename}.ogg", content_type='audio/ogg')
+            else:
+                form_data.add_field(
+                    'audio',
+                    file_content,
+                    filename=f"{filename}{suffix}",
+                    content_type=file_meta['mime_type']
+                )
+                if thumbnail:
+                    form_data.add_field('thumb', thumbnail, filename=f"thumb.jpeg", content_type='image/jpeg')
+            return form_data
+
+        # Байты можно отправить повторно (после 429), поток - только один раз.
+        return await self._request(
+            path, params=params, form_data=build_form if isinstance(file_content, (bytes, bytearray)) else build_form(),
+        )
 
-    async def upload_roundy(self, user_id: int, video: bytes, duration: int, radius: int):
+    async def upload_roundy(
+            self,
+            user_id: int,
+            video: Union[bytes, AsyncIterator[bytes]],
+            duration: int,
+            radius: int,
+    ) -> dict:
         params: dict = {'chat_id': str(user_id), 'duration': duration, 'length': radius}
-        form_data: FormData = FormData(quote_fields=False)
+        video = self._limit_upload_size(video)
         filename: str = 'roundy'
-        form_data.add_field('video_note', video, filename=f"{filename}.mp4", content_type='video/mp4')
-        return await self._request('sendVideoNote', params=params, form_data=form_data)
+
+        def build_form() -> FormData:
+            form_data: FormData = FormData(quote_fields=False)
+            form_data.add_field('video_note', video, filename=f"{filename}.mp4", content_type='video/mp4')
+            return form_data
+
+        return await self._request(
+            'sendVideoNote',
+            params=params,
+            form_data=build_form if isinstance(video, (bytes, bytearray)) else build_form(),
+        )
+
+    def resend_descriptor(self, message: dict) -> Optional[dict]:
+        """
+        По Message, который вернул sendAudio/sendVoice/sendVideoNote, собирает все что нужно для повторной отправки
+        этого же файла по file_id: метод, поле, file_id и параметры. Используется кэшем результатов.
+        """
+        for field, method in self.resend_methods.items():
+            media: Optional[dict] = message.get(field)
+            if not media or not media.get('file_id'):
+                continue
+
+            params: dict = {
+                key: media[key] for key in ('duration', 'performer', 'title', 'length') if media.get(key)
+            }
+            return {'method': method, 'field': field, 'file_id': media['file_id'], 'params': params}
+
+        return None
+
+    async def send_cached_file(self, user_id: int, descriptor: dict) -> dict:
+        """Пересылает пользователю уже загруженный в Telegram файл по file_id, см. resend_descriptor."""
+        params: dict = {'chat_id': str(user_id), descriptor['field']: descriptor['file_id'], **descriptor['params']}
+        return await self._request(descriptor['method'], params=params)
+
+
+class FileStream:
+    """
+    Содержимое скачиваемого файла в виде асинхронного итератора чанков размером не больше STREAM_CHUNK_SIZE.
+    Сетевые ошибки во время чтения превращаются в TGNetworkError.
+    """
+    def __init__(self, response: ClientResponse, meta: dict, chunk_size: Optional[int] = STREAM_CHUNK_SIZE):
+        self.response: ClientResponse = response
+        self.meta: dict = meta
+        self.chunk_size: int = chunk_size
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in self.response.content.iter_chunked(self.chunk_size):
+                yield chunk
+        except Exception as exc:
+            raise TGNetworkError('Receiving file content is failed.', self.meta, exc)
+
+    async def read(self) -> bytes:
+        """Дочитывает файл целиком. Для форматов и действий, которые не умеют работать с потоком."""
+        try:
+            return await self.response.read()
+        except Exception as exc:
+            raise TGNetworkError('Receiving file content is failed.', self.meta, exc)
+
+
+class RangedFileStream:
+    """
+    Файл, который качается parts параллельными Range запросами в буфер размером с файл.
+    size - размер файла, проверенный по Content-Range (см. TelegramAPI._range_file_size).
+    response - уже открытый ответ 206 на первую часть: ее чанки при итерации отдаются сразу, как и у FileStream,
+    а остальные части в это время качаются в буфер и отдаются по порядку, как только скачаны.
+    read() отдает сам буфер (bytearray), без копирования. close() отменяет части, которые еще качаются.
+    """
+    def __init__(
+            self,
+            api: TelegramAPI,
+            url: str,
+            response: ClientResponse,
+            meta: dict,
+            part_size: int,
+            size: int,
+            chunk_size: Optional[int] = STREAM_CHUNK_SIZE,
+    ):
+        self.response: ClientResponse = response
+        self.meta: dict = meta
+        self.chunk_size: int = chunk_size
+        self.first_end: int = min(part_size, size)
+        self.buffer: bytearray = bytearray(size)
+        self.parts: List[Tuple[int, int, asyncio.Future]] = [
+            (start, min(start + part_size, size), asyncio.ensure_future(
+                api._fetch_range(url, meta, self.buffer, start, min(start + part_size, size)),
+            ))
+            for start in range(part_size, size, part_size)
+        ]
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            offset: int = 0
+            async for chunk in self.response.content.iter_chunked(self.chunk_size):
+                offset += len(chunk)
+                if offset > self.first_end:
+                    raise TGApiError('File server returned more bytes than requested.', {'end': self.first_end})
+                yield chunk
+            if offset != self.first_end:
+                raise TGApiError('File server returned incomplete range.', {'end': self.first_end, 'got': offset})
+
+            view: memoryview = memoryview(self.buffer)
+            for start, end, task in self.parts:
+                await task
+                for position in range(start, end, self.chunk_size):
+                    yield bytes(view[position:min(position + self.chunk_size, end)])
+        except SoundHoundError:
+            raise
+        except Exception as exc:
+            raise TGNetworkError('Receiving file content is failed.', self.meta, exc)
+
+    async def read(self) -> bytearray:
+        """Дочитывает все части в буфер и отдает его."""
+        try:
+            await TelegramAPI._read_range(self.response, self.buffer, 0, self.first_end)
+            await asyncio.gather(*[task for _, _, task in self.parts])
+        except SoundHoundError:
+            raise
+        except Exception as exc:
+            raise TGNetworkError('Receiving file content is failed.', self.meta, exc)
+        return self.buffer
+
+    async def close(self):
+        """Одна часть упала или файл больше не нужен - остальные не оставляем качать в фоне."""
+        for _, _, task in self.parts:
+            task.cancel()
+        await asyncio.gather(*[task for _, _, task in self.parts], return_exceptions=True)
+
+
+class LocalFileStream:
+    """
+    То же, что FileStream, но для файла на диске локального Bot API сервера (TG_LOCAL_MODE).
+    ffmpeg и ffprobe читают такой файл прямо по path (см. mediahandler.local_path), без pipe и временной копии.
+    Итерация и read() нужны только обработке в процессе (native crop, обложка), read() загружает файл в память.
+    Чтение идет в пуле потоков, чтобы большой файл не блокировал event loop.
+    """
+    def __init__(self, path: str, meta: dict, chunk_size: Optional[int] = STREAM_CHUNK_SIZE):
+        self.path: str = path
+        self.meta: dict = meta
+        self.chunk_size: int = chunk_size
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        try:
+            with open(self.path, 'rb') as file:
+                while True:
+                    chunk: bytes = await loop.run_in_executor(None, file.read, self.chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+        except OSError as exc:
+            raise TGNetworkError('Reading local file is failed.', self.meta, exc)
+
+    async def read(self) -> bytes:
+        try:
+            return await asyncio.get_event_loop().run_in_executor(None, Path(self.path).read_bytes)
+        except OSError as exc:
+            raise TGNetworkError('Reading local file is failed.', self.meta, exc)
@@ -12,6 +12,15 @@ def is_start_message(update):
     return False
 
 
+def is_simple_update(update: dict) -> bool:
+    """
+    Update без файлов: текст или нажатие кнопки. Его обработка - только redis и текстовый ответ,
+    поэтому его можно обработать прямо в webhook и ответить в теле HTTP ответа.
+    """
+    message: dict = update.get('message') or {}
+    return not any(message.get(media) for media in ('audio', 'voice', 'document', 'video', 'animation', 'photo'))
+
+
 def resize_thumbnail(img_data: bytes, width: int, height: int, edge_max_limit: int = 320) -> bytes:
     """
     TG API, InputMediaAudio: The thumbnail should be in JPEG format and less than 200 kB in size.
@@ -1,15 +1,20 @@
 import logging
 from logging import Logger
-from typing import Optional
+import time
+from typing import List, Optional
 
-from aiohttp.web import Response, View
+from aiohttp.web import Response, View, json_response
 from aiojobs.aiohttp import spawn
 from marshmallow.exceptions import ValidationError
 
-from app.config import DEBUGLEVEL
+from app import codec
+from app.config import DEBUGLEVEL, FULL_UPDATE_SCHEMA, MEDIA_WORKERS_ENABLED
 from app.exceptions.tg_api import UpdateValidationError
+from app.lease import UserLease
+from app.metrics import metrics
+from app.serializers.fast_update import parse_update
 from app.serializers.telegram import Update
-from app.utils import is_start_message
+from app.utils import is_simple_update, is_start_message
 
 log: Logger = logging.getLogger(__name__)
 logging.basicConfig(level=DEBUGLEVEL)
@@ -20,8 +25,12 @@ class WebhookHandler(View):
     Webhook-хэндлер бота. Принимает входящее от Telegram API сообщение (update).
     Сериализует его, запускает бэкграунд корутину (asyncio job) который принимает решение о дальнейшем действии бота,
     и возвращает Response() не дожидаясь выполнения джоба. Вся дальнейшая работа бота происходит в фоновом джобе.
-    Dispatch-джоб устанавливает lock в redis для этого пользователя и снимает его по завершении.
-    Т.о. все входящие сообщения от этого пользователя во время действия lock отвергаются хэндлером.
+    До запуска джоба хэндлер атомарно захватывает lease пользователя в redis (см. app/lease.py),
+    джоб продлевает его, пока работает, и снимает по завершении.
+    Т.о. все входящие сообщения от этого пользователя во время действия lease отвергаются хэндлером.
+    Update без файлов (текст, кнопки) обрабатываются сразу, а единственный текстовый ответ на них
+    возвращается в теле HTTP ответа вместо отдельного запроса к Telegram API.
+    В режиме MEDIA_WORKERS_ENABLED джоб не запускается здесь, а ставится в очередь redis для пула app/worker.py.
     """
     @staticmethod
     def validate_user(update_data: dict) -> int:
@@ -62,36 +71,79 @@ class WebhookHandler(View):
                 if data['message']['from'].get('id'):
                     return data['message']['from']['id']
 
+    @staticmethod
+    def reply(params: dict) -> Response:
+        """
+        Ответ на update прямо в теле HTTP ответа webhook: Telegram сам выполнит sendMessage с этими параметрами.
+        Экономит отдельный исходящий запрос к Telegram API.
+        """
+        return json_response(
+            {'method': 'sendMessage', **{k: v for k, v in params.items() if v}}, dumps=codec.dumps,
+        )
+
+    def reply_many(self, outbox: List[dict]) -> Response:
+        """
+        В теле webhook ответа помещается только один метод. Если ответов больше, они уходят через
+        BackgroundSender по порядку, чтобы не перемешались. Webhook их отправки не ждет.
+        """
+        if not outbox:
+            return Response()
+        if len(outbox) == 1:
+            return self.reply(outbox[0])
+
+        self.request.app['sender'].submit(outbox)
+        return Response()
+
     async def post(self) -> Response:
         """
         POST-хэндлер webhook бота.
         Отвечает по URL, который устанавливается как webhook URL боту при старте Aiohttp Application.
+        Сам хэндлер никогда не ждет исходящих запросов к Telegram API. Время ответа пишется в metrics (webhook.handle).
         """
-        data: dict = await self.request.json()
+        started: float = time.monotonic()
+        try:
+            return await self.handle()
+        finally:
+            metrics.timing('webhook.handle').observe(time.monotonic() - started)
+
+    async def handle(self) -> Response:
+        data: dict = codec.loads(await self.request.read())
 
         try:
-            update = Update().load(data)
+            update = Update().load(data) if FULL_UPDATE_SCHEMA else parse_update(data)
         except ValidationError:
             user_id = self.find_sender(data)
+            log.exception('Marshmallow serialization failed.')
             if user_id:
-                await self.request.app['tg_api'].send_message(
+                return self.reply(self.request.app['tg_api'].message_params(
                     user_id,
                     'Unknown message type. Only audio/Voice, text and keyboard messages are supported by now.',
-                )
-            log.exception('Marshmallow serialization failed.')
+                ))
             return Response()
 
         user_id: int = self.validate_user(update)
 
         log.debug(f'Incoming message from {user_id}: {update}\n')
 
-        with await self.request.app['redis'] as conn:
-            if is_start_message(update):
-                await conn.delete(f'{user_id}-lock')
-            elif await conn.exists(f'{user_id}-lock'):
-                await self.request.app['tg_api'].send_message(user_id, 'operation is pending')
-                return Response()
+        lease: UserLease = self.request.app['lease']
+        lease_token: Optional[str]
+        if is_start_message(update):
+            lease_token = await lease.force_acquire(user_id)
+        else:
+            lease_token = await lease.acquire(user_id)
+        if not lease_token:
+            return self.reply(self.request.app['tg_api'].message_params(user_id, 'operation is pending'))
 
-        await spawn(self.request, self.request.app['dispatcher'].dispatch(user_id, update))
+        try:
+            if is_simple_update(update):
+                outbox: List[dict] = await self.request.app['dispatcher'].dispatch_inline(user_id, update, lease_token)
+                return self.reply_many(outbox)
+            elif MEDIA_WORKERS_ENABLED:
+                await self.request.app['job_queue'].push(user_id, update, lease_token)
+            else:
+                await spawn(self.request, self.request.app['dispatcher'].dispatch(user_id, update, lease_token))
+        except Exception:
+            await lease.release(user_id, lease_token)
+            raise
 
         return Response()
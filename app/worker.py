@@ -0,0 +1,125 @@
+"""
+Пул media-воркеров. Запуск: python -m app.worker
+
+Каждый процесс пула забирает джобы из очереди redis (см. app/jobs.py) и выполняет их через Dispatcher,
+т.е. вся работа с ffmpeg происходит здесь, а не в gunicorn воркере, принимающем webhook.
+Количество процессов: MEDIA_WORKERS, количество одновременных джобов в процессе: MEDIA_WORKER_CONCURRENCY.
+"""
+import asyncio
+import logging
+from logging import Logger
+from multiprocessing import Process
+import signal
+from typing import List, Optional, Set, Tuple
+
+from aiohttp import ClientSession
+import aioredis
+from aioredis.commands import Redis
+
+from app.cache import FileMetaCache
+from app.config import DEBUGLEVEL, MEDIA_WORKER_CONCURRENCY, MEDIA_WORKERS, REDIS_ADDRESS
+from app.dispatcher import Dispatcher
+from app.executor import blocking_executor
+from app.jobs import JobQueue, consumer_slots
+from app.stats import MetricsPublisher
+from app.tg_api import TelegramAPI, create_api_session, create_file_session
+
+log: Logger = logging.getLogger(__name__)
+logging.basicConfig(level=DEBUGLEVEL)
+
+
+async def run_job(slots: asyncio.Semaphore, dispatcher: Dispatcher, user_id: int, update: dict, lease_token: str):
+    """Выполняет один джоб и освобождает его слот. Ошибки обработки ловит сам Dispatcher.dispatch."""
+    consumer_slots.set(slots)
+    try:
+        await dispatcher.dispatch(user_id, update, lease_token)
+    finally:
+        slots.release()
+
+
+async def consume(worker_name: str, concurrency: int, queue: JobQueue, dispatcher: Dispatcher):
+    """
+    Бесконечный цикл потребителя очереди. Одновременно выполняется не больше concurrency джобов: джоб занимает
+    слот до конца, кроме времени ожидания чужого результата (см. consumer_slot_released).
+    """
+    slots: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+    jobs: Set[asyncio.Task] = set()
+    try:
+        while True:
+            await slots.acquire()
+            job: Optional[Tuple[int, dict, str]] = await queue.pop()
+            if not job:
+                slots.release()
+                continue
+
+            user_id, update, lease_token = job
+            log.debug(f'{worker_name} got job for user {user_id}')
+            task: asyncio.Task = asyncio.ensure_future(run_job(slots, dispatcher, user_id, update, lease_token))
+            jobs.add(task)
+            task.add_done_callback(jobs.discard)
+    finally:
+        for task in jobs:
+            task.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+
+async def run_worker(worker_name: str, concurrency: int):
+    # Одно соединение на BLPOP очереди, плюс соединения для самих джобов и BLPOP джобов, ждущих чужой результат.
+    redis_pool: Redis = await aioredis.create_redis_pool(REDIS_ADDRESS, db=0, maxsize=concurrency * 3 + 2)
+    client_session: ClientSession = create_api_session()
+    file_session: ClientSession = create_file_session()
+    tg_api: TelegramAPI = TelegramAPI(client_session, file_session, file_meta_cache=FileMetaCache(redis_pool))
+    dispatcher: Dispatcher = Dispatcher(redis_pool, tg_api, client_session)
+    queue: JobQueue = JobQueue(redis_pool)
+    # Метрики воркера (очередь cpu_scheduler, crop, transcode и т.д.) видны в /stats/ только через redis.
+    publisher: MetricsPublisher = MetricsPublisher(redis_pool, worker_name)
+    await publisher.start()
+
+    log.info(f'{worker_name} started with {concurrency} consumers')
+    try:
+        await consume(worker_name, concurrency, queue, dispatcher)
+    finally:
+        await publisher.stop()
+        await client_session.close()
+        await file_session.close()
+        await blocking_executor.shutdown()
+        redis_pool.close()
+        await redis_pool.wait_closed()
+        log.info(f'{worker_name} stopped')
+
+
+def worker_process(worker_name: str, concurrency: int):
+    """Точка входа дочернего процесса пула."""
+    # SIGTERM от родителя превращаем в KeyboardInterrupt, чтобы отработали finally и закрылись соединения.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(run_worker(worker_name, concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+def main(workers: int = MEDIA_WORKERS, concurrency: int = MEDIA_WORKER_CONCURRENCY):
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    processes: List[Process] = [
+        Process(target=worker_process, args=(f'media-worker-{n}', concurrency), daemon=True)
+        for n in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    log.info(f'Started {workers} media worker processes')
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
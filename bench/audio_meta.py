@@ -0,0 +1,52 @@
+"""
+Битрейт перед makeopus: mutagen в процессе (get_audio_meta) против подпроцесса ffprobe.
+Запуск из корня репозитория: python -m bench.audio_meta path/to/file.mp3 [path/to/file.m4a ...]
+
+ffprobe каждый раз - fork/exec плюс передача всего файла через pipe, mutagen читает только заголовки.
+"""
+import asyncio
+from pathlib import Path
+import sys
+import time
+from typing import List
+
+from app.mediahandler import AudioHandler
+
+ROUNDS: int = 20
+
+
+async def measure(handler: AudioHandler, path: Path):
+    audio: bytes = path.read_bytes()
+    suffix: str = path.suffix.lower()
+
+    started: float = time.perf_counter()
+    for _ in range(ROUNDS):
+        mutagen_meta = AudioHandler.get_audio_meta(audio)
+    mutagen_ms: float = (time.perf_counter() - started) / ROUNDS * 1000
+
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        output: bytes = await handler._run_command(
+            'ffprobe', audio, suffix, '-show_entries', 'stream=bit_rate', '-select_streams', 'a', '-of', 'csv',
+        )
+    ffprobe_ms: float = (time.perf_counter() - started) / ROUNDS * 1000
+
+    bitrate: str = str(mutagen_meta and mutagen_meta['bitrate'])
+    print(
+        f'{path.name:<32}{len(audio) // 1024:>10}{bitrate:>12}{output.decode().strip():>20}'
+        f'{mutagen_ms:>12.2f}{ffprobe_ms:>12.2f}'
+    )
+
+
+async def main(paths: List[str]):
+    handler: AudioHandler = AudioHandler()
+    print(f'{"file":<32}{"KB":>10}{"mutagen":>12}{"ffprobe":>20}{"mutagen ms":>12}{"ffprobe ms":>12}')
+    for path in paths:
+        await measure(handler, Path(path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python -m bench.audio_meta FILE [FILE ...]')
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+"""
+JSON стоимость одного update от приема до ответа: stdlib json против app.codec (orjson, если установлен).
+Запуск из корня репозитория: python -m bench.json_codec
+
+На каждый update считается: разбор тела webhook, ответ в webhook со списком действий (клавиатура),
+разбор ответа Telegram API на sendAudio. Для видео дополнительно разбор вывода ffprobe.
+"""
+import json
+import timeit
+from typing import Callable, Dict
+
+from app import codec
+from app.actions_dict import action_buttons
+from app.tg_api import encode_keyboard
+from bench.update_parsing import UPDATES
+
+ROUNDS: int = 5000
+
+SEND_AUDIO_RESPONSE: bytes = json.dumps({
+    'ok': True,
+    'result': {
+        'message_id': 14,
+        'from': {'id': 1, 'is_bot': True, 'first_name': 'SoundHound', 'username': 'soundhound_bot'},
+        'chat': {'id': 123456789, 'first_name': 'Ivan', 'username': 'ivan', 'type': 'private'},
+        'date': 1600000004,
+        'audio': {
+            'file_id': 'CQACAgIAAxkBAAIB', 'file_unique_id': 'AgADmQcAAr', 'duration': 105,
+            'performer': 'Artist', 'title': 'Title', 'mime_type': 'audio/mpeg', 'file_size': 1680000,
+        },
+    },
+}).encode()
+FFPROBE_OUTPUT: bytes = json.dumps({
+    'streams': [{
+        'index': 0, 'codec_name': 'h264', 'codec_type': 'video', 'width': 1280, 'height': 720,
+        'coded_width': 1280, 'coded_height': 720, 'pix_fmt': 'yuv420p', 'r_frame_rate': '30/1',
+        'duration': '59.966667', 'bit_rate': '2500000', 'nb_frames': '1799',
+        'disposition': {'default': 1, 'dub': 0, 'original': 0, 'comment': 0},
+        'tags': {'language': 'und', 'handler_name': 'VideoHandler'},
+    }],
+}).encode()
+
+
+def stdlib_update(body: bytes) -> Callable[[], None]:
+    def run():
+        json.loads(body)
+        json.dumps({'method': 'sendMessage', 'chat_id': 123456789, 'text': 'Please select an action',
+                    'reply_markup': json.dumps({
+                        'inline_keyboard': [[{'callback_data': k[0], 'text': k[1]}] for k in action_buttons]
+                    })})
+        json.loads(SEND_AUDIO_RESPONSE)
+        json.loads(FFPROBE_OUTPUT)
+
+    return run
+
+
+def codec_update(body: bytes) -> Callable[[], None]:
+    def run():
+        codec.loads(body)
+        codec.dumps({'method': 'sendMessage', 'chat_id': 123456789, 'text': 'Please select an action',
+                     'reply_markup': encode_keyboard(action_buttons)})
+        codec.loads(SEND_AUDIO_RESPONSE)
+        codec.loads(FFPROBE_OUTPUT)
+
+    return run
+
+
+def main():
+    bodies: Dict[str, bytes] = {name: json.dumps(update).encode() for name, update in UPDATES.items()}
+    print(f'codec backend: {codec.BACKEND}')
+    print(f'{"update":<24}{"stdlib us":>12}{"codec us":>12}{"speedup":>10}')
+    for name, body in bodies.items():
+        stdlib: float = timeit.timeit(stdlib_update(body), number=ROUNDS) / ROUNDS * 1e6
+        fast: float = timeit.timeit(codec_update(body), number=ROUNDS) / ROUNDS * 1e6
+        print(f'{name:<24}{stdlib:>12.1f}{fast:>12.1f}{stdlib / fast:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
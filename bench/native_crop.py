@@ -0,0 +1,67 @@
+"""
+crop без ffmpeg (app/crop.py) против ffmpeg -acodec copy.
+Запуск из корня репозитория: python -m bench.native_crop [path/to/file.flac path/to/file.mp3 ...]
+
+Без аргументов режется сгенерированный WAV (3 минуты, 44.1 kHz stereo 16 bit). FLAC и MP3 передаются аргументами.
+ffmpeg путь замеряется, только если ffmpeg установлен.
+"""
+import asyncio
+from io import BytesIO
+import os
+from pathlib import Path
+import shutil
+import sys
+import time
+from typing import Dict, Tuple
+import wave
+
+from app.crop import native_crop
+
+ROUNDS: int = 20
+TIME_RANGE: Tuple[int, int] = (30, 150)
+
+
+def generated_wav(seconds: int = 180) -> bytes:
+    buf: BytesIO = BytesIO()
+    with wave.open(buf, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(44100)
+        wav.writeframes(os.urandom(44100 * 4 * seconds))
+    return buf.getvalue()
+
+
+async def ffmpeg_crop(audio: bytes, suffix: str) -> bytes:
+    from app.mediahandler import AudioHandler
+    return await AudioHandler()._run_command(
+        'ffmpeg', audio, suffix,
+        '-ss', str(TIME_RANGE[0]), '-to', str(TIME_RANGE[1]), '-acodec', 'copy', '-f', suffix.lstrip('.'),
+    )
+
+
+async def main(paths: Tuple[str]):
+    files: Dict[str, Tuple[bytes, str]] = {'generated.wav': (generated_wav(), '.wav')}
+    files.update({Path(path).name: (Path(path).read_bytes(), Path(path).suffix.lower()) for path in paths})
+    has_ffmpeg: bool = bool(shutil.which('ffmpeg'))
+
+    print(f'{"file":<32}{"MB":>8}{"native ms":>12}{"ffmpeg ms":>12}{"out MB":>10}')
+    for name, (audio, suffix) in files.items():
+        started: float = time.perf_counter()
+        for _ in range(ROUNDS):
+            # Куски не склеиваются: как и при загрузке, они отдаются дальше как есть (см. iter_pieces).
+            result = native_crop(audio, suffix, TIME_RANGE)
+            size: int = sum(len(piece) for piece in result) if result else 0
+        native_ms: float = (time.perf_counter() - started) / ROUNDS * 1000
+
+        ffmpeg_ms: str = '-'
+        if has_ffmpeg:
+            started = time.perf_counter()
+            for _ in range(ROUNDS):
+                await ffmpeg_crop(audio, suffix)
+            ffmpeg_ms = f'{(time.perf_counter() - started) / ROUNDS * 1000:.1f}'
+
+        print(f'{name:<32}{len(audio) / 2 ** 20:>8.1f}{native_ms:>12.2f}{ffmpeg_ms:>12}{size / 2 ** 20:>10.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(tuple(sys.argv[1:])))
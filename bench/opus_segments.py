@@ -0,0 +1,76 @@
+"""
+makeopus одним ffmpeg против кодирования по сегментам (AudioHandler._make_opus_segmented).
+Запуск из корня репозитория: python -m bench.opus_segments [path/to/file.flac ...]
+
+Без аргументов кодируется сгенерированный WAV (10 минут, 44.1 kHz stereo 16 bit, синус).
+Нужны ffmpeg с libopus и mutagen. Кроме времени печатается длительность результата по granule position
+последней страницы: у склейки она должна совпадать с длительностью входа и результата одного ffmpeg.
+"""
+import asyncio
+from io import BytesIO
+import math
+from pathlib import Path
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+import wave
+
+from app.mediahandler import AudioHandler
+from app.ogg import parse_opus
+from app.scheduler import cpu_scheduler
+
+
+def generated_wav(seconds: int = 600) -> bytes:
+    buf: BytesIO = BytesIO()
+    period: bytes = b''.join(
+        struct.pack('<hh', int(8000 * math.sin(2 * math.pi * n / 100)), int(8000 * math.cos(2 * math.pi * n / 100)))
+        for n in range(100)
+    )
+    with wave.open(buf, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(44100)
+        wav.writeframes(period * (441 * seconds))
+    return buf.getvalue()
+
+
+def opus_duration(data: bytes) -> float:
+    stream = parse_opus(data)
+    return (stream.granule - stream.pre_skip) / 48000 if stream else float('nan')
+
+
+async def main(paths: Tuple[str]):
+    files: Dict[str, Tuple[bytes, str]] = {'generated.wav': (generated_wav(), '.wav')}
+    files.update({Path(path).name: (Path(path).read_bytes(), Path(path).suffix.lower()) for path in paths})
+    handler: AudioHandler = AudioHandler()
+
+    print(f'{"file":<32}{"input s":>10}{"single s":>10}{"out s":>10}{"segments s":>12}{"out s":>10}')
+    for name, (audio, suffix) in files.items():
+        length: float = handler.get_audio_meta(audio)['length']
+
+        started: float = time.perf_counter()
+        single: bytes = await handler._run_command(
+            'ffmpeg', audio, suffix, '-vn', '-c:a', 'libopus', '-b:a', '128K', '-vbr', 'off', '-f', 'oga',
+        )
+        single_s: float = time.perf_counter() - started
+
+        bounds: Optional[List[int]] = handler._opus_segment_bounds(audio, suffix)
+        segmented: Optional[bytes] = None
+        started = time.perf_counter()
+        if bounds:
+            segmented = await handler._make_opus_segmented(audio, suffix, '128K', bounds)
+        segmented_s: str = f'{time.perf_counter() - started:.2f}' if segmented else '-'
+        segmented_out: str = f'{opus_duration(segmented):.3f}' if segmented else '-'
+
+        print(
+            f'{name:<32}{length:>10.3f}{single_s:>10.2f}{opus_duration(single):>10.3f}'
+            f'{segmented_s:>12}{segmented_out:>10}'
+        )
+
+    if not bounds:
+        print(f'Segmented encoding is off: set OPUS_SEGMENTS > 1 (CPU budget {cpu_scheduler.budget}).')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(tuple(sys.argv[1:])))
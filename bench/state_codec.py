@@ -0,0 +1,96 @@
+"""
+Сравнение старого (pickle + UserStateSchema) и нового (msgpack + blob ключи) формата стейта пользователя.
+Запуск из корня репозитория: python -m bench.state_codec
+
+Показывает время round-trip (encode + decode), сколько байт читается из redis на каждом шаге диалога
+и сколько памяти redis занимает стейт (MEMORY USAGE по всем ключам стейта). Redis берется из BENCH_REDIS
+(по умолчанию redis://localhost), без него колонка памяти пустая.
+"""
+import asyncio
+from dataclasses import asdict
+import logging
+import os
+import pickle
+import timeit
+from typing import Callable, Dict, Optional, Tuple
+
+import aioredis
+
+from app.serializers.user_state import UserStateModel, UserStateSchema, decode_state, encode_state
+
+ROUNDS: int = 2000
+
+
+def legacy_round_trip(state: UserStateModel) -> Tuple[Callable[[], None], int]:
+    data: bytes = pickle.dumps(UserStateSchema().load(asdict(state)))
+
+    def run():
+        UserStateModel(**UserStateSchema().load(pickle.loads(pickle.dumps(UserStateSchema().load(asdict(state))))))
+
+    return run, len(data)
+
+
+def codec_round_trip(state: UserStateModel) -> Tuple[Callable[[], None], int]:
+    data, _ = encode_state(state)
+
+    def run():
+        decode_state(encode_state(state)[0])
+
+    return run, len(data)
+
+
+async def redis_memory(state: UserStateModel) -> Optional[Dict[str, int]]:
+    """MEMORY USAGE ключей стейта в старом формате (один ключ) и в новом (стейт плюс ключи байтовых полей)."""
+    try:
+        redis = await aioredis.create_redis(os.getenv('BENCH_REDIS', 'redis://localhost'))
+    except (OSError, aioredis.RedisError):
+        return None
+
+    legacy: Dict[str, bytes] = {'bench-state': pickle.dumps(UserStateSchema().load(asdict(state)))}
+    data, blobs = encode_state(state)
+    codec: Dict[str, bytes] = {'bench-state': data, **{f'bench-state-{name}': blob for name, blob in blobs.items()}}
+
+    usage: Dict[str, int] = {}
+    try:
+        for fmt, keys in (('legacy', legacy), ('codec', codec)):
+            for key, value in keys.items():
+                await redis.set(key, value)
+            usage[fmt] = sum([await redis.execute('MEMORY', 'USAGE', key) for key in keys])
+            await redis.delete(*keys)
+    finally:
+        redis.close()
+        await redis.wait_closed()
+    return usage
+
+
+def main():
+    # app модули включают DEBUG логирование при импорте.
+    logging.getLogger().setLevel(logging.WARNING)
+    states = {
+        'text step (crop, time range)': UserStateModel(
+            id=123456789,
+            action='crop',
+            actions_sent=True,
+            time_range=(15, 120),
+        ),
+        'setcover with thumbnails': UserStateModel(
+            id=123456789,
+            action='setcover',
+            actions_sent=True,
+            thumbnail_file=os.urandom(300 * 1024),
+            tg_thumbnail_file=os.urandom(40 * 1024),
+        ),
+    }
+
+    print(f'{"state":<32}{"format":<10}{"us/round-trip":>16}{"bytes read/step":>18}{"redis memory":>15}')
+    for name, state in states.items():
+        memory: Optional[Dict[str, int]] = asyncio.run(redis_memory(state))
+        for fmt, factory in (('legacy', legacy_round_trip), ('codec', codec_round_trip)):
+            run, size = factory(state)
+            seconds: float = timeit.timeit(run, number=ROUNDS)
+            used: str = str(memory[fmt]) if memory else '-'
+            print(f'{name:<32}{fmt:<10}{seconds / ROUNDS * 1e6:>16.1f}{size:>18}{used:>15}')
+
+
+if __name__ == '__main__':
+    main()
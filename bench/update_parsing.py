@@ -0,0 +1,75 @@
+"""
+Стоимость разбора одного update: полная схема Update().load против быстрого parse_update.
+Запуск из корня репозитория: python -m bench.update_parsing
+"""
+import copy
+import logging
+import timeit
+from typing import Dict
+
+from app.serializers.fast_update import parse_update
+from app.serializers.telegram import Update
+
+ROUNDS: int = 5000
+
+USER: dict = {'id': 123456789, 'is_bot': False, 'first_name': 'Ivan', 'username': 'ivan', 'language_code': 'ru'}
+CHAT: dict = {'id': 123456789, 'first_name': 'Ivan', 'username': 'ivan', 'type': 'private'}
+THUMB: dict = {'file_id': 'AAMCAgADGQEAAg', 'file_unique_id': 'AQADx', 'file_size': 9846, 'width': 320, 'height': 320}
+
+UPDATES: Dict[str, dict] = {
+    'text /start': {
+        'update_id': 1,
+        'message': {
+            'message_id': 10, 'from': USER, 'chat': CHAT, 'date': 1600000000, 'text': '/start',
+            'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}],
+        },
+    },
+    'callback_query': {
+        'update_id': 2,
+        'callback_query': {
+            'id': '530337396915', 'from': USER, 'chat_instance': '-1234', 'data': 'makeopus',
+            'message': {
+                'message_id': 11, 'from': {'id': 1, 'is_bot': True, 'first_name': 'SoundHound'}, 'chat': CHAT,
+                'date': 1600000001, 'text': 'Please select an action',
+                'reply_markup': {'inline_keyboard': [[{'text': 'Convert', 'callback_data': 'makeopus'}]]},
+            },
+        },
+    },
+    'audio': {
+        'update_id': 3,
+        'message': {
+            'message_id': 12, 'from': USER, 'chat': CHAT, 'date': 1600000002,
+            'audio': {
+                'file_id': 'CQACAgIAAxkBAAIB', 'file_unique_id': 'AgADmQcAAr', 'duration': 245,
+                'performer': 'Artist', 'title': 'Title', 'mime_type': 'audio/mpeg', 'file_size': 5898240,
+                'thumb': THUMB,
+            },
+        },
+    },
+    'forwarded photo reply': {
+        'update_id': 4,
+        'message': {
+            'message_id': 13, 'from': USER, 'chat': CHAT, 'date': 1600000003,
+            'forward_from': USER, 'forward_date': 1590000000,
+            'reply_to_message': {'message_id': 12, 'from': USER, 'chat': CHAT, 'date': 1600000002, 'text': '15-120'},
+            'photo': [THUMB, dict(THUMB, width=800, height=800, file_size=72000)],
+        },
+    },
+}
+
+
+def main():
+    # Модули app пишут DEBUG лог при импорте и разборе, в замерах он не нужен.
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f'{"update":<24}{"Update().load us":>18}{"parse_update us":>18}{"speedup":>10}')
+    schema: Update = Update()
+    for name, update in UPDATES.items():
+        full: float = timeit.timeit(lambda: schema.load(copy.deepcopy(update)), number=ROUNDS)
+        fast: float = timeit.timeit(lambda: parse_update(copy.deepcopy(update)), number=ROUNDS)
+        copying: float = timeit.timeit(lambda: copy.deepcopy(update), number=ROUNDS)
+        full, fast = (full - copying) / ROUNDS * 1e6, (fast - copying) / ROUNDS * 1e6
+        print(f'{name:<24}{full:>18.1f}{fast:>18.1f}{full / fast:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
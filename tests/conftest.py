@@ -0,0 +1,14 @@
+import os
+import shutil
+
+import pytest
+
+# app.config требует эти переменные при импорте.
+os.environ.setdefault('TOKEN', 'test-token')
+os.environ.setdefault('PUBLIC_PORT', '8443')
+os.environ.setdefault('REDIS_HOST', 'localhost')
+os.environ.setdefault('DEBUGLEVEL', 'INFO')
+
+requires_ffmpeg = pytest.mark.skipif(
+    not (shutil.which('ffmpeg') and shutil.which('ffprobe')), reason='ffmpeg and ffprobe are required',
+)
@@ -0,0 +1,96 @@
+import subprocess
+from typing import List, Optional
+
+import pytest
+
+from app.crop import Frame, _crc16, _following_frame, _next_frame, _parse_flac_metadata, _utf8_number, crop_flac
+from tests.conftest import requires_ffmpeg
+
+
+def generated_flac(*params: str) -> bytes:
+    return subprocess.run(
+        ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=f=440:d=20', *params, '-c:a', 'flac', '-f', 'flac', '-'],
+        check=True, capture_output=True,
+    ).stdout
+
+
+def flac_file(tmp_path) -> bytes:
+    # Записанный в файл, а не в pipe, FLAC знает свое число сэмплов: без него конец файла не проверяется.
+    path = tmp_path / 'sine.flac'
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=f=440:d=20', str(path)], check=True)
+    return path.read_bytes()
+
+
+def flac_frames(data: bytes) -> List[Frame]:
+    streaminfo, _, frames_start = _parse_flac_metadata(data)
+    result: List[Frame] = []
+    frame: Optional[Frame] = _next_frame(data, frames_start, streaminfo)
+    while frame:
+        result.append(frame)
+        frame = _following_frame(data, frame, streaminfo)
+    return result
+
+
+def decode(data: bytes) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ['ffmpeg', '-hide_banner', '-err_detect', 'crccheck', '-i', '-', '-f', 's16le', '-'],
+        input=data, capture_output=True,
+    )
+
+
+@pytest.mark.parametrize('number', [0, 1, 127, 128, 2047, 2048, 65535, 65536, 2 ** 21, 2 ** 31, 2 ** 36 - 1])
+def test_utf8_number_roundtrip(number):
+    encoded: bytes = _utf8_number(number)
+    extra: int = 0
+    while extra < 7 and encoded[0] & (0x80 >> extra):
+        extra += 1
+    value: int = encoded[0] & (0x7F >> extra) if extra else encoded[0]
+    for byte in encoded[1:]:
+        assert byte & 0xC0 == 0x80
+        value = (value << 6) | (byte & 0x3F)
+
+    assert value == number
+    assert len(encoded) == max(1, extra)
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('params', [('-ac', '2'), ('-ac', '1', '-compression_level', '0', '-frame_size', '1000')])
+def test_cropped_flac_is_renumbered_from_zero(params):
+    source: bytes = generated_flac(*params)
+    cropped: bytes = b''.join(crop_flac(source, 5, 12))
+
+    frames: List[Frame] = flac_frames(cropped)
+    assert frames[0].sample == 0
+    ends: List[int] = [frame.pos for frame in frames[1:]] + [len(cropped)]
+    for frame, end in zip(frames, ends):
+        # CRC-16 фрейма пересчитан по линейности: проверяем его полным проходом.
+        assert _crc16(cropped[frame.pos:end - 2]) == int.from_bytes(cropped[end - 2:end], 'big')
+
+    result: subprocess.CompletedProcess = decode(cropped)
+    stderr: str = result.stderr.decode()
+    assert 'start: 0.000000' in stderr
+    assert 'CRC' not in stderr
+    channels: int = 2 if params[1] == '2' else 1
+    assert 7 <= len(result.stdout) / (2 * channels * 44100) < 7.2
+
+
+@requires_ffmpeg
+def test_cropped_flac_runs_to_the_end_of_file(tmp_path):
+    cropped: bytes = b''.join(crop_flac(flac_file(tmp_path), 15, 25))
+
+    result: subprocess.CompletedProcess = decode(cropped)
+    assert 'CRC' not in result.stderr.decode()
+    assert 4.9 <= len(result.stdout) / (2 * 44100) <= 5.1
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('tag', [
+    b'TAG' + b'title'.ljust(125, b'\x00'),
+    b'APETAGEX' + (2000).to_bytes(4, 'little') + bytes(20) + b'\xff\xfb' * 16,
+], ids=['id3v1', 'apev2'])
+def test_flac_with_trailing_tag_is_left_to_ffmpeg(tmp_path, tag):
+    source: bytes = flac_file(tmp_path)
+
+    assert crop_flac(source + tag, 15, 25) is None
+    # Срез, который кончается до тега, режется как обычно.
+    assert b''.join(crop_flac(source + tag, 5, 12)) == b''.join(crop_flac(source, 5, 12))
@@ -0,0 +1,87 @@
+import array
+import asyncio
+from io import BytesIO
+import math
+import subprocess
+from typing import List, Optional
+import wave
+
+import pytest
+
+from app import mediahandler
+from app.mediahandler import AudioHandler
+from app.ogg import parse_opus
+from app.scheduler import cpu_scheduler
+from tests.conftest import requires_ffmpeg
+
+SECONDS: int = 30
+SEGMENTS: int = 4
+RATE: int = 44100
+# Окно вокруг склейки, как в ручной проверке: ±40 мс при 48 kHz.
+WINDOW: int = 1920
+
+
+def sine_wav(seconds: int = SECONDS, frequency: int = 440) -> bytes:
+    samples: array.array = array.array('h', (
+        int(4096 * math.sin(2 * math.pi * frequency * n / RATE)) for n in range(seconds * RATE)
+    ))
+    buf: BytesIO = BytesIO()
+    with wave.open(buf, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(RATE)
+        wav.writeframes(samples.tobytes())
+    return buf.getvalue()
+
+
+def decode(opus: bytes) -> array.array:
+    pcm: bytes = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-i', '-', '-f', 's16le', '-ac', '1', '-ar', '48000', '-'],
+        input=opus, capture_output=True, check=True,
+    ).stdout
+    return array.array('h', pcm)
+
+
+def mean_error(left: array.array, right: array.array, start: int, end: int) -> float:
+    return sum(abs(left[index] - right[index]) for index in range(start, end)) / (end - start)
+
+
+@pytest.fixture
+def segmented(monkeypatch):
+    monkeypatch.setattr(mediahandler, 'OPUS_SEGMENTS', SEGMENTS)
+    monkeypatch.setattr(mediahandler, 'OPUS_SEGMENT_MIN_DURATION', 10)
+    monkeypatch.setattr(cpu_scheduler, 'budget', 2 * SEGMENTS)
+
+
+@requires_ffmpeg
+def test_segmented_opus_is_gapless(segmented):
+    audio: bytes = sine_wav()
+    handler: AudioHandler = AudioHandler()
+
+    async def encode():
+        bounds: Optional[List[int]] = handler._opus_segment_bounds(audio, '.wav')
+        joined: Optional[bytes] = await handler._make_opus_segmented(audio, '.wav', '128K', bounds)
+        single: bytes = await handler._run_command(
+            'ffmpeg', audio, '.wav', '-c:a', 'libopus', '-b:a', '128K', '-vbr', 'off', '-f', 'oga',
+        )
+        return bounds, joined, single
+
+    bounds, joined, single = asyncio.run(encode())
+    assert len(bounds) == SEGMENTS - 1
+    assert joined is not None
+    stream = parse_opus(joined)
+    assert stream.granule - stream.pre_skip == SECONDS * 48000
+
+    pcm: array.array = decode(joined)
+    reference: array.array = decode(single)
+    assert len(pcm) == len(reference) == SECONDS * 48000
+
+    far: float = mean_error(pcm, reference, 48000, bounds[0] - 48000)
+    for bound in bounds:
+        # Склейка в выходе декодера - на границе сегмента плюс pre-skip.
+        join: int = bound + handler.opus_pre_skip
+        near: float = mean_error(pcm, reference, join - WINDOW, join + WINDOW)
+        assert near <= 2 * far + 1, f'join at {join}: error {near:.1f} vs {far:.1f} away from joins'
+        jump: int = max(abs(pcm[index + 1] - pcm[index]) for index in range(join - WINDOW, join + WINDOW))
+        # Соседние сэмплы синуса 440 Hz амплитудой 4096 при 48 kHz отличаются не больше чем на ~236.
+        assert jump < 300, f'join at {join}: sample step {jump}'
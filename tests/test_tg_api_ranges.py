@@ -0,0 +1,150 @@
+import asyncio
+import os
+import re
+from typing import Callable, List, Optional, Tuple
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+from aiohttp.web import Application, Request, Response, StreamResponse
+import pytest
+
+from app import tg_api
+from app.exceptions.tg_api import TGApiError, TGNetworkError
+from app.tg_api import FileStream, RangedFileStream, TelegramAPI
+
+# Размер не делится на число частей: последняя часть короче.
+CONTENT: bytes = os.urandom(1000003)
+PARTS: int = 4
+
+
+def content_range(start: int, end: int, size: int) -> Optional[str]:
+    return f'bytes {start}-{end}/{size}'
+
+
+def file_app(
+        content: bytes,
+        honour_range: bool,
+        ranges: List[Optional[Tuple[int, int]]],
+        make_content_range: Callable[[int, int, int], Optional[str]] = content_range,
+        reset_parts: bool = False,
+) -> Application:
+    async def handler(request: Request) -> StreamResponse:
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', request.headers.get('Range', ''))
+        if not match or not honour_range:
+            ranges.append(None)
+            return Response(body=content)
+        start, end = int(match.group(1)), min(int(match.group(2)), len(content) - 1)
+        ranges.append((start, end))
+        header: Optional[str] = make_content_range(start, end, len(content))
+        headers: dict = {'Content-Range': header} if header else {}
+        if reset_parts and start:
+            # Обрыв соединения посреди части, которая качается в фоне.
+            response: StreamResponse = StreamResponse(status=206, headers={**headers, 'Content-Length': '1000'})
+            await response.prepare(request)
+            await response.write(content[start:start + 10])
+            request.transport.close()
+            return response
+        return Response(status=206, body=content[start:end + 1], headers=headers)
+
+    app: Application = Application()
+    app.router.add_get('/file', handler)
+    return app
+
+
+async def fetch(honour_range: bool, streamed: bool, file_size: int = len(CONTENT), **server_options):
+    ranges: List[Optional[Tuple[int, int]]] = []
+    server: TestServer = TestServer(file_app(CONTENT, honour_range, ranges, **server_options))
+    await server.start_server()
+    try:
+        async with ClientSession() as session:
+            api: TelegramAPI = TelegramAPI(session)
+            meta: dict = {'file_id': 'file', 'file_size': file_size}
+            resolved: Tuple[dict, str] = ({'file_id': 'file', 'suffix': '.mp3'}, str(server.make_url('/file')))
+
+            async def get_file_meta(*_) -> Tuple[dict, str]:
+                return resolved
+            api._get_file_meta = get_file_meta
+
+            if streamed:
+                async with api.stream_file(meta, 'audio') as stream:
+                    kind: type = type(stream)
+                    content: bytes = b''.join([chunk async for chunk in stream])
+            else:
+                content, _ = await api.download_file(meta, 'audio')
+                kind = type(content)
+    finally:
+        await server.close()
+    return content, kind, ranges
+
+
+@pytest.fixture(autouse=True)
+def ranged_downloads(monkeypatch):
+    monkeypatch.setattr(tg_api, 'RANGE_DOWNLOAD_PARTS', PARTS)
+    monkeypatch.setattr(tg_api, 'RANGE_DOWNLOAD_THRESHOLD', 1)
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_ranges_cover_file_exactly(streamed):
+    content, kind, ranges = asyncio.run(fetch(honour_range=True, streamed=streamed))
+
+    assert content == CONTENT
+    assert kind is (RangedFileStream if streamed else bytearray)
+    part: int = -(-len(CONTENT) // PARTS)
+    assert sorted(ranges) == [(start, min(start + part, len(CONTENT)) - 1) for start in range(0, len(CONTENT), part)]
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_size_other_than_file_size_from_telegram_is_rejected(streamed):
+    with pytest.raises(TGApiError):
+        asyncio.run(fetch(honour_range=True, streamed=streamed, file_size=len(CONTENT) - 5000))
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_size_over_download_limit_is_rejected(streamed, monkeypatch):
+    monkeypatch.setattr(tg_api, 'TG_DOWNLOAD_LIMIT', len(CONTENT) - 1)
+
+    with pytest.raises(TGApiError):
+        asyncio.run(fetch(honour_range=True, streamed=streamed))
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+@pytest.mark.parametrize('make_content_range', [
+    lambda start, end, size: None,
+    lambda start, end, size: f'bytes */{size}',
+    lambda start, end, size: f'bytes {start}-{end}/*',
+    lambda start, end, size: f'bytes {start}-{end}/{size}0',
+], ids=['missing', 'unsatisfied', 'unknown_size', 'wrong_size'])
+def test_malformed_content_range_is_tg_api_error(streamed, make_content_range):
+    with pytest.raises(TGApiError):
+        asyncio.run(fetch(honour_range=True, streamed=streamed, make_content_range=make_content_range))
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_reset_part_is_tg_network_error(streamed):
+    with pytest.raises(TGNetworkError):
+        asyncio.run(fetch(honour_range=True, streamed=streamed, reset_parts=True))
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_server_ignoring_range_is_read_in_one_request(streamed):
+    content, kind, ranges = asyncio.run(fetch(honour_range=False, streamed=streamed))
+
+    assert content == CONTENT
+    assert kind is (FileStream if streamed else bytes)
+    assert ranges == [None]
+
+
+def test_reset_part_request_is_tg_network_error():
+    async def fetch_part():
+        server: TestServer = TestServer(file_app(CONTENT, True, [], reset_parts=True))
+        await server.start_server()
+        try:
+            async with ClientSession() as session:
+                await TelegramAPI(session)._fetch_range(
+                    str(server.make_url('/file')), {'file_id': 'file'}, bytearray(len(CONTENT)), 1000, 2000,
+                )
+        finally:
+            await server.close()
+
+    with pytest.raises(TGNetworkError):
+        asyncio.run(fetch_part())